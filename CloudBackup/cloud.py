@@ -20,19 +20,59 @@ Created on 2012-5-1
 @author: Chine
 '''
 
+import os
+import re
+import zlib
+import time
+import heapq
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
 from CloudBackup.lib.vdisk import VdiskClient
 from CloudBackup.lib.s3 import (S3Client, get_end_point as s3_get_end_point, ALL_USERS_URI, 
                                 ACL_PERMISSION as S3_ACL_PERMISSION, 
-                                S3AclGrantByURI, S3AclGrantByPersonID)
+                                S3AclGrantByURI, S3AclGrantByPersonID, MAX_DELETE_OBJECTS)
 from CloudBackup.lib.gs import (GSClient, GSAclGrantByAllUsers,
                                 ACL_PERMISSION as GS_ACL_PERMISSION,
                                 get_end_point as gs_get_end_point)
-from CloudBackup.lib.errors import VdiskError, S3Error
+from CloudBackup.lib.errors import CloudBackupLibError, VdiskError, S3Error
+from CloudBackup.lib.utils import ReadAheadIterator
+from CloudBackup.lib.erasure import ReedSolomon
 from CloudBackup.utils import join_path
+from CloudBackup.sessions import UploadSessions
 
 __author__ = "Chine King"
 
+DEFAULT_PREFETCH_PAGES = 2
+DEFAULT_SHARD_DEPTH = 2
+# the concurrent requests of a recursive listing, the sync and the snapshot list by it.
+DEFAULT_LIST_CONNECTIONS = 4
+DEFAULT_DELETE_WORKERS = 4
+DEFAULT_RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_DATA_SHARDS = 2
+DEFAULT_PARITY_SHARDS = 1
+
+# a shard is named by the path of the file, the md5 of the file and its index.
+SHARD_SUFFIX = '.cbshard'
+SHARD_HEADER = struct.Struct('>BBBQ')
+# the path, the md5, the time uploaded in milliseconds, and the index of the shard,
+# the shards uploaded before the time is added are the oldest.
+shard_pattern = re.compile(r'^(.*)\.([0-9a-f]{32})(?:\.(\d+))?\.(\d+)%s$' % re.escape(SHARD_SUFFIX))
+
 class Storage(object):
+    # the number of files deleted in one batch by delete_files.
+    delete_batch_size = 100
+    # if the storage can check the content of a file on the cloud cheaply,
+    # by the conditional requests eg.
+    conditional = False
+    # if download_range reads only the range, not the whole file.
+    ranged = False
+    
     def _ensure_cloud_path_legal(self, cloud_path):
         return cloud_path.strip('/')
     
@@ -45,12 +85,95 @@ class Storage(object):
     def upload(self, cloud_path, filename):
         raise NotImplementedError
     
-    def download(self, cloud_path, filename):
+    def download(self, cloud_path, filename, md5=None):
+        raise NotImplementedError
+    
+    def upload_raw(self, cloud_path, filename):
+        '''
+        Upload a file without the encryption of the client,
+        the caller encrypts the content itself if needed, the packs eg.
+        '''
+        
+        raise NotImplementedError
+    
+    def download_range(self, cloud_path, offset, length):
+        '''
+        Read a range of a file on the cloud, without the decryption of the client.
+        
+        :return: the content of the range.
+        '''
+        
         raise NotImplementedError
     
     def delete(self, cloud_path, filename):
         raise NotImplementedError
     
+    def _delete_batch(self, cloud_paths):
+        deleted, failed = [], []
+        for cloud_path in cloud_paths:
+            try:
+                self.delete(cloud_path)
+                deleted.append(cloud_path)
+            except CloudBackupLibError, e:
+                failed.append((cloud_path, e))
+        return deleted, failed
+    
+    def delete_files(self, cloud_paths, workers=DEFAULT_DELETE_WORKERS):
+        '''
+        Delete the files in the cloud in batches, several batches are in flight at the same time.
+        
+        :param cloud_paths: the paths on the cloud, it can be a generator,
+                            the batches are sent while iterating it.
+        :param workers(optional): the number of batches in flight.
+        
+        :return 0: the list of paths deleted.
+        :return 1: the list of (path, error) failed to delete.
+        '''
+        
+        deleted, failed = [], []
+        slots = threading.Semaphore(workers * 2)
+        
+        def _delete(batch):
+            try:
+                return self._delete_batch(batch)
+            except CloudBackupLibError, e:
+                return [], [(cloud_path, e) for cloud_path in batch]
+            except Exception, e:
+                error = CloudBackupLibError('cloud', -1, str(e))
+                return [], [(cloud_path, error) for cloud_path in batch]
+            
+        def _done(result):
+            deleted.extend(result[0])
+            failed.extend(result[1])
+            slots.release()
+            
+        def _submit(batch):
+            # limit the batches waiting, so the paths are not all read into the memory.
+            slots.acquire()
+            pool.apply_async(_delete, (batch, ), callback=_done)
+        
+        pool = ThreadPool(max(workers, 1))
+        try:
+            batch = []
+            for cloud_path in cloud_paths:
+                batch.append(cloud_path)
+                if len(batch) >= self.delete_batch_size:
+                    _submit(batch)
+                    batch = []
+            if batch:
+                _submit(batch)
+        finally:
+            pool.close()
+            pool.join()
+            
+        return deleted, failed
+    
+    def copy(self, src_cloud_path, cloud_path):
+        raise NotImplementedError
+    
+    def move(self, src_cloud_path, cloud_path):
+        raise NotImplementedError
+    
     def list(self, cloud_path, recursive=False):
         raise NotImplementedError
     
@@ -60,24 +183,82 @@ class Storage(object):
     def info(self, cloud_path):
         raise NotImplementedError
     
+    def head(self, cloud_path):
+        raise NotImplementedError
+    
+    def abort_upload(self, cloud_path):
+        '''
+        Give up the unfinished upload of a file, 
+        nothing to do if the storage doesn't upload by parts.
+        '''
+        
+        pass
+    
     def share(self, cloud_path):
         raise NotImplementedError
     
-class CloudFile(object):
+    def get_change_token(self, probe=True):
+        '''
+        Get a token which changes when the content of the cloud changes,
+        None if the storage doesn't support.
+        
+        :param probe(optional): if False, return the token known by the latest request
+                                without sending a new one.
+        '''
+        
+        return None
+    
+class CloudEntry(object):
+    '''
+    The base of the files and folders listed on the cloud.
+    
+    A listing may return millions of them, so the attributes are slots.
+    The attributes not in the slots, which the info of a file returns eg,
+    are kept in a dict, made only when there are.
+    '''
+    
+    __slots__ = ('path', 'cloud_path', 'id', 'extras')
+    
+    def _set_extras(self, kwargs):
+        self.extras = None
+        for k, v in kwargs.iteritems():
+            if k in self._fields:
+                setattr(self, k, v)
+            else:
+                if self.extras is None:
+                    self.extras = {}
+                self.extras[k] = v
+    
+    def __getattr__(self, attr):
+        # only called when the slot is not set, or not a slot.
+        if attr != 'extras':
+            extras = self.extras
+            if extras is not None and attr in extras:
+                return extras[attr]
+        raise AttributeError(attr)
+    
+class CloudFile(CloudEntry):
+    __slots__ = ('content_type', 'md5', 'size', 'timestamp', 'shards')
+    _fields = frozenset(('cloud_path', 'id', 'size', 'timestamp', 'shards'))
+    
     def __init__(self, path, content_type, md5, **kwargs):
         self.path = path
         self.content_type = content_type
         self.md5 = md5
-        for k, v in kwargs.iteritems():
-            setattr(self, k, v)
+        self._set_extras(kwargs)
+    
+class CloudFolder(CloudEntry):
+    __slots__ = ()
+    _fields = frozenset(('cloud_path', 'id'))
     
-class CloudFolder(object):
     def __init__(self, path, **kwargs):
         self.path = path
-        for k, v in kwargs.iteritems():
-            setattr(self, k, v)
+        self._set_extras(kwargs)
     
 class VdiskStorage(Storage):
+    # vdisk can't read a range of a file, so the last file downloaded is kept.
+    range_cache = None
+    
     def __init__(self, client, cache={}, holder_name=''):
         '''
         :param client: must be VdiskClient or it's subclass, CryptoVdiskClient eg.
@@ -191,19 +372,67 @@ class VdiskStorage(Storage):
             
         self.client.upload_file(filename, dir_id, cover, upload_name=cloud_name)
         
-    def download(self, cloud_path, filename):
+    def download(self, cloud_path, filename, md5=None):
         '''
         Download the file to local from cloud.
         
         :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
         :param filename: the local file's absolute path.
+        :param md5(optional): the md5 of the local file, 
+                              if the same as the file on the cloud, the file will not be downloaded.
+        
+        :return: True if the file is downloaded, False if the local file is the same.
         '''
         
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         
         fid = self._get_cloud_file_id(cloud_path)
         
+        if md5 is not None and self.client.get_file_info(fid).md5 == md5:
+            return False
         self.client.download_file(fid, filename)
+        return True
+    
+    def upload_raw(self, cloud_path, filename):
+        '''
+        Upload local file to the cloud without the encryption of the client.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param filename: the local file's absolute path.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        dir_id, cloud_name = self._split_cloud_path(cloud_path)
+        self.client.upload_file(filename, dir_id, True, upload_name=cloud_name, encrypt=False)
+        
+    def download_range(self, cloud_path, offset, length):
+        '''
+        Read a range of a file on the cloud without the decryption of the client,
+        the whole file is downloaded, and kept until another file is read.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param offset: the first byte of the range.
+        :param length: the length of the range.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        cache = self.range_cache
+        if cache is None or cache[0] != cloud_path:
+            fid = self._get_cloud_file_id(cloud_path)
+            fd, tmp = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                self.client.download_file(fid, tmp, decrypt=False)
+                fp = open(tmp, 'rb')
+                try:
+                    cache = self.range_cache = (cloud_path, fp.read())
+                finally:
+                    fp.close()
+            finally:
+                os.remove(tmp)
+                
+        return cache[1][offset:offset+length]
         
     def delete(self, cloud_path):
         '''
@@ -221,6 +450,60 @@ class VdiskStorage(Storage):
             fid = self._get_cloud_file_id(cloud_path)
             self.client.delete_file(fid)
             
+    def _split_cloud_path(self, cloud_path):
+        dir_id = 0
+        if '/' in cloud_path:
+            dir_path, name = tuple(cloud_path.rsplit('/', 1))
+            dir_id = self._get_cloud_dir_id(dir_path, create_if_not_exist=True)
+        else:
+            name = cloud_path
+        return dir_id, name
+            
+    def copy(self, src_cloud_path, cloud_path):
+        '''
+        Copy the file in the cloud, the content is not transfered by the client.
+        
+        :param src_cloud_path: the path of the source file on the cloud, 'test/file.txt' eg.
+        :param cloud_path: the path of the new file on the cloud.
+        '''
+        
+        src_cloud_path = self._ensure_cloud_path_legal(src_cloud_path)
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        fid = self._get_cloud_file_id(src_cloud_path)
+        dir_id, name = self._split_cloud_path(cloud_path)
+        
+        data = self.client.copy_file(fid, name, dir_id)
+        self.cache[cloud_path] = data.fid
+        
+    def move(self, src_cloud_path, cloud_path):
+        '''
+        Move the file or folder in the cloud, the content is not transfered by the client.
+        
+        :param src_cloud_path: the path of the source on the cloud, 'test/file.txt' eg.
+        :param cloud_path: the new path on the cloud.
+        '''
+        
+        src_cloud_path = self._ensure_cloud_path_legal(src_cloud_path)
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        dir_id, name = self._split_cloud_path(cloud_path)
+        try:
+            src_dir_id = self._get_cloud_dir_id(src_cloud_path)
+        except VdiskError:
+            fid = self._get_cloud_file_id(src_cloud_path)
+            self.client.move_file(fid, name, dir_id)
+            self.cache.pop(src_cloud_path, None)
+            self.cache[cloud_path] = fid
+        else:
+            self.client.move_dir(src_dir_id, name, dir_id)
+            # the ids of the sub folders and files are kept, but their paths change.
+            prefix = src_cloud_path + '/'
+            for path in self.cache.keys():
+                if path == src_cloud_path or path.startswith(prefix):
+                    del self.cache[path]
+            self.cache[cloud_path] = src_dir_id
+            
     def list(self, cloud_path, recursive=False):
         '''
         List all objects include folders and files in a cloud path.
@@ -256,7 +539,8 @@ class VdiskStorage(Storage):
                     path = path.split(self.holder+'/', 1)[1]
                     
                 if 'url' in itm:
-                    yield CloudFile(path, itm.type, itm.md5, id=itm.id)
+                    size = int(itm.byte) if itm.byte is not None else None
+                    yield CloudFile(path, itm.type, itm.md5, id=itm.id, size=size)
                 else:
                     yield CloudFolder(path, id=itm.id)
                     
@@ -317,11 +601,30 @@ class VdiskStorage(Storage):
         fid = self._get_cloud_file_id(cloud_path)
         return self.client.share_file(fid).download_page
     
+    def get_change_token(self, probe=True):
+        '''
+        Vdisk returns the dologid with each response, 
+        which changes once the files of the account change.
+        '''
+        
+        if probe:
+            self.client.keep()
+        return self.client.dologid
+    
 class S3Storage(Storage):
-    def __init__(self, client, holder_name):
+    # Multi-Object Delete accepts 1000 keys in one request.
+    delete_batch_size = MAX_DELETE_OBJECTS
+    conditional = True
+    ranged = True
+    
+    def __init__(self, client, holder_name, prefetch=DEFAULT_PREFETCH_PAGES, connections=1):
         '''
         :param client: must be S3Client or it's subclass, CryptoS3Client eg.
         :param holder_name: the folder that holder the content.
+        :param prefetch(optional): the number of listing pages to fetch ahead in background, 
+                                   set to 0 to fetch pages synchronously.
+        :param connections(optional): the number of concurrent requests used by 
+                                      a recursive listing, 1 means listing sequentially.
         
         In Amazon S3, you can only store files into a bucket,
         which means the holder here.
@@ -332,6 +635,8 @@ class S3Storage(Storage):
         
         self.client = client
         self.holder = holder_name
+        self.prefetch = prefetch
+        self.connections = connections
         
         self._ensure_holder_exist(self.holder)
         
@@ -357,17 +662,51 @@ class S3Storage(Storage):
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         self.client.upload_file(filename, self.holder, cloud_path)
     
-    def download(self, cloud_path, filename):
+    def download(self, cloud_path, filename, md5=None):
         '''
         Download the file to local from cloud.
         
         :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
         :param filename: the local file's absolute path.
+        :param md5(optional): the md5 of the local file, 
+                              if the same as the ETag on the cloud, the content will not be transfered.
+        
+        :return: True if the file is downloaded, False if the local file is the same.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        if isinstance(cloud_path, unicode): cloud_path = cloud_path.encode('utf-8')
+        return self.client.download_file(filename, self.holder, cloud_path, if_none_match=md5)
+    
+    def upload_raw(self, cloud_path, filename):
+        '''
+        Upload local file to the cloud without the encryption of the client.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param filename: the local file's absolute path.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        self.client.upload_file(filename, self.holder, cloud_path, encrypt=False)
+        
+    def download_range(self, cloud_path, offset, length):
         '''
+        Read a range of a file on the cloud by a ranged GET, 
+        without the decryption of the client.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param offset: the first byte of the range.
+        :param length: the length of the range.
+        '''
+        
+        if length <= 0:
+            return ''
         
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         if isinstance(cloud_path, unicode): cloud_path = cloud_path.encode('utf-8')
-        self.client.download_file(filename, self.holder, cloud_path)
+        obj = self.client.get_object(self.holder, cloud_path, 
+                                     byte_range=(offset, offset+length-1))
+        return obj.data
         
     def delete(self, cloud_path):
         '''
@@ -378,15 +717,121 @@ class S3Storage(Storage):
         
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         
-        self.client.delete_object(self.holder, cloud_path)
-        for obj in self.list_files(cloud_path, recursive=True):
-            self.client.delete_object(self.holder, obj.path)
+        def _get_paths():
+            yield cloud_path
+            for obj in self.list_files(cloud_path, recursive=True):
+                yield obj.path
+                
+        # the paths are deleted in batches, the first error is raised if any fails.
+        _, failed = self.delete_files(_get_paths())
+        if failed:
+            raise failed[0][1]
+    
+    def _delete_batch(self, cloud_paths):
+        keys = []
+        for cloud_path in cloud_paths:
+            key = self._ensure_cloud_path_legal(cloud_path)
+            if isinstance(key, unicode): key = key.encode('utf-8')
+            keys.append(key)
+        
+        _, errors = self.client.delete_objects(self.holder, keys)
+        
+        failed = {}
+        for key, code, msg in errors:
+            if isinstance(key, unicode): key = key.encode('utf-8')
+            error = S3Error(-1, msg='%s, %s' % (code, msg))
+            error.code = code
+            failed[key] = error
+        
+        deleted = [p for p, key in zip(cloud_paths, keys) if key not in failed]
+        failed = [(p, failed[key]) for p, key in zip(cloud_paths, keys) if key in failed]
+        return deleted, failed
+            
+    def _get_next_marker(self, last_key, common_prefix):
+        keys = [last_key] if last_key else []
+        if common_prefix:
+            keys.append(common_prefix[-1])
+        if keys:
+            return max(keys)
+    
+    def copy(self, src_cloud_path, cloud_path):
+        '''
+        Copy the file in the cloud, the content is not transfered by the client.
+        
+        :param src_cloud_path: the path of the source file on the cloud, 'test/file.txt' eg.
+        :param cloud_path: the path of the new file on the cloud.
+        '''
+        
+        src_cloud_path = self._ensure_cloud_path_legal(src_cloud_path)
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        self.client.copy_object(self.holder, src_cloud_path, self.holder, cloud_path)
+        
+    def move(self, src_cloud_path, cloud_path):
+        '''
+        Move the file in the cloud, the content is not transfered by the client.
+        
+        :param src_cloud_path: the path of the source file on the cloud, 'test/file.txt' eg.
+        :param cloud_path: the new path on the cloud.
+        '''
+        
+        src_cloud_path = self._ensure_cloud_path_legal(src_cloud_path)
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        self.client.move_object(self.holder, src_cloud_path, self.holder, cloud_path)
+    
+    def _iter_bucket(self, prefetch=None, **kwargs):
+        '''
+        Iterate the pages of the holder's listing, each page is a tuple of
+        (objects, common prefixes).
+        
+        While the caller handles the current page, the next pages are
+        requested in a background thread, at most `self.prefetch` pages ahead.
+        If prefetch is disabled, each page is streamed instead:
+        the objects are yielded while the response is parsed,
+        and the common prefixes are complete after the objects are iterated.
+        
+        :param prefetch(optional): the pages fetched ahead instead of `self.prefetch`.
+        '''
+        
+        prefetch = self.prefetch if prefetch is None else prefetch
+        if prefetch < 1:
+            return self._stream_bucket(**kwargs)
+        
+        def _fetch(marker):
+            if marker is not None:
+                kwargs['marker'] = marker
+            objs, common_prefix, has_next = self.client.get_bucket(self.holder, **kwargs)
+            
+            next_marker = None
+            if has_next:
+                # the next marker is known as soon as the page is parsed.
+                last_key = objs[-1].key if objs else None
+                next_marker = self._get_next_marker(last_key, common_prefix)
+            return (objs, common_prefix), next_marker
+        
+        return ReadAheadIterator(_fetch, depth=prefetch)
+    
+    def _stream_bucket(self, **kwargs):
+        while True:
+            listing = self.client.iter_bucket(self.holder, **kwargs)
+            yield listing, listing.common_prefix
+            
+            if not listing.has_next:
+                return
+            marker = self._get_next_marker(listing.last_key, listing.common_prefix)
+            if marker is None:
+                return
+            kwargs['marker'] = marker
             
     def _get_cloud_file(self, s3_obj):
         content_type = getattr(s3_obj, 'content_type', '')
         md5 = s3_obj.etag.strip('"')
+        size = getattr(s3_obj, 'size', None)
+        if size is not None:
+            size = int(size)
         
-        return CloudFile(s3_obj.key, content_type, md5)
+        return CloudFile(s3_obj.key, content_type, md5, size=size)
     
     def list(self, cloud_path, recursive=False):
         '''
@@ -407,21 +852,11 @@ class S3Storage(Storage):
         if isinstance(cloud_path, unicode): cloud_path = cloud_path.encode('utf-8')
         prefix = '' if not cloud_path else cloud_path+'/'
         
-        objs, common_prefix, has_next = self.client.get_bucket(self.holder,
-                                                               prefix=prefix,
-                                                               delimiter='/')
-        
-        for obj in objs:
-            yield self._get_cloud_file(obj)
-            
-        while has_next:
-            marker = objs[-1].key
-            objs, common_prefix, has_next = self.client.get_bucket(self.holder,
-                                                                   prefix=prefix,
-                                                                   delimiter='/',
-                                                                   marker=marker)
+        common_prefix = []
+        for objs, prefixes in self._iter_bucket(prefix=prefix, delimiter='/'):
             for obj in objs:
                 yield self._get_cloud_file(obj)
+            common_prefix.extend(prefixes)
                 
         for prefix in common_prefix:
             yield CloudFolder(self._ensure_cloud_path_legal(prefix))
@@ -449,22 +884,109 @@ class S3Storage(Storage):
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         prefix = '' if not cloud_path else cloud_path+'/'
         
+        if recursive and self.connections > 1:
+            for obj in self.list_files_parallel(cloud_path):
+                yield obj
+            return
+        
         kwargs = {'prefix': prefix}
         if not recursive:
             kwargs['delimiter'] = '/'
         
-        objs, _, has_next = self.client.get_bucket(self.holder, **kwargs)
-        
-        for obj in objs:
-            yield self._get_cloud_file(obj)
-            
-        while has_next:
-            marker = objs[-1].key
-            kwargs['marker'] = marker
-            objs, _, has_next = self.client.get_bucket(self.holder, **kwargs)
+        for objs, _ in self._iter_bucket(**kwargs):
             for obj in objs:
                 yield self._get_cloud_file(obj)
     
+    def _list_level(self, prefix):
+        objs, common_prefix = [], []
+        for page_objs, prefixes in self._iter_bucket(prefix=prefix, delimiter='/'):
+            objs.extend(page_objs)
+            common_prefix.extend(prefixes)
+        return objs, common_prefix
+    
+    def _iter_shards(self, shards):
+        '''
+        Iterate the objects of the shards by the order of the key,
+        while one shard is iterated, the next ones are listed in background,
+        `self.connections` shards at most.
+        '''
+        
+        # the shards are the folders of the same level, 
+        # so each is a range of the keys, and they don't overlap.
+        shards = iter(sorted(shards))
+        started = deque()
+        try:
+            while True:
+                for prefix in shards:
+                    pages = self._iter_bucket(prefetch=max(self.prefetch, 1), prefix=prefix)
+                    started.append(pages.start())
+                    if len(started) >= self.connections:
+                        break
+                if not started:
+                    return
+                
+                for objs, _ in started.popleft():
+                    for obj in objs:
+                        yield obj
+        finally:
+            for pages in started:
+                pages.stop()
+    
+    def _discover_shards(self, pool, prefix, depth):
+        '''
+        Split the key space under the prefix by the common prefixes,
+        descend level by level until there are enough shards for the connections.
+        
+        :return 0: the objects found in the levels listed, sorted by the key.
+        :return 1: the prefixes of the shards, which are disjoint to each other.
+        '''
+        
+        objs = []
+        shards = [prefix]
+        for _ in range(depth):
+            if not shards or len(shards) >= self.connections:
+                break
+            
+            next_shards = []
+            for level_objs, prefixes in pool.map(self._list_level, shards):
+                objs.extend(level_objs)
+                next_shards.extend(prefixes)
+            shards = next_shards
+            
+        objs.sort(key=lambda obj: obj.key)
+        return objs, shards
+    
+    def list_files_parallel(self, cloud_path, depth=DEFAULT_SHARD_DEPTH):
+        '''
+        List all the files in a cloud path recursively with concurrent requests.
+        
+        :param cloud_path: the path on the cloud, 'test' eg, not need to start with '/'
+                           list the root path if set to blank('').
+        :param depth(optional): the max levels of folders to descend to find the shards.
+        
+        The key space is split into shards by the common prefixes(folders),
+        the shards are listed with `self.connections` concurrent requests,
+        and the results are merged back into the order of the key,
+        the same as the sequential listing.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        if isinstance(cloud_path, unicode): cloud_path = cloud_path.encode('utf-8')
+        prefix = '' if not cloud_path else cloud_path+'/'
+        
+        pool = ThreadPool(max(self.connections, 1))
+        try:
+            objs, shards = self._discover_shards(pool, prefix, depth)
+        finally:
+            pool.close()
+            pool.join()
+        
+        # both are sorted, and the keys are unique.
+        streams = [((obj.key, obj) for obj in objs), 
+                   ((obj.key, obj) for obj in self._iter_shards(shards))]
+        for _, obj in heapq.merge(*streams):
+            yield self._get_cloud_file(obj)
+    
     def info(self, cloud_path):
         '''
         Get the infomation of a file on the cloud.
@@ -476,7 +998,7 @@ class S3Storage(Storage):
         
         cloud_path = self._ensure_cloud_path_legal(cloud_path)
         
-        s3_obj = self.client.get_object(self.holder, cloud_path)
+        s3_obj = self.client.head_object(self.holder, cloud_path)
         
         kwargs = {}
         for attr in dir(s3_obj):
@@ -491,6 +1013,22 @@ class S3Storage(Storage):
         
         return CloudFile(**kwargs)
     
+    def head(self, cloud_path):
+        '''
+        Get the infomation of a file on the cloud by a HEAD request.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'.
+        
+        :return: an instance of CloudFile, None if the file doesn't exist.
+        '''
+        
+        try:
+            return self.info(cloud_path)
+        except S3Error, e:
+            if e.err_no == 404:
+                return
+            raise e
+    
     def share(self, cloud_path):
         '''
         Share a file on the cloud.
@@ -515,10 +1053,21 @@ class S3Storage(Storage):
         return s3_get_end_point(self.holder, cloud_path, True)
         
 class GSStorage(S3Storage):
-    def __init__(self, client, holder_name):
+    # Google Cloud Storage doesn't support deleting multiple objects by one request,
+    # so each object is deleted by a request, and the requests are sent concurrently.
+    delete_batch_size = 1
+    
+    def __init__(self, client, holder_name, prefetch=DEFAULT_PREFETCH_PAGES, connections=1,
+                 resumable_threshold=DEFAULT_RESUMABLE_THRESHOLD):
         '''
         :param client: must be S3Client or it's subclass, CryptoS3Client eg.
         :param holder_name: the folder that holder the content.
+        :param prefetch(optional): the number of listing pages to fetch ahead in background, 
+                                   set to 0 to fetch pages synchronously.
+        :param connections(optional): the number of concurrent requests used by 
+                                      a recursive listing, 1 means listing sequentially.
+        :param resumable_threshold(optional): the files not smaller than it are uploaded
+                                              by the resumable protocol, None means never.
         
         In Amazon S3, you can only store files into a bucket,
         which means the holder here.
@@ -529,6 +1078,13 @@ class GSStorage(S3Storage):
         
         self.client = client
         self.holder = holder_name
+        self.prefetch = prefetch
+        self.connections = connections
+        
+        self.resumable_threshold = resumable_threshold
+        self.sessions = None
+        if resumable_threshold is not None:
+            self.sessions = UploadSessions('gs.%s' % holder_name.replace('/', '_'))
         
         self._ensure_holder_exist(self.holder)
         
@@ -538,6 +1094,44 @@ class GSStorage(S3Storage):
                 return
             
         self.client.put_bucket(holder_name)
+        
+    def upload(self, cloud_path, filename):
+        '''
+        Upload a file from local to cloud, 
+        the large file is uploaded by chunks, and continues from the last chunk if interrupted.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param filename: the local file's absolute path.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        self.client.upload_file(filename, self.holder, cloud_path, 
+                                resumable_threshold=self.resumable_threshold, 
+                                sessions=self.sessions)
+        
+    def abort_upload(self, cloud_path):
+        '''
+        Give up the resumable session of a file, the session expires on the server later.
+        '''
+        
+        if self.sessions is None:
+            return
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        self.sessions.pop('%s/%s' % (self.holder, cloud_path), None)
+        
+    def _delete_batch(self, cloud_paths):
+        deleted, failed = [], []
+        for cloud_path in cloud_paths:
+            key = self._ensure_cloud_path_legal(cloud_path)
+            if isinstance(key, unicode): key = key.encode('utf-8')
+            try:
+                self.client.delete_object(self.holder, key)
+                deleted.append(cloud_path)
+            except CloudBackupLibError, e:
+                failed.append((cloud_path, e))
+        return deleted, failed
     
     def share(self, cloud_path):
         '''
@@ -559,4 +1153,351 @@ class GSStorage(S3Storage):
         grant = GSAclGrantByAllUsers(GS_ACL_PERMISSION.read)
         self.client.put_object(self.holder, cloud_path, owner=owner, grants=(grant, ))
         
-        return gs_get_end_point(self.holder, cloud_path, True)
\ No newline at end of file
+        return gs_get_end_point(self.holder, cloud_path, True)
+        
+class StripedStorage(Storage):
+    '''
+    Split each file into data shards and parity shards by Reed-Solomon,
+    and place the shards on different storages.
+    A file survives losing as many storages as the parity shards,
+    while the bytes uploaded are (data + parity) / data of the file,
+    1.5 times by 2 + 1, instead of 3 times by copying to three storages.
+    
+    The shards are read from all the storages at the same time,
+    and the file is rebuilt from the fastest ones.
+    
+    The order of the storages decides where the shards are placed,
+    so it should stay the same.
+    
+    Usage:
+    storage = StripedStorage([vdisk_storage, s3_storage, gs_storage], 2, 1)
+    handler = SyncHandler(storage, '/local_folder')
+    '''
+    
+    conditional = True
+    
+    def __init__(self, storages, data_shards=DEFAULT_DATA_SHARDS, 
+                 parity_shards=DEFAULT_PARITY_SHARDS, min_shards=None):
+        '''
+        :param storages: list of the instances of Storage or its subclass.
+        :param data_shards(optional): the number of the data shards of each file.
+        :param parity_shards(optional): the number of the parity shards of each file.
+        :param min_shards(optional): an upload fails if fewer shards are stored,
+                                     all the shards as default.
+        '''
+        
+        assert len(storages) > 0
+        
+        self.storages = list(storages)
+        self.codec = ReedSolomon(data_shards, parity_shards)
+        self.data_shards = data_shards
+        self.total_shards = self.codec.total_shards
+        self.min_shards = max(min_shards or self.total_shards, data_shards)
+        
+        # the shards are encrypted by the clients of the storages if they encrypt.
+        self.client = None
+        self.holder = '+'.join(getattr(storage, 'holder', '') or '' 
+                               for storage in self.storages)
+        
+    def _get_shard_path(self, cloud_path, md5, stamp, index):
+        return '%s.%s.%d.%d%s' % (cloud_path, md5, stamp, index, SHARD_SUFFIX)
+    
+    def _get_storage(self, cloud_path, index):
+        key = cloud_path.encode('utf-8') if isinstance(cloud_path, unicode) else cloud_path
+        # the shards of the files start from different storages, to spread the load.
+        start = zlib.crc32(key) & 0xffffffff
+        return self.storages[(start + index) % len(self.storages)]
+    
+    def _map(self, func, items):
+        '''
+        Call the func with each item concurrently.
+        
+        :return: list of (item, result, error).
+        '''
+        
+        def _call(item):
+            try:
+                return item, func(item), None
+            except Exception, e:
+                return item, None, e
+        
+        items = list(items)
+        if not items:
+            return []
+        pool = ThreadPool(len(items))
+        try:
+            return pool.map(_call, items)
+        finally:
+            pool.close()
+            pool.join()
+    
+    def _list_shards(self, cloud_path, recursive, match=None):
+        '''
+        :return 0: dict of the path of the file, (the time uploaded, the md5) and the shards,
+                   the shards are dict of the index and (the storage, the shard path).
+        :return 1: the folders on any storage.
+        '''
+        
+        def _list(storage):
+            return list(storage.list(cloud_path, recursive))
+        
+        files, folders = {}, {}
+        results = self._map(_list, self.storages)
+        errors = [error for _, _, error in results if error is not None]
+        if len(errors) == len(results):
+            raise errors[0]
+        
+        for storage, objs, error in results:
+            if error is not None:
+                continue
+            for obj in objs:
+                if isinstance(obj, CloudFolder):
+                    folders.setdefault(obj.path, obj)
+                    continue
+                
+                matched = shard_pattern.match(obj.path)
+                if matched is None:
+                    continue
+                path, md5 = matched.group(1), matched.group(2)
+                stamp, index = int(matched.group(3) or 0), int(matched.group(4))
+                if match is not None and path != match:
+                    continue
+                shards = files.setdefault(path, {}).setdefault((stamp, md5), {})
+                shards[index] = (storage, obj.path)
+        return files, folders.values()
+    
+    def _pick(self, versions):
+        '''
+        :param versions: dict of (the time uploaded, the md5) and the shards.
+        
+        :return: (md5, shards) of the latest version which can be rebuilt, None if none can.
+        '''
+        
+        candidates = [(stamp, len(shards), md5, shards) 
+                      for (stamp, md5), shards in versions.iteritems()
+                      if len(shards) >= self.data_shards]
+        if not candidates:
+            return
+        _, _, md5, shards = max(candidates)
+        return md5, shards
+    
+    def _find(self, cloud_path):
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        dirname = cloud_path.rsplit('/', 1)[0] if '/' in cloud_path else ''
+        try:
+            files, _ = self._list_shards(dirname, False, match=cloud_path)
+        except CloudBackupLibError:
+            # the folder doesn't exist on any storage.
+            return
+        return self._pick(files.get(cloud_path, {}))
+    
+    def upload(self, cloud_path, filename):
+        '''
+        Split the local file into shards, and upload them to the storages concurrently.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param filename: the local file's absolute path.
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        
+        fp = open(filename, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        md5 = hashlib.md5(data).hexdigest()
+        stamp = int(time.time() * 1000)
+        shards = self.codec.encode(data)
+        
+        def _upload(index):
+            fd, tmp = tempfile.mkstemp()
+            try:
+                try:
+                    os.write(fd, SHARD_HEADER.pack(self.data_shards, self.codec.parity_shards,
+                                                   index, len(data)))
+                    os.write(fd, shards[index])
+                finally:
+                    os.close(fd)
+                storage = self._get_storage(cloud_path, index)
+                storage.upload(self._get_shard_path(cloud_path, md5, stamp, index), tmp)
+            finally:
+                os.remove(tmp)
+        
+        results = self._map(_upload, range(self.total_shards))
+        errors = [error for _, _, error in results if error is not None]
+        if self.total_shards - len(errors) < self.min_shards:
+            raise errors[0]
+        
+        self._discard_versions(cloud_path, (stamp, md5))
+        
+    def _discard_versions(self, cloud_path, kept):
+        '''
+        Delete the shards of the other versions of a file, 
+        the ones of the same content uploaded before included.
+        
+        :param kept: (the time uploaded, the md5) of the version kept.
+        '''
+        
+        dirname = cloud_path.rsplit('/', 1)[0] if '/' in cloud_path else ''
+        try:
+            files, _ = self._list_shards(dirname, False, match=cloud_path)
+        except CloudBackupLibError:
+            return
+        
+        targets = [target for version, shards in files.get(cloud_path, {}).iteritems()
+                   if version != kept for target in shards.itervalues()]
+        # the latest version is picked anyway, the ones failed are left till the next upload.
+        self._map(lambda target: target[0].delete(target[1]), targets)
+    
+    def _fetch(self, shards):
+        '''
+        Download the shards concurrently, and rebuild the file by the fastest ones.
+        
+        :param shards: dict of the index and (the storage, the shard path).
+        '''
+        
+        results = Queue()
+        
+        def _download(index, storage, shard_path):
+            fd, tmp = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                storage.download(shard_path, tmp)
+                fp = open(tmp, 'rb')
+                try:
+                    content = fp.read()
+                finally:
+                    fp.close()
+                _, _, _, size = SHARD_HEADER.unpack(content[:SHARD_HEADER.size])
+                results.put((index, content[SHARD_HEADER.size:], size, None))
+            except Exception, e:
+                results.put((index, None, None, e))
+            finally:
+                os.remove(tmp)
+        
+        for index, (storage, shard_path) in shards.iteritems():
+            thread = threading.Thread(target=_download, args=(index, storage, shard_path))
+            thread.setDaemon(True)
+            thread.start()
+        
+        received, size, error = {}, None, None
+        for _ in range(len(shards)):
+            index, content, shard_size, e = results.get()
+            if e is not None:
+                error = e
+                continue
+            received[index] = content
+            size = shard_size
+            # the slow ones are left behind.
+            if len(received) >= self.data_shards:
+                return self.codec.decode(received, size)
+        
+        raise error or CloudBackupLibError('striped', -1, 'Not enough shards.')
+    
+    def download(self, cloud_path, filename, md5=None):
+        '''
+        Download the shards and rebuild the file.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        :param filename: the local file's absolute path.
+        :param md5(optional): the md5 of the local file, 
+                              if the same as the cloud one, the shards will not be transfered.
+        
+        :return: True if the file is downloaded, False if the local file is the same.
+        '''
+        
+        found = self._find(cloud_path)
+        if found is None:
+            raise CloudBackupLibError('striped', 404, 
+                                      'Not enough shards of %s.' % cloud_path)
+        file_md5, shards = found
+        if md5 is not None and md5 == file_md5:
+            return False
+        
+        data = self._fetch(shards)
+        if hashlib.md5(data).hexdigest() != file_md5:
+            raise CloudBackupLibError('striped', -1, 
+                                      'The content of %s is broken.' % cloud_path)
+        
+        fp = open(filename, 'wb')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+        return True
+        
+    def delete(self, cloud_path):
+        '''
+        Delete the shards of a file, or the folder on each storage.
+        
+        :param cloud_path: the path on the cloud, 'test/file.txt' eg, not need to start with '/'
+        '''
+        
+        cloud_path = self._ensure_cloud_path_legal(cloud_path)
+        dirname = cloud_path.rsplit('/', 1)[0] if '/' in cloud_path else ''
+        files, _ = self._list_shards(dirname, False, match=cloud_path)
+        
+        if cloud_path in files:
+            targets = [target for shards in files[cloud_path].itervalues() 
+                       for target in shards.itervalues()]
+            for storage, shard_path in targets:
+                storage.delete(shard_path)
+            return
+        
+        results = self._map(lambda storage: storage.delete(cloud_path), self.storages)
+        errors = [error for _, _, error in results if error is not None]
+        if len(errors) == len(results):
+            raise errors[0]
+        
+    def list(self, cloud_path, recursive=False):
+        '''
+        List the folders and the files can be rebuilt in a cloud path.
+        
+        :param cloud_path: the path on the cloud, 'test' eg, not need to start with '/'
+                           list the root path if set to blank('').
+        :param recursive(Optional): if set to True, will return the objects recursively.
+        '''
+        
+        files, folders = self._list_shards(cloud_path, recursive)
+        for folder in sorted(folders, key=lambda folder: folder.path):
+            yield folder
+        for cloud_file in self._iter_files(files):
+            yield cloud_file
+        
+    def _iter_files(self, files):
+        for path in sorted(files):
+            found = self._pick(files[path])
+            if found is not None:
+                yield CloudFile(path, '', found[0], shards=len(found[1]))
+        
+    def list_files(self, cloud_path, recursive=False):
+        '''
+        List the files can be rebuilt in a cloud path.
+        
+        :param cloud_path: the path on the cloud, 'test' eg, not need to start with '/'
+                           list the root path if set to blank('').
+        :param recursive(Optional): if set to True, will return the files recursively.
+        '''
+        
+        files, _ = self._list_shards(cloud_path, recursive)
+        return self._iter_files(files)
+        
+    def info(self, cloud_path):
+        cloud_file = self.head(cloud_path)
+        if cloud_file is None:
+            raise CloudBackupLibError('striped', 404, 
+                                      'Not enough shards of %s.' % cloud_path)
+        return cloud_file
+        
+    def head(self, cloud_path):
+        '''
+        :return: an instance of CloudFile, None if the file can't be rebuilt.
+        '''
+        
+        found = self._find(cloud_path)
+        if found is None:
+            return
+        md5, shards = found
+        return CloudFile(self._ensure_cloud_path_legal(cloud_path), '', md5, 
+                         shards=len(shards))
@@ -33,8 +33,14 @@ from CloudBackup.lib.s3 import S3Client, CryptoS3Client
 from CloudBackup.lib.gs import GSClient, CryptoGSClient
 from CloudBackup.lib.errors import VdiskError, S3Error, GSError
 from CloudBackup.lib.crypto import DES
-from CloudBackup.cloud import VdiskStorage, S3Storage, GSStorage
-from CloudBackup.local import SyncHandler, S3SyncHandler, VdiskRefreshToken
+from CloudBackup.lib.bandwidth import (BandwidthManager, BandwidthSchedule, 
+                                       set_bandwidth_manager)
+from CloudBackup.cloud import (VdiskStorage, S3Storage, GSStorage, StripedStorage,
+                               DEFAULT_DATA_SHARDS, DEFAULT_PARITY_SHARDS, 
+                               DEFAULT_LIST_CONNECTIONS)
+from CloudBackup.local import SyncHandler, S3SyncHandler, SyncOrchestrator, VdiskRefreshToken
+from CloudBackup.restore import BulkRestore, DEFAULT_RESTORE_WORKERS
+from CloudBackup.ignore import set_ignore_settings, get_ignore_rules
 from CloudBackup.errors import CloudBackupError
 from CloudBackup.utils import win_hide_file, get_info_path, ensure_folder_exsits
 from CloudBackup.test.settings import VDISK_APP_KEY, VDISK_APP_SECRET
@@ -102,6 +108,15 @@ class Environment(object):
     gs_handler = None
     gs_lock = threading.Lock()
     
+    stripes_handler = None
+    stripes_lock = threading.Lock()
+    
+    bandwidth_manager = None
+    
+    # the handlers of the same local folder share an orchestrator, which scans once each cycle.
+    orchestrators = {}
+    orchestrators_lock = threading.Lock()
+    
     def __new__(cls, *args, **kwargs):
         if not cls.instance:
             cls.instance = super(Environment, cls).__new__(
@@ -123,6 +138,33 @@ class Environment(object):
         des = DES(iv)
         return des.decrypt
     
+    def _start_handler(self, handler):
+        self.orchestrators_lock.acquire()
+        try:
+            orchestrator = self.orchestrators.get(handler.folder_name)
+            if orchestrator is None:
+                orchestrator = SyncOrchestrator(handler.folder_name, sec=DEFAULT_SLEEP_SECS)
+                orchestrator.setDaemon(True)
+                orchestrator.add(handler)
+                orchestrator.start()
+                self.orchestrators[handler.folder_name] = orchestrator
+            else:
+                orchestrator.add(handler)
+        finally:
+            self.orchestrators_lock.release()
+            
+    def _stop_handler(self, handler):
+        handler.stop()
+        
+        self.orchestrators_lock.acquire()
+        try:
+            orchestrator = self.orchestrators.get(handler.folder_name)
+            if orchestrator is not None and orchestrator.remove(handler) == 0:
+                orchestrator.stop()
+                del self.orchestrators[handler.folder_name]
+        finally:
+            self.orchestrators_lock.release()
+    
     def setup_vdisk(self, account, password, local_folder, holder, is_weibo=False, 
                     log=True, encrypt=False, encrypt_code=None, force_stop=True):
         try:
@@ -132,7 +174,7 @@ class Environment(object):
                 return self.vdisk_handler
             
             if force_stop and self.vdisk_handler:
-                self.vdisk_handler.stop()
+                self._stop_handler(self.vdisk_handler)
             
             if encrypt and encrypt_code:
                 client = CryptoVdiskClient(VDISK_APP_KEY, VDISK_APP_SECRET)
@@ -148,8 +190,7 @@ class Environment(object):
             
             try:
                 handler = SyncHandler(storage, local_folder, sec=DEFAULT_SLEEP_SECS, log=log)
-                handler.setDaemon(True)
-                handler.start()
+                self._start_handler(handler)
                 self.vdisk_handler = handler
                 
                 self.save_vdisk_info(account, password, local_folder, holder,
@@ -167,7 +208,7 @@ class Environment(object):
             if self.vdisk_handler is None:
                 return
             
-            self.vdisk_handler.stop()
+            self._stop_handler(self.vdisk_handler)
             self.vdisk_handler = None
             self.vdisk_token_refresh.stop()
             self.vdisk_token_refresh = None
@@ -202,7 +243,8 @@ class Environment(object):
             os.remove(save_file)
         
     def setup_s3(self, access_key, secret_access_key, local_folder, holder,
-                 log=True, encrypt=False, encrypt_code=None, force_stop=True):
+                 log=True, encrypt=False, encrypt_code=None, force_stop=True, 
+                 list_connections=DEFAULT_LIST_CONNECTIONS):
         try:
             self.s3_lock.acquire()
         
@@ -210,19 +252,18 @@ class Environment(object):
                 return self.s3_handler
             
             if force_stop and self.s3_handler:
-                self.s3_handler.stop()
+                self._stop_handler(self.s3_handler)
             
             if encrypt and encrypt_code:
                 client = CryptoS3Client(access_key, secret_access_key, encrypt_code)
             else:
                 client = S3Client(access_key, secret_access_key)
                 
-            storage = S3Storage(client, holder)
+            storage = S3Storage(client, holder, connections=list_connections)
             
             try:
                 handler = S3SyncHandler(storage, local_folder, sec=DEFAULT_SLEEP_SECS, log=log)
-                handler.setDaemon(True)
-                handler.start()
+                self._start_handler(handler)
                 self.s3_handler = handler
                 
                 self.save_s3_info(access_key, secret_access_key, local_folder, holder, 
@@ -241,7 +282,7 @@ class Environment(object):
             if self.s3_handler is None:
                 return
             
-            self.s3_handler.stop()
+            self._stop_handler(self.s3_handler)
             self.s3_handler = None
             
             if clear_info:
@@ -271,7 +312,8 @@ class Environment(object):
             os.remove(save_file)
         
     def setup_gs(self, access_key, secret_access_key, project_id, local_folder, holder,
-                 log=True, encrypt=False, encrypt_code=None, force_stop=True):
+                 log=True, encrypt=False, encrypt_code=None, force_stop=True, 
+                 list_connections=DEFAULT_LIST_CONNECTIONS):
         try:
             self.gs_lock.acquire()
         
@@ -279,19 +321,18 @@ class Environment(object):
                 return self.gs_handler
             
             if force_stop and self.gs_handler:
-                self.gs_handler.stop()
+                self._stop_handler(self.gs_handler)
             
             if encrypt and encrypt_code:
                 client = CryptoGSClient(access_key, secret_access_key, project_id, encrypt_code)
             else:
                 client = GSClient(access_key, secret_access_key, project_id)
                 
-            storage = GSStorage(client, holder)
+            storage = GSStorage(client, holder, connections=list_connections)
             
             try:
                 handler = SyncHandler(storage, local_folder, sec=DEFAULT_SLEEP_SECS, log=log)
-                handler.setDaemon(True)
-                handler.start()
+                self._start_handler(handler)
                 self.gs_handler = handler
                 
                 self.save_gs_info(access_key, secret_access_key, project_id, 
@@ -310,7 +351,7 @@ class Environment(object):
             if self.gs_handler is None:
                 return
             
-            self.gs_handler.stop()
+            self._stop_handler(self.gs_handler)
             self.gs_handler = None
             
             if clear_info:
@@ -338,4 +379,154 @@ class Environment(object):
         save_file = get_settings_path(get_info_path(), 'gs')
         
         if os.path.exists(save_file):
-            os.remove(save_file)
\ No newline at end of file
+            os.remove(save_file)
+        
+    def setup_stripes(self, local_folder, data_shards=DEFAULT_DATA_SHARDS, 
+                      parity_shards=DEFAULT_PARITY_SHARDS, log=True):
+        '''
+        Stripe the files of a local folder across the clouds set up,
+        instead of copying the whole files to each of them.
+        The clouds stop syncing the folder by themselves.
+        
+        :param local_folder: the local folder to sync.
+        :param data_shards(optional): the number of the data shards of each file.
+        :param parity_shards(optional): the number of the parity shards of each file,
+                                        the clouds can be lost at most.
+        '''
+        
+        try:
+            self.stripes_lock.acquire()
+            
+            handlers = [handler for handler in (self.vdisk_handler, self.s3_handler, self.gs_handler)
+                        if handler is not None]
+            if not handlers:
+                raise CloudBackupError('striped', -1, 'No cloud is set up.')
+            
+            if self.stripes_handler is not None:
+                self._stop_handler(self.stripes_handler)
+                self.stripes_handler = None
+            for handler in handlers:
+                if handler.folder_name == local_folder:
+                    self._stop_handler(handler)
+            
+            storage = StripedStorage([handler.storage for handler in handlers], 
+                                     data_shards, parity_shards)
+            handler = SyncHandler(storage, local_folder, sec=DEFAULT_SLEEP_SECS, log=log)
+            self._start_handler(handler)
+            self.stripes_handler = handler
+            return handler
+        finally:
+            self.stripes_lock.release()
+            
+    def stop_stripes(self):
+        try:
+            self.stripes_lock.acquire()
+            
+            if self.stripes_handler is None:
+                return
+            
+            self._stop_handler(self.stripes_handler)
+            self.stripes_handler = None
+        finally:
+            self.stripes_lock.release()
+            
+    def restore(self, cloud, local_folder, workers=DEFAULT_RESTORE_WORKERS, verify=True):
+        '''
+        Restore all the files of a cloud set up to a local folder, a new one eg.
+        
+        :param cloud: 'vdisk', 's3' or 'gs'.
+        :param local_folder: the folder to restore to.
+        :param workers(optional): the files downloaded at the same time.
+        :param verify(optional): check the md5 of each file restored.
+        
+        :return: an instance of RestoreReport, 
+                 which is written to the local folder as well.
+        '''
+        
+        handler = getattr(self, '%s_handler' % cloud, None)
+        if handler is None:
+            raise CloudBackupError(cloud, -1, 'The cloud is not set up.')
+        
+        handler_cls = S3SyncHandler if isinstance(handler, S3SyncHandler) else SyncHandler
+        restore_handler = handler_cls(handler.storage, local_folder, loop=False, 
+                                      snapshot=False, journal=False)
+        return BulkRestore(restore_handler, workers, verify).run()
+        
+    def setup_bandwidth(self, upload_rate=None, download_rate=None, weights=None, 
+                        periods=None, save=True):
+        '''
+        Limit the bandwidth shared by vdisk, Amazon S3 and Google Cloud Storage.
+        
+        :param upload_rate(optional): the bytes per second, None means unlimited.
+        :param download_rate(optional): the bytes per second, None means unlimited.
+        :param weights(optional): dict of 'vdisk', 's3', 'gs' and the weight.
+        :param periods(optional): list of (start, end, upload_rate, download_rate), 
+                                  the time as 'HH:MM', the rates in the periods of each day.
+        '''
+        
+        schedule = None
+        if periods:
+            schedule = BandwidthSchedule.from_list(periods, upload_rate, download_rate)
+        
+        self.bandwidth_manager = BandwidthManager(upload_rate, download_rate, 
+                                                  weights, schedule)
+        set_bandwidth_manager(self.bandwidth_manager)
+        
+        if save:
+            self.save_bandwidth_info(upload_rate, download_rate, weights, periods)
+        return self.bandwidth_manager
+    
+    def save_bandwidth_info(self, upload_rate=None, download_rate=None, weights=None, 
+                            periods=None):
+        args = locals()
+        del args['self']
+        
+        save_info('bandwidth', args, lambda s: s)
+        
+    def load_bandwidth_info(self):
+        info = get_info('bandwidth', lambda s: s)
+        return info
+    
+    def load_bandwidth(self):
+        info = self.load_bandwidth_info()
+        if info is None:
+            return
+        return self.setup_bandwidth(save=False, **info)
+        
+    def setup_ignore(self, patterns=None, max_size=None, max_age=None, save=True):
+        '''
+        Set the files not synced of all the local folders, 
+        besides the .cbignore file in each folder.
+        
+        :param patterns(optional): list of the patterns of the gitignore syntax.
+        :param max_size(optional): the files larger than the bytes are ignored.
+        :param max_age(optional): the files not modified in the seconds are ignored.
+        '''
+        
+        set_ignore_settings(patterns, max_size, max_age)
+        
+        self.orchestrators_lock.acquire()
+        try:
+            for orchestrator in self.orchestrators.values():
+                orchestrator.scanner.rules = get_ignore_rules()
+        finally:
+            self.orchestrators_lock.release()
+        
+        if save:
+            self.save_ignore_info(patterns, max_size, max_age)
+    
+    def save_ignore_info(self, patterns=None, max_size=None, max_age=None):
+        args = locals()
+        del args['self']
+        
+        save_info('ignore', args, lambda s: s)
+        
+    def load_ignore_info(self):
+        info = get_info('ignore', lambda s: s)
+        return info
+    
+    def load_ignore(self):
+        info = self.load_ignore_info()
+        if info is None:
+            return
+        return self.setup_ignore(save=False, **info)
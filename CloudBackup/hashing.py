@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from CloudBackup.utils import calc_md5
+
+# the files read at the same time, hashlib releases the GIL on the large blocks.
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_READ_SIZE = 1024 * 1024
+
+def _advise(fd, advice):
+    # posix_fadvise is only in the python 3 and on the posix systems.
+    fadvise = getattr(os, 'posix_fadvise', None)
+    advice = getattr(os, advice, None)
+    if fadvise is None or advice is None:
+        return
+    try:
+        fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+def read_md5(filename, encrypt_func=None, read_size=DEFAULT_READ_SIZE):
+    '''
+    :param filename: the local file's absolute path.
+    :param encrypt_func(optional): the file is encrypted before hashed if set,
+                                   the whole content is read since it's encrypted at once.
+    :param read_size(optional): the bytes read each time.
+    
+    :return: (the md5, the bytes read), or (None, 0) if the file doesn't exist.
+    '''
+    
+    try:
+        fp = open(filename, 'rb')
+    except IOError:
+        return None, 0
+    
+    try:
+        # read ahead more, and don't keep the pages after read.
+        _advise(fp.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        if encrypt_func is not None:
+            content = fp.read()
+            return calc_md5(encrypt_func(content)), len(content)
+        
+        md5, size = hashlib.md5(), 0
+        while True:
+            data = fp.read(read_size)
+            if not data:
+                break
+            md5.update(data)
+            size += len(data)
+        return md5.hexdigest(), size
+    finally:
+        _advise(fp.fileno(), 'POSIX_FADV_DONTNEED')
+        fp.close()
+
+class FileHasher(object):
+    '''
+    Hash many files at the same time,
+    the readers are bounded by the workers in all, however many callers there are.
+    The smaller files go first, so that the more files are done earlier.
+    
+    Usage:
+    hasher = FileHasher(workers=8)
+    for filename, md5 in hasher.map(hasher.calc_md5, filenames, key=os.path.getsize):
+        ...
+    print hasher.get_stats()['throughput']
+    '''
+    
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, read_size=DEFAULT_READ_SIZE):
+        '''
+        :param workers(optional): the files read at the same time.
+        :param read_size(optional): the bytes read each time.
+        '''
+        
+        self.workers = max(workers, 1)
+        self.read_size = read_size
+        self.readers = threading.Semaphore(self.workers)
+        # the DES of pyDes keeps the state of CBC, so the content is encrypted one by one.
+        self.encrypt_lock = threading.Lock()
+        
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'secs': 0.0, 'throughput': 0.0}
+    
+    def _encrypt(self, encrypt_func, content):
+        self.encrypt_lock.acquire()
+        try:
+            return encrypt_func(content)
+        finally:
+            self.encrypt_lock.release()
+    
+    def calc_md5(self, filename, encrypt_func=None):
+        if encrypt_func is not None:
+            func = encrypt_func
+            encrypt_func = lambda content: self._encrypt(func, content)
+        
+        self.readers.acquire()
+        try:
+            start = time.time()
+            md5, size = read_md5(filename, encrypt_func, self.read_size)
+            secs = time.time() - start
+        finally:
+            self.readers.release()
+        
+        if md5 is not None:
+            self.lock.acquire()
+            try:
+                self.stats['files'] += 1
+                self.stats['bytes'] += size
+                self.stats['secs'] += secs
+            finally:
+                self.lock.release()
+        return md5
+    
+    def map(self, func, items, key=None):
+        '''
+        :param func: called with each item, hashes by calc_md5 mostly.
+        :param items: the items to hash.
+        :param key(optional): the size of an item, the smaller ones go first.
+        
+        :return: the list of (item, the result of func).
+        '''
+        
+        items = sorted(items, key=key) if key is not None else list(items)
+        if not items:
+            return []
+        
+        start = time.time()
+        bytes_before = self.stats['bytes']
+        if self.workers == 1 or len(items) == 1:
+            results = [(item, func(item)) for item in items]
+        else:
+            pool = ThreadPool(min(self.workers, len(items)))
+            try:
+                # one item each task, so they start by the order.
+                results = list(pool.imap(lambda item: (item, func(item)), items, 1))
+            finally:
+                pool.close()
+                pool.join()
+        
+        # the bytes per second of the latest batch, read by all the workers.
+        secs = time.time() - start
+        self.lock.acquire()
+        try:
+            if secs > 0:
+                self.stats['throughput'] = (self.stats['bytes'] - bytes_before) / secs
+        finally:
+            self.lock.release()
+        return results
+    
+    def get_stats(self):
+        '''
+        :return: dict of the files and bytes hashed, the seconds spent reading,
+                 and the bytes per second of the latest batch.
+        '''
+        
+        self.lock.acquire()
+        try:
+            return dict(self.stats)
+        finally:
+            self.lock.release()
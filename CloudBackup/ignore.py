@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import re
+import time
+
+# the file in a folder keeps the patterns of the folder, the same as .gitignore.
+IGNORE_FILE = '.cbignore'
+
+def translate(pattern):
+    '''
+    Translate a glob pattern to a regular expression,
+    '*' and '?' never match '/', and '**' matches any folders.
+    '''
+    
+    i, n, res = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i+3] == '**/':
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern[i:i+2] == '**':
+                res.append('.*')
+                i += 2
+                continue
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                res.append('\\[')
+            else:
+                body = pattern[i+1:j].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                res.append('[%s]' % body)
+                i = j + 1
+                continue
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pattern[i+1]))
+            i += 2
+            continue
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+class IgnorePattern(object):
+    def __init__(self, line):
+        '''
+        :param line: a line of the gitignore syntax,
+                     '!' negates, '/' at the end matches the folders only,
+                     a '/' else anchors the pattern to the folder of the ignore file.
+        '''
+        
+        self.line = line
+        self.negate = line.startswith('!')
+        if self.negate:
+            line = line[1:]
+        self.dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        
+        if '/' in line:
+            self.regex = '^%s$' % translate(line.lstrip('/'))
+        else:
+            self.regex = '^(?:.*/)?%s$' % translate(line)
+        self.matcher = re.compile(self.regex)
+    
+    def match(self, path, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        return self.matcher.match(path) is not None
+
+def parse_lines(lines):
+    patterns = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        # the trailing spaces are ignored unless escaped.
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        patterns.append(IgnorePattern(line))
+    return patterns
+
+class IgnoreScope(object):
+    '''
+    The patterns of a folder, the later ones take precedence.
+    Without a negation, the patterns are combined into one expression,
+    so a path is matched once.
+    '''
+    
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.ordered = any(pattern.negate for pattern in patterns)
+        
+        self.any_matcher = self.dir_matcher = None
+        if not self.ordered:
+            self.any_matcher = self._combine([p for p in patterns if not p.dir_only])
+            self.dir_matcher = self._combine([p for p in patterns if p.dir_only])
+    
+    def _combine(self, patterns):
+        if not patterns:
+            return
+        return re.compile('|'.join('(?:%s)' % pattern.regex for pattern in patterns))
+    
+    def match(self, path, is_dir):
+        '''
+        :return: True if ignored, False if included by a negation, None if not matched.
+        '''
+        
+        if not self.ordered:
+            if self.any_matcher is not None and self.any_matcher.match(path):
+                return True
+            if is_dir and self.dir_matcher is not None and self.dir_matcher.match(path):
+                return True
+            return
+        
+        for pattern in reversed(self.patterns):
+            if pattern.match(path, is_dir):
+                return not pattern.negate
+
+class IgnoreRules(object):
+    '''
+    Decide which local files are not synced.
+    
+    The global patterns apply to the whole folder,
+    the patterns of the ignore file in a folder apply to the paths under it,
+    and the deeper ones take precedence, the same as git.
+    The hidden files, the too large and the too old files are ignored as well.
+    
+    Usage:
+    rules = IgnoreRules(['*.pyc', 'build/', 'node_modules/'], max_size=100*1024*1024)
+    for dirpath, dirnames, filenames in os.walk(root):
+        rules.load_folder(rel_dir, dirpath)
+        dirnames[:] = [d for d in dirnames if not rules.is_ignored(join(rel_dir, d), True)]
+    '''
+    
+    def __init__(self, patterns=None, max_size=None, max_age=None, hidden=True,
+                 ignore_file=IGNORE_FILE):
+        '''
+        :param patterns(optional): the global patterns of the gitignore syntax.
+        :param max_size(optional): the files larger than the bytes are ignored.
+        :param max_age(optional): the files not modified in the seconds are ignored.
+        :param hidden(optional): if the files and folders start with '.' are ignored.
+        :param ignore_file(optional): the name of the ignore file in each folder.
+        '''
+        
+        self.patterns = list(patterns or [])
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hidden = hidden
+        self.ignore_file = ignore_file
+        
+        self.global_scope = IgnoreScope(parse_lines(self.patterns))
+        self.scopes = {}
+    
+    def reset(self):
+        '''
+        Forget the ignore files of the folders, called before each walk.
+        '''
+        
+        self.scopes = {}
+    
+    def load_folder(self, rel_dir, dirpath, filenames=None):
+        '''
+        Read the ignore file of a folder if it has.
+        
+        :param rel_dir: the relative path of the folder, '/' separated, '' for the root.
+        :param dirpath: the absolute path of the folder.
+        :param filenames(optional): the files in the folder, to save a stat if given.
+        '''
+        
+        if filenames is not None and self.ignore_file not in filenames:
+            return
+        filename = os.path.join(dirpath, self.ignore_file)
+        if not os.path.isfile(filename):
+            return
+        
+        fp = open(filename)
+        try:
+            patterns = parse_lines(fp.readlines())
+        finally:
+            fp.close()
+        if patterns:
+            self.scopes[rel_dir] = IgnoreScope(patterns)
+    
+    def _iter_scopes(self, path):
+        yield '', self.global_scope
+        if not self.scopes:
+            return
+        
+        parts = path.split('/')
+        for i in range(len(parts)):
+            scope_dir = '/'.join(parts[:i])
+            scope = self.scopes.get(scope_dir)
+            if scope is not None:
+                yield scope_dir, scope
+    
+    def is_ignored(self, path, is_dir=False, size=None, timestamp=None):
+        '''
+        :param path: the relative path, '/' separated.
+        :param is_dir(optional): if the path is a folder.
+        :param size(optional): the size of the file, for the size filter.
+        :param timestamp(optional): the mtime of the file, for the age filter.
+        '''
+        
+        name = path.rsplit('/', 1)[-1]
+        if self.hidden and name.startswith('.'):
+            return True
+        
+        if not is_dir:
+            if self.max_size is not None and size is not None and size > self.max_size:
+                return True
+            if self.max_age is not None and timestamp is not None and \
+                time.time() - timestamp > self.max_age:
+                return True
+        
+        ignored = False
+        for scope_dir, scope in self._iter_scopes(path):
+            rel_path = path[len(scope_dir)+1:] if scope_dir else path
+            matched = scope.match(rel_path, is_dir)
+            if matched is not None:
+                ignored = matched
+        return ignored
+    
+    def is_path_ignored(self, path, size=None, timestamp=None):
+        '''
+        Check a path and all its folders, the path of a cloud listing eg,
+        which isn't reached by a walk pruned.
+        
+        :param size(optional): the size of the file, for the size filter.
+        :param timestamp(optional): the mtime of the file, for the age filter.
+        '''
+        
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            if self.is_ignored('/'.join(parts[:i]), True):
+                return True
+        return self.is_ignored(path, size=size, timestamp=timestamp)
+
+default_settings = {}
+
+def set_ignore_settings(patterns=None, max_size=None, max_age=None):
+    global default_settings
+    default_settings = {'patterns': patterns, 'max_size': max_size, 'max_age': max_age}
+
+def get_ignore_rules():
+    '''
+    :return: a new instance of IgnoreRules by the settings of the process.
+    '''
+    
+    return IgnoreRules(**default_settings)
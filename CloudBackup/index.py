@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import time
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.utils import calc_md5, get_info_path, ensure_folder_exsits
+
+get_local_index_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.local' % name)
+
+def get_index_name(folder_name):
+    if isinstance(folder_name, unicode):
+        folder_name = folder_name.encode('utf-8')
+    return calc_md5(os.path.abspath(folder_name))[:16]
+
+def get_key_digest(key):
+    # the key of the encryption is never written to the disk.
+    if key is None:
+        return
+    return calc_md5(str(key))
+
+class LocalIndex(object):
+    '''
+    The md5 of the local files, kept by the mtime and the size of each file,
+    so that a file is hashed again only when it changes, even after a restart.
+    
+    The md5 is kept by the key of the encryption as well,
+    since the content is encrypted before hashed.
+    
+    The changes of each file seen by the walks are kept too,
+    so that the files still being written can be told.
+    
+    Usage:
+    index = LocalIndex(get_index_name('/local_folder'))
+    md5 = index.get(filename, timestamp, size)
+    if md5 is None:
+        index.put(filename, timestamp, size, calc_md5(content))
+    index.save()
+    '''
+    
+    def __init__(self, name):
+        '''
+        :param name: the name of the index file in the info folder.
+        '''
+        
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_local_index_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        # the absolute path and (timestamp, size, the time hashed, dict of the key and md5).
+        self.files = {}
+        # the absolute path and (timestamp, size, the time the change is seen, 
+        # the walks in a row which see a change).
+        self.changes = {}
+        self.meta = {}
+        self.dirty = False
+        
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        fp = open(self.path, 'rb')
+        try:
+            content = pickle.load(fp)
+            self.files = content['files']
+            self.meta = content['meta']
+            self.changes = content.get('changes', {})
+        except (EOFError, pickle.UnpicklingError, KeyError, ValueError):
+            self.files, self.changes, self.meta = {}, {}, {}
+        finally:
+            fp.close()
+    
+    def save(self):
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            
+            tmp_path = self.path + '.tmp'
+            fp = open(tmp_path, 'wb')
+            try:
+                pickle.dump({'files': self.files, 'changes': self.changes, 
+                             'meta': self.meta}, fp, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+        finally:
+            self.lock.release()
+    
+    def get(self, filename, timestamp, size, key=None):
+        '''
+        :param filename: the local file's absolute path.
+        :param timestamp: the mtime of the local file.
+        :param size: the size of the local file.
+        :param key(optional): the key of the encryption, None if not encrypted.
+        
+        :return: the md5 if the file doesn't change since hashed, else None.
+        '''
+        
+        record = self.files.get(filename)
+        if record is None or record[0] != timestamp or record[1] != size:
+            return
+        return record[3].get(get_key_digest(key))
+    
+    def put(self, filename, timestamp, size, md5, key=None):
+        digest = get_key_digest(key)
+        
+        self.lock.acquire()
+        try:
+            record = self.files.get(filename)
+            if record is not None and record[0] == timestamp and record[1] == size:
+                md5s = dict(record[3])
+            else:
+                md5s = {}
+            md5s[digest] = md5
+            self.files[filename] = (timestamp, size, int(time.time()), md5s)
+            self.dirty = True
+        finally:
+            self.lock.release()
+    
+    def observe(self, filename, timestamp, size, now=None):
+        '''
+        Record the mtime and the size of a file seen by a walk.
+        
+        :return: (the time the latest change is seen, None if never,
+                  the walks in a row which see a change).
+        '''
+        
+        now = now or int(time.time())
+        self.lock.acquire()
+        try:
+            record = self.changes.get(filename)
+            if record is None:
+                record = (timestamp, size, None, 0)
+            elif record[0] != timestamp or record[1] != size:
+                record = (timestamp, size, now, record[3] + 1)
+            elif record[3] > 0:
+                record = (timestamp, size, record[2], 0)
+            else:
+                return record[2], record[3]
+            self.changes[filename] = record
+            self.dirty = True
+            return record[2], record[3]
+        finally:
+            self.lock.release()
+    
+    def get_change(self, filename):
+        '''
+        :return: (the time the latest change is seen, the walks in a row which see a change).
+        '''
+        
+        record = self.changes.get(filename)
+        if record is None:
+            return None, 0
+        return record[2], record[3]
+    
+    def prune(self, filenames):
+        '''
+        Forget the files not in the folder any more.
+        
+        :param filenames: the absolute paths of the files in the folder.
+        '''
+        
+        self.lock.acquire()
+        try:
+            for records in (self.files, self.changes):
+                removed = [filename for filename in records if filename not in filenames]
+                for filename in removed:
+                    del records[filename]
+                if removed:
+                    self.dirty = True
+        finally:
+            self.lock.release()
+    
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+    
+    def set_meta(self, key, value):
+        self.lock.acquire()
+        try:
+            self.meta[key] = value
+            self.dirty = True
+        finally:
+            self.lock.release()
+    
+    def __len__(self):
+        return len(self.files)
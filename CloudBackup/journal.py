@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.utils import get_info_path, ensure_folder_exsits
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# the suffix of a file being downloaded, renamed when the download finishes.
+PART_SUFFIX = '.cbpart'
+
+get_journal_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.journal' % name)
+# the file being downloaded is hidden, so that it's never synced.
+get_part_path = lambda filename: \
+    os.path.join(os.path.dirname(filename), '.%s%s' % (os.path.basename(filename), PART_SUFFIX))
+
+class TransferOperation(object):
+    def __init__(self, kind, filename, cloud_path, timestamp):
+        '''
+        :param kind: UPLOAD or DOWNLOAD.
+        :param filename: the local file's absolute path.
+        :param cloud_path: the path on the cloud.
+        :param timestamp: the mtime of the local file when uploading,
+                          or the timestamp of the cloud file when downloading.
+        '''
+        
+        self.kind = kind
+        self.filename = filename
+        self.cloud_path = cloud_path
+        self.timestamp = timestamp
+
+class TransferJournal(object):
+    '''
+    A write-ahead journal of the transfers.
+    
+    Each transfer is recorded before it starts, and marked when it ends,
+    both are synced to the disk at once.
+    So after a crash, the transfers not ended are known,
+    which can be replayed or rolled back when the process restarts.
+    
+    Usage:
+    op_id = journal.begin(TransferOperation(UPLOAD, filename, cloud_path, timestamp))
+    try:
+        storage.upload(cloud_path, filename)
+    finally:
+        journal.end(op_id)
+    '''
+    
+    def __init__(self, name):
+        '''
+        :param name: the name of the journal file in the info folder.
+        '''
+        
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_journal_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.next_id = 0
+        
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        fp = open(self.path, 'rb')
+        try:
+            while True:
+                try:
+                    op_id, op = pickle.load(fp)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    # the last record may be broken if the process exits while writing.
+                    break
+                if op is None:
+                    self.outstanding.pop(op_id, None)
+                else:
+                    self.outstanding[op_id] = op
+                self.next_id = max(self.next_id, op_id + 1)
+        finally:
+            fp.close()
+    
+    def _write(self, op_id, op):
+        fp = open(self.path, 'ab')
+        try:
+            pickle.dump((op_id, op), fp, pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+    
+    def begin(self, op):
+        '''
+        Record a transfer before it starts.
+        
+        :param op: an instance of TransferOperation.
+        
+        :return: the id of the operation.
+        '''
+        
+        self.lock.acquire()
+        try:
+            op_id = self.next_id
+            self.next_id += 1
+            
+            self._write(op_id, op)
+            self.outstanding[op_id] = op
+            return op_id
+        finally:
+            self.lock.release()
+    
+    def end(self, op_id):
+        '''
+        Mark the transfer ended, no matter if it succeeds.
+        The journal file is removed when no transfer is outstanding.
+        '''
+        
+        self.lock.acquire()
+        try:
+            if op_id not in self.outstanding:
+                return
+            del self.outstanding[op_id]
+            
+            if not self.outstanding:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            else:
+                self._write(op_id, None)
+        finally:
+            self.lock.release()
+    
+    def iter_outstanding(self):
+        '''
+        Iterate the transfers not ended, in the order they began.
+        
+        :return: it yields (op_id, op).
+        '''
+        
+        self.lock.acquire()
+        try:
+            items = sorted(self.outstanding.iteritems())
+        finally:
+            self.lock.release()
+        
+        for op_id, op in items:
+            yield op_id, op
+    
+    def __len__(self):
+        return len(self.outstanding)
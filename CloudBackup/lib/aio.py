@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+
+@author: Chine
+'''
+
+__author__ = "Chine King"
+__description__ = "Single thread clients of Amazon S3 and Google Cloud Storage for concurrent requests"
+
+import sys
+import asyncore
+import socket
+import time
+import heapq
+import hashlib
+from base64 import b64encode
+from collections import deque
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from s3 import S3Client, S3Request, S3Object, get_conditional_headers
+from gs import GSClient, GSRequest, GSObject
+from errors import S3Error, GSError, CircuitOpenError
+from utils import XML
+from retry import get_retry_policy, classify, NOT_RETRY
+
+DEFAULT_CONCURRENCY = 64
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_POLL_INTERVAL = 0.1
+HTTP_PORT = 80
+
+class AsyncResult(object):
+    '''
+    The result of a request which will be done later, when the client runs.
+    '''
+    
+    def __init__(self, callback=None, errback=None):
+        self.callback = callback
+        self.errback = errback
+        
+        self.done = False
+        self.result = None
+        self.error = None
+    
+    def set_result(self, result):
+        self.done, self.result = True, result
+        if self.callback is not None:
+            self.callback(result)
+    
+    def set_error(self, error):
+        self.done, self.error = True, error
+        if self.errback is not None:
+            self.errback(error)
+    
+    def get(self):
+        '''
+        :return: the result of the request, the error raises if the request fails.
+        '''
+        
+        assert self.done
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class _Task(object):
+    def __init__(self, req, parse, body=None, sink=None, result=None):
+        self.req = req
+        self.parse = parse
+        self.body = body
+        self.sink = sink
+        self.result = result or AsyncResult()
+        self.tried = 0
+    
+    def rewind(self):
+        if self.body is not None:
+            self.body.seek(0)
+        if self.sink is not None and hasattr(self.sink, 'truncate'):
+            self.sink.seek(0)
+            self.sink.truncate()
+
+class _HTTPChannel(asyncore.dispatcher):
+    '''
+    A HTTP/1.0 connection which sends one request and receives its response.
+    '''
+    
+    def __init__(self, client, task):
+        asyncore.dispatcher.__init__(self, map=client.map)
+        self.client = client
+        self.task = task
+        
+        req = task.req
+        # the date is signed, so it's renewed for each try.
+        req.date_str = req._get_date_str()
+        headers = req.get_headers()
+        headers['Host'] = req.host
+        headers['Connection'] = 'close'
+        
+        path = req.end_point.split(req.host, 1)[1] or '/'
+        lines = ['%s %s HTTP/1.0' % (req.action, path)]
+        lines.extend(('%s: %s' % (k, v) for k, v in headers.iteritems()))
+        self.out_buf = '\r\n'.join(lines) + '\r\n\r\n'
+        if req.data:
+            self.out_buf += req.data
+        
+        self.in_buf = ''
+        self.status = None
+        self.headers = None
+        self.length = None
+        self.received = 0
+        self.stream = task.body
+        self.body = task.sink if task.sink is not None else StringIO()
+        self.finished = False
+        
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((req.host, HTTP_PORT))
+    
+    def handle_connect(self):
+        pass
+    
+    def writable(self):
+        if not self.connected:
+            return True
+        return len(self.out_buf) > 0 or self.stream is not None
+    
+    def handle_write(self):
+        if not self.out_buf and self.stream is not None:
+            chunk = self.stream.read(DEFAULT_CHUNK_SIZE)
+            if not chunk:
+                self.stream = None
+                return
+            self.out_buf = chunk
+        sent = self.send(self.out_buf)
+        self.out_buf = self.out_buf[sent:]
+    
+    def _parse_headers(self):
+        pos = self.in_buf.find('\r\n\r\n')
+        if pos < 0:
+            return False
+        
+        head, self.in_buf = self.in_buf[:pos], self.in_buf[pos+4:]
+        lines = head.split('\r\n')
+        self.status = int(lines[0].split(' ', 2)[1])
+        # the keys are lower, the same as the headers of urllib2's response.
+        self.headers = {}
+        for line in lines[1:]:
+            k, v = line.split(':', 1)
+            self.headers[k.strip().lower()] = v.strip()
+        
+        if self.task.req.action == 'HEAD' or self.status in (204, 304):
+            self.length = 0
+        elif 'content-length' in self.headers:
+            self.length = int(self.headers['content-length'])
+        if self.status >= 300 and self.status != 304:
+            # the content of an error is parsed, never written to the sink.
+            self.body = StringIO()
+        return True
+    
+    def handle_read(self):
+        data = self.recv(DEFAULT_CHUNK_SIZE)
+        if self.headers is None:
+            self.in_buf += data
+            if not self._parse_headers():
+                return
+            data, self.in_buf = self.in_buf, ''
+        
+        if data:
+            self.body.write(data)
+            self.received += len(data)
+        if self.length is not None and self.received >= self.length:
+            self.finish()
+    
+    def handle_close(self):
+        if self.headers is None:
+            self.finish(socket.error('The connection is closed before the response.'))
+        else:
+            self.finish()
+    
+    def handle_error(self):
+        self.finish(sys.exc_info()[1])
+    
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.close()
+        self.client._on_response(self.task, self, error)
+
+class AsyncS3Client(object):
+    '''
+    Amazon S3 client which runs hundreds of requests concurrently in a single thread.
+    The requests are the same as S3Client's, include the signatures.
+    
+    You can use it by the steps below:
+    client = AsyncS3Client('your_access_key', 'your_secret_access_key')
+    results = [client.put_object('my_bucket_name', name, data) for name, data in files]
+    client.run() # wait until all the requests are done
+    for result in results:
+        result.get()
+    '''
+    
+    object_class = S3Object
+    
+    def __init__(self, access_key, secret_access_key, concurrency=DEFAULT_CONCURRENCY):
+        '''
+        :param access_key
+        :param secret_access_key
+        :param concurrency(optional): the max connections at the same time.
+        '''
+        
+        self.access_key = access_key
+        self.secret_key = secret_access_key
+        # the sync client builds the requests and parses the responses.
+        self.sync_client = self._new_sync_client()
+        
+        self.concurrency = concurrency
+        self.map = {}
+        self.pending = deque()
+        self.timers = []
+        self.active = 0
+    
+    def _new_sync_client(self):
+        return S3Client(self.access_key, self.secret_key)
+    
+    def _new_request(self, action, bucket_name=None, obj_name=None,
+                     data=None, metadata={}, headers={}, content_type=None):
+        return S3Request(self.access_key, self.secret_key, action,
+                         bucket_name=bucket_name, obj_name=obj_name, data=data,
+                         content_type=content_type, metadata=metadata, headers=headers)
+    
+    def _new_error(self, status, tree=None, msg=None):
+        return S3Error(status, tree, msg)
+    
+    def submit(self, req, parse=None, body=None, sink=None, callback=None, errback=None):
+        '''
+        Add a request, which is sent when the client runs.
+        
+        :param req: an instance of S3Request or GSRequest.
+        :param parse(optional): the function to build the result from the content and headers.
+        :param body(optional): a file-like object, the content sent by chunks.
+        :param sink(optional): a file-like object, the content received is written to it.
+        :param callback(optional): called with the result when the request succeeds.
+        :param errback(optional): called with the error when the request fails.
+        
+        :return: an instance of AsyncResult.
+        '''
+        
+        task = _Task(req, parse, body, sink, AsyncResult(callback, errback))
+        self.pending.append(task)
+        return task.result
+    
+    def _start(self):
+        while self.pending and self.active < self.concurrency:
+            task = self.pending.popleft()
+            
+            breaker = get_retry_policy().get_breaker(task.req.host)
+            if not breaker.allow():
+                task.result.set_error(CircuitOpenError(task.req.host, breaker.retry_after()))
+                continue
+            
+            if task.tried == 0:
+                get_retry_policy().budget.deposit()
+            task.tried += 1
+            self.active += 1
+            try:
+                _HTTPChannel(self, task)
+            except socket.error, e:
+                self.active -= 1
+                self._on_error(task, e)
+    
+    def _on_response(self, task, channel, error):
+        self.active -= 1
+        
+        if error is None and channel.status == 304:
+            # not modified by the conditions.
+            get_retry_policy().get_breaker(task.req.host).record_success()
+            task.result.set_result(None)
+            return
+        if error is None and channel.status >= 300:
+            content = channel.body.getvalue()
+            if content:
+                error = self._new_error(channel.status, XML.loads(content))
+            else:
+                error = self._new_error(channel.status, msg='HTTP status %d' % channel.status)
+        if error is not None:
+            self._on_error(task, error)
+            return
+        
+        get_retry_policy().get_breaker(task.req.host).record_success()
+        try:
+            data = channel.body.getvalue() if task.sink is None else None
+            if task.parse is not None:
+                result = task.parse(data, channel.headers)
+            else:
+                result = data
+        except Exception, e:
+            task.result.set_error(e)
+            return
+        task.result.set_result(result)
+    
+    def _on_error(self, task, error):
+        policy = get_retry_policy()
+        breaker = policy.get_breaker(task.req.host)
+        
+        kind = classify(error)
+        if kind == NOT_RETRY:
+            breaker.record_success()
+            task.result.set_error(error)
+            return
+        
+        breaker.record_failure()
+        if task.tried >= policy.max_tries or not policy.budget.withdraw():
+            if not isinstance(error, S3Error):
+                error = self._new_error(-1, msg='Can\'t connect to server: %s' % error)
+            task.result.set_error(error)
+            return
+        
+        task.rewind()
+        when = time.time() + policy.get_delay(task.tried, kind)
+        heapq.heappush(self.timers, (when, id(task), task))
+    
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, task = heapq.heappop(self.timers)
+            self.pending.append(task)
+    
+    def run(self, timeout=None):
+        '''
+        Run until all the requests are done.
+        
+        :param timeout(optional): the max seconds to run, None means no limit.
+        
+        :return: True if all the requests are done.
+        '''
+        
+        start = time.time()
+        while self.pending or self.active or self.timers:
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            
+            self._run_timers()
+            self._start()
+            if self.map:
+                asyncore.loop(DEFAULT_POLL_INTERVAL, map=self.map, count=1)
+            elif self.timers:
+                time.sleep(min(DEFAULT_POLL_INTERVAL,
+                               max(0, self.timers[0][0] - time.time())))
+        return True
+    
+    def _get_stream(self, data):
+        '''
+        :return 0: the data if a string, else None.
+        :return 1: the file-like object to read the content by chunks.
+        :return 2: the headers include the length and md5 of the content.
+        '''
+        
+        if isinstance(data, basestring):
+            return data, None, {}
+        
+        md5, size = hashlib.md5(), 0
+        while True:
+            chunk = data.read(DEFAULT_CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+            size += len(chunk)
+        data.seek(0)
+        return None, data, {'Content-Length': size,
+                            'Content-MD5': b64encode(md5.digest())}
+    
+    def put_object(self, bucket_name, obj_name, data, content_type=None, metadata={},
+                   callback=None, errback=None):
+        '''
+        Put object into a bucket.
+        
+        :param bucket_name: which bucket the object puts into.
+        :param obj_name: the obj name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param data: the content of the obj, a string or a file-like object which can seek.
+        :param content_type(optional)
+        :param metadata(optional): the meta data as amazon defined.
+        '''
+        
+        data, body, headers = self._get_stream(data)
+        req = self._new_request('PUT', bucket_name, obj_name, data=data, metadata=metadata,
+                                headers=headers, content_type=content_type)
+        return self.submit(req, body=body, callback=callback, errback=errback)
+    
+    def get_object(self, bucket_name, obj_name, fp=None, if_none_match=None,
+                   callback=None, errback=None):
+        '''
+        Get object.
+        
+        :param bucket_name: the bucket contains the object.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param fp(optional): a file-like object, the content is written to it as it arrives.
+        :param if_none_match(optional): the ETag, get the object only if its ETag differs.
+        
+        :return: an instance of AsyncResult, the result is an instance of S3Object,
+                 the 'data' property is the content if no fp.
+                 None if the object is not modified by the condition.
+        '''
+        
+        def _parse(data, headers):
+            if data is None:
+                return self.object_class(**headers)
+            return self.object_class(data=data, **headers)
+        
+        headers = get_conditional_headers(if_none_match)
+        req = self._new_request('GET', bucket_name, obj_name, headers=headers)
+        return self.submit(req, _parse, sink=fp, callback=callback, errback=errback)
+    
+    def head_object(self, bucket_name, obj_name, callback=None, errback=None):
+        '''
+        Get the metadata of the object without its content.
+        
+        :return: an instance of AsyncResult, the result is an instance of S3Object.
+        '''
+        
+        req = self._new_request('HEAD', bucket_name, obj_name)
+        return self.submit(req, lambda data, headers: self.object_class(**headers),
+                           callback=callback, errback=errback)
+    
+    def delete_object(self, bucket_name, obj_name, callback=None, errback=None):
+        req = self._new_request('DELETE', bucket_name, obj_name)
+        return self.submit(req, callback=callback, errback=errback)
+    
+    def get_bucket(self, bucket_name, callback=None, errback=None, **kwargs):
+        '''
+        List objects in the bucket by the bucket's name, the params are the same as S3Client's.
+        
+        :return: an instance of AsyncResult, the result is the same as S3Client.get_bucket.
+        '''
+        
+        req = self.sync_client._get_bucket_request(bucket_name, **kwargs)
+        return self.submit(req, lambda data, headers: self.sync_client._parse_get_bucket(data),
+                           callback=callback, errback=errback)
+
+class AsyncGSClient(AsyncS3Client):
+    '''
+    Google Cloud Storage client which runs hundreds of requests concurrently in a single thread.
+    The usage is the same as AsyncS3Client.
+    '''
+    
+    object_class = GSObject
+    
+    def __init__(self, access_key, secret_access_key, project_id,
+                 concurrency=DEFAULT_CONCURRENCY):
+        self.project_id = project_id
+        super(AsyncGSClient, self).__init__(access_key, secret_access_key, concurrency)
+    
+    def _new_sync_client(self):
+        return GSClient(self.access_key, self.secret_key, self.project_id)
+    
+    def _new_request(self, action, bucket_name=None, obj_name=None,
+                     data=None, metadata={}, headers={}, content_type=None):
+        return GSRequest(self.access_key, self.secret_key, self.project_id, action,
+                         bucket_name=bucket_name, obj_name=obj_name, data=data,
+                         content_type=content_type, metadata=metadata, headers=headers)
+    
+    def _new_error(self, status, tree=None, msg=None):
+        return GSError(status, tree, msg)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+
+@author: Chine
+'''
+
+__author__ = "Chine King"
+__description__ = "The bandwidth shared by all the clouds in the process"
+
+import time
+import heapq
+import datetime
+import threading
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# the bytes a body is read or written each time.
+DEFAULT_BLOCK_SIZE = 64 * 1024
+# the bodies smaller than it are the metadata requests mostly, they never wait.
+DEFAULT_SMALL_SIZE = 64 * 1024
+# the tokens saved at most, the seconds of the rate.
+DEFAULT_BURST_SECS = 1
+DEFAULT_WEIGHT = 1
+
+def _parse_clock(clock):
+    if isinstance(clock, datetime.time):
+        return clock.hour * 60 + clock.minute
+    hour, minute = clock.split(':')
+    return int(hour) * 60 + int(minute)
+
+class BandwidthSchedule(object):
+    '''
+    The rates by the time of day, the rates out of all the periods are the default.
+    
+    Usage:
+    schedule = BandwidthSchedule()
+    # 100KB/s for uploading in the office hours.
+    schedule.add('09:00', '18:00', upload_rate=100*1024)
+    # the period can go across the midnight.
+    schedule.add('23:00', '06:00', upload_rate=None, download_rate=None)
+    '''
+    
+    def __init__(self, upload_rate=None, download_rate=None):
+        '''
+        :param upload_rate(optional): the default bytes per second, None means unlimited.
+        :param download_rate(optional): the default bytes per second, None means unlimited.
+        '''
+        
+        self.default = {UPLOAD: upload_rate, DOWNLOAD: download_rate}
+        self.periods = []
+    
+    def add(self, start, end, upload_rate=None, download_rate=None):
+        '''
+        :param start: 'HH:MM' or an instance of datetime.time.
+        :param end: 'HH:MM' or an instance of datetime.time, excluded.
+        '''
+        
+        self.periods.append((_parse_clock(start), _parse_clock(end),
+                             {UPLOAD: upload_rate, DOWNLOAD: download_rate}))
+    
+    def get_rate(self, direction, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        
+        for start, end, rates in self.periods:
+            if start <= end:
+                matched = start <= minute < end
+            else:
+                matched = minute >= start or minute < end
+            if matched:
+                return rates[direction]
+        return self.default[direction]
+    
+    def to_list(self):
+        return [('%02d:%02d' % divmod(start, 60), '%02d:%02d' % divmod(end, 60),
+                 rates[UPLOAD], rates[DOWNLOAD]) for start, end, rates in self.periods]
+    
+    @classmethod
+    def from_list(cls, periods, upload_rate=None, download_rate=None):
+        schedule = cls(upload_rate, download_rate)
+        for start, end, up, down in periods:
+            schedule.add(start, end, up, down)
+        return schedule
+
+class TokenBucket(object):
+    '''
+    The tokens are the bytes, earned by the rate.
+    It's not thread safe, the lock is held by the BandwidthManager.
+    '''
+    
+    def __init__(self, rate=None, burst_secs=DEFAULT_BURST_SECS):
+        self.burst_secs = burst_secs
+        self.rate = None
+        self.tokens = 0
+        self.last = time.time()
+        self.set_rate(rate)
+    
+    @property
+    def capacity(self):
+        return max(self.rate * self.burst_secs, DEFAULT_BLOCK_SIZE)
+    
+    def set_rate(self, rate):
+        if rate == self.rate:
+            return
+        self.refill()
+        self.rate = rate
+        if rate is not None:
+            self.tokens = min(self.tokens, self.capacity)
+    
+    def refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    
+    def get_wait(self, size):
+        '''
+        :return: the seconds to wait until the size can be taken.
+        '''
+        
+        self.refill()
+        if self.rate is None:
+            return 0
+        # the tokens may be in debt, the small bodies are charged without waiting.
+        need = min(size, self.capacity) - self.tokens
+        return max(0, float(need) / self.rate) if self.rate > 0 else None
+    
+    def take(self, size):
+        self.tokens -= size
+
+class BandwidthManager(object):
+    '''
+    Limit the bandwidth of all the clouds in the process,
+    each direction has a token bucket shared by the clouds.
+    
+    The waiting clouds are served by the weighted fair queuing,
+    so that each cloud gets the bandwidth by its weight, and none is starved,
+    while the bandwidth one doesn't use is left to the others.
+    
+    Usage:
+    manager = BandwidthManager(upload_rate=200*1024, weights={'s3': 2, 'vdisk': 1})
+    set_bandwidth_manager(manager)
+    '''
+    
+    def __init__(self, upload_rate=None, download_rate=None, weights=None, schedule=None,
+                 small_size=DEFAULT_SMALL_SIZE, burst_secs=DEFAULT_BURST_SECS):
+        '''
+        :param upload_rate(optional): the bytes per second, None means unlimited.
+        :param download_rate(optional): the bytes per second, None means unlimited.
+        :param weights(optional): dict of the cloud name and its weight, 1 as default.
+        :param schedule(optional): an instance of BandwidthSchedule,
+                                   the rates are taken from it if set.
+        :param small_size(optional): the bodies smaller than it are charged but never wait.
+        '''
+        
+        self.buckets = {
+            UPLOAD: TokenBucket(upload_rate, burst_secs),
+            DOWNLOAD: TokenBucket(download_rate, burst_secs)
+        }
+        self.weights = dict(weights or {})
+        self.schedule = schedule
+        self.small_size = small_size
+        
+        self.cond = threading.Condition()
+        # the virtual time of each direction, and the finish tag of each cloud.
+        self.virtual = {UPLOAD: 0, DOWNLOAD: 0}
+        self.finish = {}
+        self.waiters = {UPLOAD: [], DOWNLOAD: []}
+        self.seq = 0
+        
+        self.transferred = {}
+    
+    def set_rate(self, direction, rate):
+        self.cond.acquire()
+        try:
+            self.buckets[direction].set_rate(rate)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+    
+    def set_weight(self, name, weight):
+        self.cond.acquire()
+        try:
+            self.weights[name] = weight
+        finally:
+            self.cond.release()
+    
+    def set_schedule(self, schedule):
+        self.cond.acquire()
+        try:
+            self.schedule = schedule
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+    
+    def _apply_schedule(self, direction):
+        if self.schedule is not None:
+            self.buckets[direction].set_rate(self.schedule.get_rate(direction))
+    
+    def is_limited(self, direction):
+        if self.schedule is not None:
+            return True
+        return self.buckets[direction].rate is not None
+    
+    def _count(self, name, direction, size):
+        key = (name, direction)
+        self.transferred[key] = self.transferred.get(key, 0) + size
+    
+    def acquire(self, name, direction, size, wait=True):
+        '''
+        Wait until the bytes can be transfered.
+        
+        :param name: the name of the cloud, 's3' eg.
+        :param direction: UPLOAD or DOWNLOAD.
+        :param size: the bytes to transfer.
+        :param wait(optional): if False, the bytes are charged without waiting,
+                               the small bodies eg.
+        '''
+        
+        if size <= 0:
+            return
+        
+        self.cond.acquire()
+        try:
+            self._apply_schedule(direction)
+            self._count(name, direction, size)
+            bucket = self.buckets[direction]
+            if bucket.rate is None or not wait:
+                bucket.take(size)
+                return
+            
+            # start-time fair queuing, the waiter with the smallest start tag goes first.
+            weight = max(self.weights.get(name, DEFAULT_WEIGHT), 0.001)
+            key = (name, direction)
+            start = max(self.virtual[direction], self.finish.get(key, 0))
+            self.finish[key] = start + float(size) / weight
+            
+            self.seq += 1
+            waiter = (start, self.seq)
+            waiters = self.waiters[direction]
+            heapq.heappush(waiters, waiter)
+            try:
+                while True:
+                    self._apply_schedule(direction)
+                    wait = bucket.get_wait(size)
+                    if waiters[0] == waiter and wait == 0:
+                        break
+                    if waiters[0] != waiter or wait is None:
+                        wait = 1
+                    self.cond.wait(wait)
+                
+                bucket.take(size)
+                self.virtual[direction] = start
+            finally:
+                waiters.remove(waiter)
+                heapq.heapify(waiters)
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+    
+    def get_stats(self):
+        '''
+        :return: dict of (the name of the cloud, the direction) and the bytes transfered.
+        '''
+        
+        self.cond.acquire()
+        try:
+            return dict(self.transferred)
+        finally:
+            self.cond.release()
+
+class ThrottledReader(object):
+    '''
+    Read a body, the content of a request or a response, by the manager's pace.
+    The other attributes are the body's, the headers of a response eg.
+    '''
+    
+    def __init__(self, body, manager, name, direction, size=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.body = body
+        self.manager = manager
+        self.name = name
+        self.direction = direction
+        self.size = size
+        self.block_size = block_size
+        self.pos = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def __getattr__(self, attr):
+        return getattr(self.body, attr)
+    
+    def _read(self, size):
+        if isinstance(self.body, str):
+            data = self.body[self.pos:self.pos+size]
+            self.pos += len(data)
+            return data
+        return self.body.read(size)
+    
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            block_size = self.block_size if size < 0 else min(size, self.block_size)
+            data = self._read(block_size)
+            if not data:
+                break
+            self.manager.acquire(self.name, self.direction, len(data))
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(parts)
+
+default_manager = BandwidthManager()
+
+def get_bandwidth_manager():
+    return default_manager
+
+def set_bandwidth_manager(manager):
+    global default_manager
+    default_manager = manager
+
+def throttle_upload(data, name):
+    '''
+    :param data: the content of a request, a str or a file-like object with length.
+    :param name: the name of the cloud.
+    
+    :return: the data itself if not limited, else a file-like object read by the manager's pace.
+    '''
+    
+    manager = get_bandwidth_manager()
+    if not data or not manager.is_limited(UPLOAD):
+        return data
+    if len(data) < manager.small_size:
+        manager.acquire(name, UPLOAD, len(data), wait=False)
+        return data
+    return ThrottledReader(data, manager, name, UPLOAD, len(data))
+
+def throttle_download(resp, name):
+    '''
+    :param resp: the response.
+    :param name: the name of the cloud.
+    
+    :return: the response itself if not limited, else a file-like object read by the manager's pace.
+    '''
+    
+    manager = get_bandwidth_manager()
+    if not manager.is_limited(DOWNLOAD):
+        return resp
+    
+    try:
+        size = int(resp.headers.get('content-length'))
+    except (AttributeError, TypeError, ValueError):
+        size = None
+    if size is not None and size < manager.small_size:
+        manager.acquire(name, DOWNLOAD, size, wait=False)
+        return resp
+    return ThrottledReader(resp, manager, name, DOWNLOAD, size)
@@ -25,6 +25,8 @@ import pyDes
 __author__ = "Chine King"
 __description__ = "crypto modules, DES requires for pyDes."
 
+BLOCK_SIZE = 8
+
 class DES(object):
     def __init__(self, IV):
         '''
@@ -35,10 +37,69 @@ class DES(object):
         assert len(IV) == 8
         
         self.IV = IV
-        self.des = pyDes.des("DESCRYPT", pyDes.CBC, self.IV, pad=None, padmode=pyDes.PAD_PKCS5)
+        
+    def _get_des(self):
+        # the pyDes keeps the state of CBC and the block being crypted, 
+        # so each call has its own, and a DES can be shared by the threads.
+        return pyDes.des("DESCRYPT", pyDes.CBC, self.IV, pad=None, padmode=pyDes.PAD_PKCS5)
         
     def encrypt(self, data):
-        return self.des.encrypt(data)
+        return self._get_des().encrypt(data)
         
     def decrypt(self, data):
-        return self.des.decrypt(data)
\ No newline at end of file
+        return self._get_des().decrypt(data)
+    
+    def encryptor(self):
+        return DESStream(self.IV)
+    
+    def decryptor(self):
+        return DESStream(self.IV, decrypt=True)
+    
+    @staticmethod
+    def get_encrypted_size(size):
+        # PKCS5 always pads 1 to 8 bytes.
+        return (size // BLOCK_SIZE + 1) * BLOCK_SIZE
+    
+class DESStream(object):
+    '''
+    Encrypt or decrypt the data by chunks, 
+    the result is the same as DES does on the whole data.
+    
+    Usage:
+    stream = DES('12345678').encryptor()
+    for chunk in chunks:
+        fp.write(stream.update(chunk))
+    fp.write(stream.final())
+    '''
+    
+    def __init__(self, IV, decrypt=False):
+        self.des = pyDes.des("DESCRYPT", pyDes.CBC, IV, pad=None, padmode=pyDes.PAD_PKCS5)
+        self.decrypt = decrypt
+        self.buf = ''
+        
+    def update(self, data):
+        self.buf += data
+        
+        n = len(self.buf) // BLOCK_SIZE * BLOCK_SIZE
+        if self.decrypt and n == len(self.buf):
+            # the last block is kept to remove the padding when final.
+            n -= BLOCK_SIZE
+        if n <= 0:
+            return ''
+        
+        data, self.buf = self.buf[:n], self.buf[n:]
+        if self.decrypt:
+            result = self.des.crypt(data, pyDes.des.DECRYPT)
+            iv = data[-BLOCK_SIZE:]
+        else:
+            result = self.des.crypt(data, pyDes.des.ENCRYPT)
+            iv = result[-BLOCK_SIZE:]
+        # the cipher block chains to the next chunk.
+        self.des.setIV(iv)
+        return result
+    
+    def final(self):
+        data, self.buf = self.buf, ''
+        if self.decrypt:
+            return self.des.decrypt(data)
+        return self.des.encrypt(data)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+
+@author: Chine
+'''
+
+__author__ = "Chine King"
+__description__ = "Reed-Solomon erasure coding over GF(2^8)"
+
+from binascii import hexlify, unhexlify
+
+from errors import CloudBackupLibError
+
+# the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1.
+GF_POLYNOMIAL = 0x11d
+MAX_SHARDS = 256
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        GF_EXP[i] = x
+        GF_LOG[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLYNOMIAL
+    for i in range(255, 512):
+        GF_EXP[i] = GF_EXP[i - 255]
+_init_tables()
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256).')
+    return GF_EXP[255 - GF_LOG[a]]
+
+def gf_pow(a, n):
+    if n == 0:
+        return 1
+    if a == 0:
+        return 0
+    return GF_EXP[(GF_LOG[a] * n) % 255]
+
+_mul_tables = {}
+
+def _get_mul_table(c):
+    # the table for str.translate, so a shard is multiplied in C.
+    table = _mul_tables.get(c)
+    if table is None:
+        table = ''.join(chr(gf_mul(c, x)) for x in range(256))
+        _mul_tables[c] = table
+    return table
+
+def _mat_mul(a, b):
+    rows, cols, inner = len(a), len(b[0]), len(b)
+    result = [[0] * cols for _ in range(rows)]
+    for r in range(rows):
+        for c in range(cols):
+            value = 0
+            for i in range(inner):
+                value ^= gf_mul(a[r][i], b[i][c])
+            result[r][c] = value
+    return result
+
+def _mat_invert(matrix):
+    size = len(matrix)
+    work = [list(row) + [1 if i == j else 0 for j in range(size)]
+            for i, row in enumerate(matrix)]
+    
+    for col in range(size):
+        pivot = None
+        for row in range(col, size):
+            if work[row][col] != 0:
+                pivot = row
+                break
+        if pivot is None:
+            raise CloudBackupLibError('erasure', -1, 'The matrix is singular.')
+        work[col], work[pivot] = work[pivot], work[col]
+        
+        inv = gf_inv(work[col][col])
+        work[col] = [gf_mul(inv, v) for v in work[col]]
+        for row in range(size):
+            factor = work[row][col]
+            if row != col and factor != 0:
+                work[row] = [v ^ gf_mul(factor, p) for v, p in zip(work[row], work[col])]
+    
+    return [row[size:] for row in work]
+
+def _build_matrix(data_shards, total_shards):
+    '''
+    A Vandermonde matrix turned systematic,
+    the top rows are the identity, so the data shards are the data itself,
+    and any rows of the number of data shards can be inverted.
+    '''
+    
+    vandermonde = [[gf_pow(r, c) for c in range(data_shards)] for r in range(total_shards)]
+    top_inv = _mat_invert(vandermonde[:data_shards])
+    return _mat_mul(vandermonde, top_inv)
+
+def _combine(coefficients, shards, shard_size):
+    '''
+    :return: the sum of each shard multiplied by its coefficient.
+    '''
+    
+    acc = 0
+    for c, shard in zip(coefficients, shards):
+        if c == 0:
+            continue
+        if c != 1:
+            shard = shard.translate(_get_mul_table(c))
+        # the xor of the whole shards as big numbers.
+        acc ^= int(hexlify(shard), 16)
+    return unhexlify('%0*x' % (shard_size * 2, acc))
+
+class ReedSolomon(object):
+    '''
+    Split the data into data shards and parity shards,
+    the data can be rebuilt from any shards of the number of data shards.
+    
+    Usage:
+    codec = ReedSolomon(2, 1)
+    shards = codec.encode(data)
+    data = codec.decode({0: shards[0], 2: shards[2]}, len(data))
+    '''
+    
+    def __init__(self, data_shards, parity_shards):
+        '''
+        :param data_shards: the number of the data shards.
+        :param parity_shards: the number of the parity shards,
+                              the shards can be lost at most.
+        '''
+        
+        if data_shards <= 0 or parity_shards < 0 or \
+            data_shards + parity_shards > MAX_SHARDS:
+            raise CloudBackupLibError('erasure', -1,
+                                      'Illegal shards: %d+%d.' % (data_shards, parity_shards))
+        
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+        self.total_shards = data_shards + parity_shards
+        self.matrix = _build_matrix(data_shards, self.total_shards)
+    
+    def get_shard_size(self, size):
+        return (size + self.data_shards - 1) // self.data_shards
+    
+    def encode(self, data):
+        '''
+        :param data: the content to split.
+        
+        :return: the list of the shards, the data shards come first.
+        '''
+        
+        shard_size = self.get_shard_size(len(data))
+        if shard_size == 0:
+            return [''] * self.total_shards
+        
+        data = data + '\0' * (shard_size * self.data_shards - len(data))
+        shards = [data[i*shard_size:(i+1)*shard_size] for i in range(self.data_shards)]
+        for row in self.matrix[self.data_shards:]:
+            shards.append(_combine(row, shards[:self.data_shards], shard_size))
+        return shards
+    
+    def decode(self, shards, size):
+        '''
+        :param shards: dict of the index and the shard,
+                       the number of the data shards are needed at least.
+        :param size: the size of the data.
+        
+        :return: the data.
+        '''
+        
+        if len(shards) < self.data_shards:
+            raise CloudBackupLibError('erasure', -1,
+                                      'Need %d shards, only %d.' % (self.data_shards, len(shards)))
+        
+        shard_size = self.get_shard_size(size)
+        if shard_size == 0:
+            return ''
+        
+        # the data shards are used first, which need no calculation.
+        indexes = sorted(shards)[:self.data_shards]
+        if indexes == range(self.data_shards):
+            return ''.join(shards[i] for i in indexes)[:size]
+        
+        inv = _mat_invert([self.matrix[i] for i in indexes])
+        chosen = [shards[i] for i in indexes]
+        data = []
+        for i in range(self.data_shards):
+            if i in shards:
+                data.append(shards[i])
+            else:
+                data.append(_combine(inv[i], chosen, shard_size))
+        return ''.join(data)[:size]
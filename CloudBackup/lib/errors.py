@@ -89,4 +89,16 @@ class GSError(S3Error):
     
     def __init__(self, status, tree=None, msg=None):
         super(GSError, self).__init__(status, tree, msg)
-        self.src = 'Google Cloud Storage'
\ No newline at end of file
+        self.src = 'Google Cloud Storage'
+        
+class CircuitOpenError(CloudBackupLibError):
+    '''
+    The requests to an endpoint are refused for a while,
+    because too many of them failed in succession.
+    '''
+    
+    def __init__(self, endpoint, retry_after):
+        super(CircuitOpenError, self).__init__(
+            'retry', -1, 'Too many failures of %s, retry after %d seconds' % (endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
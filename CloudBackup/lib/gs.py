@@ -20,11 +20,23 @@ Created on 2012-5-12
 @author: Chine
 '''
 
+import os
+import urllib
+import urlparse
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 from s3 import (S3Bucket, S3Object, AmazonUser, S3Request, 
-                S3ACL, S3AclGrant, S3AclGrantByEmail)
+                S3ACL, S3AclGrant, S3AclGrantByEmail, 
+                S3ObjectRecord, S3BucketListing, get_conditional_headers)
 from errors import S3Error, GSError
 from utils import hmac_sha1, calc_md5, XML
 from crypto import DES
+from retry import get_retry_policy
+from pipeline import (DEFAULT_PIPELINE_THRESHOLD, DEFAULT_QUEUE_DEPTH, DEFAULT_CHUNK_SIZE,
+                      upload_by_pipeline, download_by_pipeline)
 
 __author__ = "Chine King"
 __description__ = "A client for Google Cloud Storage api, site: https://developers.google.com/storage/"
@@ -32,9 +44,13 @@ __all__ = ['get_end_point', 'X_GOOG_ACL', 'ACL_PERMISSION',
            'GSAclGrantByUserID', 'GSAclGrantByUserEmail', 
            'GSAclGrantByGroupID', 'GSAclGrantByGroupEmail',
            'GSAclGrantByAllUsers', 'GSAclGrantByAllAuthenticatedUsers',
-           'GSBucket', 'GSObject', 'GSUser', 'GSClient']
+           'GSBucket', 'GSObject', 'GSObjectRecord', 'GSBucketListing', 'GSUser', 'GSClient']
 
 ACTION_TYPES = ('PUT', 'GET', 'DELETE', 'HEAD', 'POST')
+# the size of chunks must be a multiple of 256K, except the last one.
+DEFAULT_RESUMABLE_CHUNK_SIZE = 8 * 256 * 1024
+# the times to query the committed bytes and resume, if a chunk fails.
+MAX_RESUME_TIMES = 5
 STRING_TO_SIGN = '''%(action)s
 %(content_md5)s
 %(content_type)s
@@ -272,6 +288,20 @@ class GSObject(S3Object):
     Object of Google cloud storage, almost like Amazon S3 object.
     '''
     
+class GSObjectRecord(S3ObjectRecord):
+    '''
+    A compact record of an object in the bucket listing of Google cloud storage.
+    '''
+    
+    __slots__ = ()
+    
+class GSBucketListing(S3BucketListing):
+    '''
+    A page of the bucket listing of Google cloud storage, parsed incrementally.
+    '''
+    
+    record_cls = GSObjectRecord
+    
 class GSUser(AmazonUser):
     '''
     The Google cloud storage user.
@@ -291,9 +321,12 @@ class GSUser(AmazonUser):
         return self.id_
     
 class GSRequest(S3Request):
+    provider = 'gs'
+    
     def __init__(self, access_key, secret_access_key, project_id, action, 
                  bucket_name=None, obj_name=None,
-                 data=None, content_type=None, metadata={}, goog_headers={} ):
+                 data=None, content_type=None, metadata={}, goog_headers={}, headers={},
+                 query=None):
         
         assert action in ACTION_TYPES # action must be PUT, GET and DELETE.
         
@@ -314,8 +347,12 @@ class GSRequest(S3Request):
         
         self.project_id = project_id
         self.goog_headers = goog_headers
+        self.headers = headers
         self.host = get_end_point(self.bucket_name)
         self.end_point = get_end_point(self.bucket_name, self.obj_name, True)
+        # the query string, the upload id eg, isn't signed, but the object is.
+        if query:
+            self.end_point += '?' + query
     
     def _get_canoicalized_extension_headers(self, headers):
         goog_headers = [(k.lower(), v) for k, v in headers.iteritems() 
@@ -344,7 +381,10 @@ class GSRequest(S3Request):
         headers = { 
                    'Date': self.date_str
                    }
-        if self.data:
+        if hasattr(self.data, 'read'):
+            # the content is streamed, so its md5 is checked by the ETag after sent.
+            headers['Content-Length'] = len(self.data)
+        elif self.data:
             headers['Content-Length'] = len(self.data)
             headers['Content-MD5'] = calc_md5(self.data)
         else:
@@ -360,6 +400,7 @@ class GSRequest(S3Request):
             headers['x-goog-meta-' + k] = v
         for k, v in self.goog_headers.iteritems():
             headers['x-goog-' + k] = v
+        headers.update(self.headers)
             
         headers['x-goog-api-version'] = 1
         headers['x-goog-project-id'] = self.project_id
@@ -367,13 +408,17 @@ class GSRequest(S3Request):
         
         return headers
     
-    def submit(self, try_times=3, try_interval=3, callback=None, include_headers=False):
+    def submit(self, try_times=None, try_interval=None, callback=None, include_headers=False,
+               stream=False):
         try:
             return super(GSRequest, self).submit(
-                try_times=try_times, try_interval=try_times, 
-                callback=callback, include_headers=include_headers)
+                try_times=try_times, try_interval=try_interval, 
+                callback=callback, include_headers=include_headers, stream=stream)
         except S3Error, e:
-            raise GSError(e.err_no, e.tree)
+            error = GSError(e.err_no, getattr(e, 'tree', None), getattr(e, 'msg', None))
+            error.headers = getattr(e, 'headers', {})
+            error.cause = getattr(e, 'cause', None)
+            raise error
     
 class GSClient(object):
     '''
@@ -383,8 +428,17 @@ class GSClient(object):
     client = GSClient('your_access_key', 'your_secret_access_key', 'your_project_id') # init
     client.upload_file('/local_path/file_name', 'my_bucket_name', 'my_folder/file_name') 
     # call the Google Cloud Storage api
+    
+    The files not smaller than pipeline_threshold are read, encrypted and transfered
+    at the same time, chunk by chunk, and the utilization of each stage 
+    is kept in last_utilization after the transfer.
     '''
     
+    pipeline_threshold = DEFAULT_PIPELINE_THRESHOLD
+    pipeline_depth = DEFAULT_QUEUE_DEPTH
+    pipeline_chunk_size = DEFAULT_CHUNK_SIZE
+    last_utilization = None
+    
     def __init__(self, access_key, secret_access_key, project_id,
                  canonical_user_id=None):
         self.access_key = access_key
@@ -473,24 +527,11 @@ class GSClient(object):
                
         return owner, grants
     
-    def _parse_get_bucket(self, data):
-        tree = XML.loads(data)
-        bucket = GSBucket.from_xml(tree)
-        has_next = True if bucket.is_truncated == 'true' else False
-        
-        objs = []
-        for ele in tree.findall('Contents'):
-            obj = GSObject.from_xml(ele)
-            obj.bucket = bucket
-            objs.append(obj)
+    def _parse_get_bucket(self, source):
+        listing = GSBucketListing(source)
+        objs = list(listing)
             
-        common_prefix = []
-        for ele in tree.findall('CommonPrefixes'):
-            prefix = ele.find('Prefix')
-            if hasattr(prefix, 'text'):
-                common_prefix.append(prefix.text)
-            
-        return objs, common_prefix, has_next
+        return objs, listing.common_prefix, listing.has_next
     
     def get_bucket(self, bucket_name, acl=False, **kwargs):
         '''
@@ -498,7 +539,7 @@ class GSClient(object):
         
         :param bucket_name
         
-        :return 0: list of objects in the bucket, each one is an instance of GSObject.
+        :return 0: list of objects in the bucket, each one is an instance of GSObjectRecord.
         :return 1: the common prefix list, always when prefix parameter in kwargs.
         :return 2: if has next objects.
         
@@ -518,6 +559,21 @@ class GSClient(object):
                             bucket_name=bucket_name, obj_name='?acl')
             return req.submit(callback=self._parse_get_acl)
         
+        req = self._get_bucket_request(bucket_name, **kwargs)
+        return req.submit(stream=True, callback=self._parse_get_bucket)
+    
+    def iter_bucket(self, bucket_name, **kwargs):
+        '''
+        List objects in the bucket by the bucket's name, the params are the same as get_bucket.
+        
+        :return: an instance of GSBucketListing, 
+                 the objects are parsed while iterating it, as the response arrives.
+        '''
+        
+        req = self._get_bucket_request(bucket_name, **kwargs)
+        return req.submit(stream=True, callback=GSBucketListing)
+    
+    def _get_bucket_request(self, bucket_name, **kwargs):
         args = {}
         for k in ('delimiter', 'marker', 'prefix', 'max_keys'):
             v = kwargs.pop(k, None)
@@ -530,9 +586,8 @@ class GSClient(object):
         else:
             param = '?' + param
         
-        req = GSRequest(self.access_key, self.secret_key, self.project_id, 'GET',
-                        bucket_name=bucket_name, obj_name=param)
-        return req.submit(callback=self._parse_get_bucket)
+        return GSRequest(self.access_key, self.secret_key, self.project_id, 'GET',
+                         bucket_name=bucket_name, obj_name=param)
     
     def delete_bucket(self, bucket_name):
         '''
@@ -545,16 +600,23 @@ class GSClient(object):
                         bucket_name=bucket_name)
         return req.submit()
     
-    def get_object(self, bucket_name, obj_name, acl=False):
+    def get_object(self, bucket_name, obj_name, acl=False, 
+                   if_none_match=None, if_modified_since=None, byte_range=None):
         '''
         Get object.
         
         :param bucket_name: the bucket contains the object.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
         :param acl: if True, return the acl infomation of the object.
+        :param if_none_match(optional): the ETag, return the object only if its ETag differs.
+        :param if_modified_since(optional): the timestamp or the datetime, 
+                                            return the object only if modified after it.
+        :param byte_range(optional): tuple of (the first byte, the last byte), both included,
+                                     only the range of the content is returned.
         
         if acl is not True
         :return: return an instance of S3Object, the 'data' property is the content of the object.
+                 None if the object is not modified by the conditions.
         else
         :return 0: the owner of the buckt, an instance of GSUser.
         :return 1: a list. each one is an isntance of GSAclGrant or its subclass.
@@ -568,9 +630,17 @@ class GSClient(object):
                             bucket_name=bucket_name, obj_name=obj_name+"?acl")
             return req.submit(callback=self._parse_get_acl)
         
+        headers = get_conditional_headers(if_none_match, if_modified_since)
+        if byte_range is not None:
+            headers['Range'] = 'bytes=%d-%d' % tuple(byte_range)
         req = GSRequest(self.access_key, self.secret_key, self.project_id, 'GET',
-                        bucket_name=bucket_name, obj_name=obj_name)
-        return req.submit(include_headers=True, callback=lambda data, headers: GSObject(data=data, **headers))
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        try:
+            return req.submit(include_headers=True, callback=lambda data, headers: GSObject(data=data, **headers))
+        except GSError, e:
+            if e.err_no == 304:
+                return
+            raise e
     
     def put_object(self, bucket_name, obj_name, data=None, x_goog_acl=X_GOOG_ACL.private,
                    content_type=None, metadata={}, goog_headers={}, owner=None, grants=None):
@@ -589,19 +659,28 @@ class GSClient(object):
                         content_type=content_type, metadata=metadata, goog_headers=goog_headers)
         return req.submit()
     
-    def head_object(self, bucket_name, obj_name):
+    def head_object(self, bucket_name, obj_name, if_none_match=None, if_modified_since=None):
         '''
         List metadata of the object.
         
         :param bucket_name: the bucket contains the object.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param if_none_match(optional): the ETag, return the metadata only if the ETag differs.
+        :param if_modified_since(optional): the timestamp or the datetime, 
+                                            return the metadata only if modified after it.
         
-        :return: an instance of GSObject.
+        :return: an instance of GSObject, None if the object is not modified by the conditions.
         '''
         
+        headers = get_conditional_headers(if_none_match, if_modified_since)
         req = GSRequest(self.access_key, self.secret_key, self.project_id, 'HEAD',
-                        bucket_name=bucket_name, obj_name=obj_name)
-        return req.submit(include_headers=True, callback=lambda data, headers: S3Object(**headers))
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        try:
+            return req.submit(include_headers=True, callback=lambda data, headers: GSObject(**headers))
+        except GSError, e:
+            if e.err_no == 304:
+                return
+            raise e
     
     def delete_object(self, bucket_name, obj_name):
         '''
@@ -615,8 +694,230 @@ class GSClient(object):
                         bucket_name=bucket_name, obj_name=obj_name)
         return req.submit()
     
+    def _parse_copy_object(self, data):
+        if not data:
+            return GSObject()
+        
+        tree = XML.loads(data)
+        if tree.tag == 'Error':
+            raise GSError(200, tree)
+        return GSObject.from_xml(tree)
+    
+    def copy_object(self, src_bucket_name, src_obj_name, bucket_name, obj_name,
+                    metadata=None, goog_headers={}):
+        '''
+        Copy object in the server side, the content is not transfered by the client.
+        
+        :param src_bucket_name: the bucket contains the source object.
+        :param src_obj_name: the source object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param bucket_name: the bucket which the object copies to.
+        :param obj_name: the new object's name.
+        :param metadata(optional): if None, the metadata of the source object is copied,
+                                   else replaced by the metadata.
+        :param goog_headers(optional): the extra headers which google defined.
+        
+        :return: an instance of GSObject.
+        
+        You can refer to the document here:
+        https://developers.google.com/storage/docs/reference-headers#xgoogcopysource
+        '''
+        
+        if isinstance(src_obj_name, unicode):
+            src_obj_name = src_obj_name.encode('utf-8')
+        
+        goog_headers = dict(goog_headers)
+        goog_headers['copy-source'] = urllib.quote('/%s/%s' % (src_bucket_name, src_obj_name))
+        if metadata is not None:
+            goog_headers['metadata-directive'] = 'REPLACE'
+        else:
+            metadata = {}
+        
+        req = GSRequest(self.access_key, self.secret_key, self.project_id, 'PUT',
+                        bucket_name=bucket_name, obj_name=obj_name,
+                        metadata=metadata, goog_headers=goog_headers)
+        return req.submit(callback=self._parse_copy_object)
+    
+    def move_object(self, src_bucket_name, src_obj_name, bucket_name, obj_name):
+        '''
+        Move object in the server side, by copying it and deleting the source.
+        
+        :param src_bucket_name: the bucket contains the source object.
+        :param src_obj_name: the source object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param bucket_name: the bucket which the object moves to.
+        :param obj_name: the new object's name.
+        
+        :return: an instance of GSObject.
+        '''
+        
+        obj = self.copy_object(src_bucket_name, src_obj_name, bucket_name, obj_name)
+        self.delete_object(src_bucket_name, src_obj_name)
+        return obj
+    
+    def start_resumable_upload(self, bucket_name, obj_name, content_type=None, goog_headers={}):
+        '''
+        Start a session of the resumable upload.
+        
+        :param bucket_name: name of the bucket which file puts into.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        
+        :return: the session URI, which the content is put to.
+        '''
+        
+        goog_headers = dict(goog_headers, resumable='start')
+        req = GSRequest(self.access_key, self.secret_key, self.project_id, 'POST',
+                        bucket_name=bucket_name, obj_name=obj_name, 
+                        content_type=content_type, goog_headers=goog_headers)
+        return req.submit(include_headers=True, callback=lambda data, headers: headers['location'])
+    
+    def _get_session_request(self, bucket_name, obj_name, session_uri, data=None, headers={}):
+        # the session URI is the object's with the upload id.
+        return GSRequest(self.access_key, self.secret_key, self.project_id, 'PUT',
+                         bucket_name=bucket_name, obj_name=obj_name, data=data, headers=headers,
+                         query=urlparse.urlparse(session_uri).query)
+    
+    def _parse_committed(self, e):
+        # the Range is like 'bytes=0-1048575', not exists if nothing committed.
+        committed = e.headers.get('range')
+        if not committed:
+            return 0
+        return int(committed.rsplit('-', 1)[1]) + 1
+    
+    def query_resumable_upload(self, bucket_name, obj_name, session_uri, size):
+        '''
+        Query the bytes committed by the server.
+        
+        :param bucket_name: name of the bucket which file puts into.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param session_uri: the URI returned by start_resumable_upload.
+        :param size: the total size of the content.
+        
+        :return: the size committed, the next chunk starts here.
+        '''
+        
+        headers = {'Content-Range': 'bytes */%d' % size}
+        req = self._get_session_request(bucket_name, obj_name, session_uri, headers=headers)
+        try:
+            req.submit()
+            return size
+        except GSError, e:
+            if e.err_no == 308:
+                return self._parse_committed(e)
+            raise e
+    
+    def put_resumable_chunk(self, bucket_name, obj_name, session_uri, data, offset, size):
+        '''
+        Put a chunk of the content.
+        
+        :param bucket_name: name of the bucket which file puts into.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param session_uri: the URI returned by start_resumable_upload.
+        :param data: the content of the chunk.
+        :param offset: the position of the chunk in the content.
+        :param size: the total size of the content.
+        
+        :return: the size committed, the next chunk starts here.
+        '''
+        
+        headers = {'Content-Range': 'bytes %d-%d/%d' % (offset, offset+len(data)-1, size)}
+        req = self._get_session_request(bucket_name, obj_name, session_uri, 
+                                        data=data, headers=headers)
+        try:
+            # the chunk may be committed partly when fails, 
+            # so it's not retried blindly but resumed from the committed bytes.
+            req.submit(try_times=1)
+            return size
+        except GSError, e:
+            if e.err_no == 308:
+                return self._parse_committed(e)
+            raise e
+    
+    def upload_resumable(self, source, bucket_name, obj_name, goog_headers={},
+                         sessions=None, version=None, chunk_size=DEFAULT_RESUMABLE_CHUNK_SIZE):
+        '''
+        Upload the content by the resumable protocol, 
+        if a chunk fails, the upload continues from the bytes the server committed.
+        
+        :param source: a file-like object which can seek.
+        :param bucket_name: name of the bucket which file puts into.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param sessions(optional): a dict-like object keeps the session URIs, 
+                                   so that an interrupted upload can continue after restart.
+        :param version(optional): the version of the content, mtime of the file eg, 
+                                  the session continues only if the version is the same.
+        :param chunk_size(optional): the size of each chunk, must be a multiple of 256K.
+        '''
+        
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        
+        key = '%s/%s' % (bucket_name, obj_name)
+        session = sessions.get(key) if sessions is not None else None
+        
+        session_uri, offset = None, 0
+        if session is not None and tuple(session[1:]) == (size, version):
+            session_uri = session[0]
+            try:
+                offset = self.query_resumable_upload(bucket_name, obj_name, session_uri, size)
+            except GSError, e:
+                # the session expires.
+                if e.err_no not in (404, 410):
+                    raise e
+                session_uri = None
+        if session_uri is None:
+            session_uri = self.start_resumable_upload(bucket_name, obj_name, 
+                                                      goog_headers=goog_headers)
+            offset = 0
+            if sessions is not None:
+                sessions[key] = (session_uri, size, version)
+        
+        resumed = 0
+        while offset < size:
+            source.seek(offset)
+            data = source.read(chunk_size)
+            try:
+                offset = self.put_resumable_chunk(bucket_name, obj_name, session_uri, 
+                                                  data, offset, size)
+            except GSError, e:
+                if e.err_no in (404, 410) or resumed >= MAX_RESUME_TIMES:
+                    if sessions is not None and e.err_no in (404, 410):
+                        sessions.pop(key, None)
+                    raise e
+                # the chunk may be committed partly.
+                resumed += 1
+                offset = self.query_resumable_upload(bucket_name, obj_name, session_uri, size)
+        
+        if sessions is not None:
+            sessions.pop(key, None)
+    
+    def _upload_by_pipeline(self, filename, bucket_name, obj_name, goog_headers, encryptor=None):
+        size = os.path.getsize(filename)
+        if encryptor is not None:
+            size = DES.get_encrypted_size(size)
+            
+        def _send(body):
+            req = GSRequest(self.access_key, self.secret_key, self.project_id, 'PUT',
+                            bucket_name=bucket_name, obj_name=obj_name, data=body,
+                            goog_headers=goog_headers)
+            # the body can't be read again, so the whole transfer is retried instead.
+            return req.submit(try_times=1, include_headers=True,
+                              callback=lambda data, headers: headers.get('etag', ''))
+        
+        fp = open(filename, 'rb')
+        def _action():
+            md5, etag, self.last_utilization = upload_by_pipeline(
+                fp, size, _send, encryptor() if encryptor is not None else None,
+                self.pipeline_depth, self.pipeline_chunk_size)
+            if etag.strip('"') != md5:
+                raise GSError(-1, msg='The content of %s is broken while uploading.' % obj_name)
+        
+        try:
+            get_retry_policy().call(_action)
+        finally:
+            fp.close()
+    
     def upload_file(self, filename, bucket_name, obj_name, x_goog_acl=X_GOOG_ACL.private,
-                    encrypt=False, encrypt_func=None):
+                    encrypt=False, encrypt_func=None, resumable_threshold=None, sessions=None,
+                    encryptor=None):
         '''
         Upload a local file to the Amazon S3.
         
@@ -624,6 +925,11 @@ class GSClient(object):
         :param bucket_name: name of the bucket which file puts into.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
         :param x_goog_acl: the acl of the file.
+        :param resumable_threshold(optional): the file not smaller than it is uploaded 
+                                              by the resumable protocol, None means never.
+        :param sessions(optional): a dict-like object keeps the session URIs of the resumable uploads.
+        :param encryptor(optional): the function returns an object encrypts by chunks,
+                                    DES.encryptor eg, required to encrypt by the pipeline.
         
         As default, x_goog_acl is private. It can be:
         private
@@ -639,11 +945,28 @@ class GSClient(object):
         But notice that the '-' must be replaced with '_', X_GOOG_ACL.public_read eg.
         '''
         
+        goog_headers = {}
+        if x_goog_acl != X_GOOG_ACL.private:
+            goog_headers['acl'] = x_goog_acl
+            
+        size = os.path.getsize(filename)
+        resumable = resumable_threshold is not None and size >= max(resumable_threshold, 1)
+        if not resumable and size >= self.pipeline_threshold and \
+            (not encrypt or encryptor is not None):
+            self._upload_by_pipeline(filename, bucket_name, obj_name, goog_headers,
+                                     encryptor if encrypt else None)
+            return
+        
         fp = open(filename, 'rb')
         try:
-            goog_headers = {}
-            if x_goog_acl != X_GOOG_ACL.private:
-                goog_headers['acl'] = x_goog_acl
+            if resumable:
+                source = fp
+                if encrypt and encrypt_func is not None:
+                    # the encryption is the same each time, so the session can continue.
+                    source = StringIO(encrypt_func(fp.read()))
+                self.upload_resumable(source, bucket_name, obj_name, goog_headers, 
+                                      sessions, version=int(os.path.getmtime(filename)))
+                return
                 
             data = fp.read()
             if encrypt and encrypt_func is not None:
@@ -654,25 +977,53 @@ class GSClient(object):
             fp.close()
             
     def download_file(self, filename, bucket_name, obj_name, 
-                      decrypt=False, decrypt_func=None):
+                      decrypt=False, decrypt_func=None, if_none_match=None, decryptor=None):
         '''
         Download the object in Google Cloud Storage to the local file.
         
         :param filename: the absolute path of the local file.
         :param bucket_name: name of the bucket which file puts into.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param if_none_match(optional): the ETag of the local file, 
+                                        if the object's ETag is the same, the file will not be written.
+        :param decryptor(optional): the function returns an object decrypts by chunks,
+                                    DES.decryptor eg, required to decrypt by the pipeline.
+        
+        :return: True if the file is written, False if the object is not modified.
         '''
         
-        fp = open(filename, 'wb')
+        headers = get_conditional_headers(if_none_match)
+        req = GSRequest(self.access_key, self.secret_key, self.project_id, 'GET',
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        
+        def _action():
+            # the response is read after submitted, so the whole transfer is retried instead.
+            resp, resp_headers = req.submit(try_times=1, include_headers=True, stream=True)
+            fp = open(filename, 'wb')
+            try:
+                size = int(resp_headers.get('content-length', 0))
+                if size >= self.pipeline_threshold and \
+                    (not decrypt or decryptor is not None):
+                    self.last_utilization = download_by_pipeline(
+                        resp, fp, decryptor() if decrypt else None,
+                        self.pipeline_depth, self.pipeline_chunk_size)
+                    return
+                
+                data = resp.read()
+                if decrypt and decrypt_func is not None:
+                    data = decrypt_func(data)
+                fp.write(data)
+            finally:
+                fp.close()
+                resp.close()
+        
         try:
-            data = self.get_object(bucket_name, obj_name).data
-            
-            if decrypt and decrypt_func is not None:
-                data = decrypt_func(data)
-            
-            fp.write(data)
-        finally:
-            fp.close()
+            get_retry_policy().call(_action)
+        except GSError, e:
+            if e.err_no == 304:
+                return False
+            raise e
+        return True
     
 class CryptoGSClient(GSClient):
     '''
@@ -696,16 +1047,19 @@ class CryptoGSClient(GSClient):
         self.IV = IV
         self.des = DES(IV)
         
-    def upload_file(self, filename, bucket_name, obj_name, x_goog_acl=X_GOOG_ACL.private, encrypt=True):
+    def upload_file(self, filename, bucket_name, obj_name, x_goog_acl=X_GOOG_ACL.private, encrypt=True,
+                    resumable_threshold=None, sessions=None):
         if not hasattr(self, 'IV'):
             raise GSError(-1, msg='You haven\'t set the IV(8 length)')
         
         super(CryptoGSClient, self).upload_file(filename, bucket_name, obj_name, x_goog_acl,
-                                                encrypt, self.des.encrypt)
+                                                encrypt, self.des.encrypt, 
+                                                resumable_threshold, sessions, self.des.encryptor)
         
-    def download_file(self, filename, bucket_name, obj_name, decrypt=True):
+    def download_file(self, filename, bucket_name, obj_name, decrypt=True, if_none_match=None):
         if not hasattr(self, 'IV'):
             raise S3Error(-1, msg='You haven\'t set the IV(8 length)')
         
-        super(CryptoGSClient, self).download_file(filename, bucket_name, obj_name,
-                                                  decrypt, self.des.decrypt)
\ No newline at end of file
+        return super(CryptoGSClient, self).download_file(filename, bucket_name, obj_name,
+                                                         decrypt, self.des.decrypt, if_none_match,
+                                                         self.des.decryptor)
\ No newline at end of file
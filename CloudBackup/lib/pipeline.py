@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+
+@author: Chine
+'''
+
+__author__ = "Chine King"
+__description__ = "Overlap the stages of a transfer chunk by chunk"
+
+import time
+import hashlib
+import threading
+from Queue import Queue, Empty, Full
+
+# the files smaller than it are transfered as a whole, the threads cost more than they save.
+DEFAULT_PIPELINE_THRESHOLD = 4 * 1024 * 1024
+DEFAULT_QUEUE_DEPTH = 4
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_POLL_INTERVAL = 0.5
+
+_END = object()
+
+def iter_file(fp, chunk_size=DEFAULT_CHUNK_SIZE):
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+class PipelineStage(object):
+    '''
+    A stage transforms each chunk, encrypt eg.
+    
+    :param name: the name in the utilization readout.
+    :param func: called with each chunk, returns the transformed chunk.
+    :param flush(optional): called at the end, returns the rest, the padding of encryption eg.
+    '''
+    
+    def __init__(self, name, func, flush=None):
+        self.name = name
+        self.func = func
+        self.flush = flush
+
+class _StageTimer(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.waited = 0
+    
+    def utilization(self):
+        if self.start is None:
+            return 0
+        elapsed = (self.end or time.time()) - self.start
+        if elapsed <= 0:
+            return 0
+        return max(0, min(1, (elapsed - self.waited) / elapsed))
+
+class Pipeline(object):
+    '''
+    Run the source and each stage in its own thread, connected by the bounded queues,
+    so that the disk, cpu and network work at the same time,
+    and the throughput approaches the slowest stage.
+    
+    Usage:
+    pipeline = Pipeline(iter_file(fp), [PipelineStage('encrypt', enc.update, enc.final)],
+                        sink_name='upload')
+    for chunk in pipeline:
+        send(chunk)
+    print pipeline.utilization()
+    '''
+    
+    def __init__(self, source, stages=(), depth=DEFAULT_QUEUE_DEPTH,
+                 source_name='read', sink_name='write'):
+        '''
+        :param source: an iterable of the chunks.
+        :param stages(optional): list of PipelineStage.
+        :param depth(optional): the max chunks waiting between two stages.
+        :param source_name(optional): the name of the source in the utilization readout.
+        :param sink_name(optional): the name of the consumer in the utilization readout.
+        '''
+        
+        self.source = source
+        self.stages = list(stages)
+        self.depth = max(depth, 1)
+        
+        self.timers = [_StageTimer(source_name)] + \
+                      [_StageTimer(stage.name) for stage in self.stages] + \
+                      [_StageTimer(sink_name)]
+        self.queues = [Queue(self.depth) for _ in range(len(self.stages) + 1)]
+        
+        self.stopped = threading.Event()
+        self.error = None
+        self.threads = []
+    
+    def _put(self, queue, timer, item):
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    queue.put(item, timeout=DEFAULT_POLL_INTERVAL)
+                    return True
+                except Full:
+                    continue
+            return False
+        finally:
+            timer.waited += time.time() - start
+    
+    def _get(self, queue, timer):
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    return queue.get(timeout=DEFAULT_POLL_INTERVAL)
+                except Empty:
+                    continue
+            return _END
+        finally:
+            timer.waited += time.time() - start
+    
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        self.stopped.set()
+    
+    def _run_source(self):
+        timer, out_queue = self.timers[0], self.queues[0]
+        timer.start = time.time()
+        try:
+            for chunk in self.source:
+                if not self._put(out_queue, timer, chunk):
+                    return
+            self._put(out_queue, timer, _END)
+        except Exception, e:
+            self._fail(e)
+        finally:
+            timer.end = time.time()
+    
+    def _run_stage(self, i):
+        stage, timer = self.stages[i], self.timers[i+1]
+        in_queue, out_queue = self.queues[i], self.queues[i+1]
+        timer.start = time.time()
+        try:
+            while True:
+                chunk = self._get(in_queue, timer)
+                if chunk is _END:
+                    break
+                chunk = stage.func(chunk)
+                if chunk and not self._put(out_queue, timer, chunk):
+                    return
+            
+            if stage.flush is not None and not self.stopped.is_set():
+                chunk = stage.flush()
+                if chunk and not self._put(out_queue, timer, chunk):
+                    return
+            self._put(out_queue, timer, _END)
+        except Exception, e:
+            self._fail(e)
+        finally:
+            timer.end = time.time()
+    
+    def start(self):
+        targets = [(self._run_source, ())] + \
+                  [(self._run_stage, (i, )) for i in range(len(self.stages))]
+        for target, args in targets:
+            thread = threading.Thread(target=target, args=args)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def __iter__(self):
+        if not self.threads:
+            self.start()
+        
+        timer, in_queue = self.timers[-1], self.queues[-1]
+        timer.start = time.time()
+        try:
+            while True:
+                # the time between two gets is the consumer's own work.
+                chunk = self._get(in_queue, timer)
+                if chunk is _END:
+                    break
+                yield chunk
+        finally:
+            timer.end = time.time()
+            self.stop()
+        
+        if self.error is not None:
+            raise self.error
+    
+    def utilization(self):
+        '''
+        :return: list of (stage name, the ratio of time the stage is busy),
+                 the stage near 1 is the bottleneck.
+        '''
+        
+        return [(timer.name, timer.utilization()) for timer in self.timers]
+
+class PipelineFile(object):
+    '''
+    A file-like object reads the output of a pipeline, the body of a request eg.
+    The md5 of the content read is calculated at the same time.
+    '''
+    
+    def __init__(self, pipeline, size, md5_func=None):
+        '''
+        :param pipeline: an instance of Pipeline.
+        :param size: the total size of the output, known in advance.
+        :param md5_func(optional): the md5 object, hashlib.md5() eg.
+        '''
+        
+        self.pipeline = pipeline
+        self.size = size
+        self.md5 = md5_func
+        
+        self.chunks = iter(pipeline)
+        self.chunk = ''
+        self.pos = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def read(self, size=-1):
+        parts = []
+        while size < 0 or size > 0:
+            if self.pos >= len(self.chunk):
+                try:
+                    self.chunk, self.pos = self.chunks.next(), 0
+                except StopIteration:
+                    break
+            
+            # the chunk is sliced by the position, never copied as a whole.
+            if size < 0:
+                part = self.chunk[self.pos:]
+            else:
+                part = self.chunk[self.pos:self.pos+size]
+                size -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        
+        data = ''.join(parts)
+        if self.md5 is not None:
+            self.md5.update(data)
+        return data
+    
+    def close(self):
+        self.pipeline.stop()
+
+def upload_by_pipeline(fp, size, send, encryptor=None,
+                       depth=DEFAULT_QUEUE_DEPTH, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Read, encrypt and send a file at the same time.
+    
+    :param fp: the local file.
+    :param size: the size of the content sent, after encrypted.
+    :param send: called with the body, a file-like object, returns the ETag.
+    :param encryptor(optional): the object encrypts by chunks, has update and final.
+    
+    :return 0: the md5 of the content sent.
+    :return 1: the ETag returned by send.
+    :return 2: the utilization of the stages.
+    '''
+    
+    fp.seek(0)
+    stages = []
+    if encryptor is not None:
+        stages.append(PipelineStage('encrypt', encryptor.update, encryptor.final))
+    
+    pipeline = Pipeline(iter_file(fp, chunk_size), stages, depth, 'read', 'upload')
+    body = PipelineFile(pipeline, size, hashlib.md5())
+    try:
+        etag = send(body)
+    finally:
+        body.close()
+    
+    return body.md5.hexdigest(), etag, pipeline.utilization()
+
+def download_by_pipeline(resp, fp, decryptor=None,
+                         depth=DEFAULT_QUEUE_DEPTH, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Receive, decrypt and write a file at the same time.
+    
+    :param resp: the response, a file-like object.
+    :param fp: the local file.
+    :param decryptor(optional): the object decrypts by chunks, has update and final.
+    
+    :return: the utilization of the stages.
+    '''
+    
+    stages = []
+    if decryptor is not None:
+        stages.append(PipelineStage('decrypt', decryptor.update, decryptor.final))
+    
+    pipeline = Pipeline(iter_file(resp, chunk_size), stages, depth, 'receive', 'write')
+    for chunk in pipeline:
+        fp.write(chunk)
+    return pipeline.utilization()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+
+@author: Chine
+'''
+
+__author__ = "Chine King"
+__description__ = "The retry policy shared by the CloudBackup libraries"
+
+import time
+import random
+import socket
+import httplib
+import urllib2
+import threading
+
+from errors import VdiskError, S3Error, CircuitOpenError
+
+DEFAULT_MAX_TRIES = 4
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_THROTTLE_DELAY = 5
+DEFAULT_MAX_DELAY = 60
+
+# a retry costs a token, and each request earns a part of one,
+# so the retries are at most about 10 percent of the requests,
+# besides a few per second which keep the rare failures retried.
+DEFAULT_BUDGET_RATIO = 0.1
+DEFAULT_BUDGET_MIN_PER_SEC = 0.5
+DEFAULT_BUDGET_MAX_TOKENS = 20
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+# 900 means too many requests in a minute, 5 and 6 happen when vdisk is busy uploading.
+VDISK_THROTTLE_ERRORS = (900, )
+VDISK_RETRY_ERRORS = (5, 6)
+S3_THROTTLE_CODES = ('SlowDown', 'Throttling', 'RequestLimitExceeded')
+S3_RETRY_CODES = ('RequestTimeout', 'InternalError', 'ServiceUnavailable')
+
+NOT_RETRY = 0
+RETRY = 1
+THROTTLE = 2
+
+def classify(e):
+    '''
+    Classify an error raised by a request.
+    
+    :return: NOT_RETRY if the request will fail again,
+             RETRY if the error is transient, THROTTLE if the server asks to slow down.
+    '''
+    
+    if isinstance(e, VdiskError):
+        if e.err_no in VDISK_THROTTLE_ERRORS:
+            return THROTTLE
+        if e.err_no in VDISK_RETRY_ERRORS:
+            return RETRY
+        return NOT_RETRY
+    
+    if isinstance(e, S3Error):
+        if e.err_no == -1 and getattr(e, 'cause', None) is not None:
+            # the connection fails.
+            return classify(e.cause)
+        code = getattr(e, 'code', None)
+        if e.err_no == 503 or code in S3_THROTTLE_CODES:
+            return THROTTLE
+        if 500 <= e.err_no < 600 or e.err_no == 408 or code in S3_RETRY_CODES:
+            return RETRY
+        return NOT_RETRY
+    
+    if isinstance(e, urllib2.HTTPError):
+        if e.code in (429, 503):
+            return THROTTLE
+        if 500 <= e.code < 600 or e.code == 408:
+            return RETRY
+        return NOT_RETRY
+    
+    # the connection is refused or reset, the dns fails, or the response is broken.
+    if isinstance(e, (urllib2.URLError, socket.error, httplib.HTTPException)):
+        return RETRY
+    
+    return NOT_RETRY
+
+class RetryBudget(object):
+    '''
+    Limit the retries of all the requests as a token bucket,
+    so that an outage of the server will not be amplified by the retries.
+    '''
+    
+    def __init__(self, ratio=DEFAULT_BUDGET_RATIO, min_per_sec=DEFAULT_BUDGET_MIN_PER_SEC,
+                 max_tokens=DEFAULT_BUDGET_MAX_TOKENS):
+        '''
+        :param ratio(optional): the tokens each request earns.
+        :param min_per_sec(optional): the tokens earned each second even if no request.
+        :param max_tokens(optional): the max tokens can be saved.
+        '''
+        
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.max_tokens = max_tokens
+        
+        self.tokens = max_tokens
+        self.last = time.time()
+        self.lock = threading.Lock()
+    
+    def _refill(self, tokens):
+        now = time.time()
+        tokens += (now - self.last) * self.min_per_sec
+        self.last = now
+        self.tokens = min(self.max_tokens, self.tokens + tokens)
+    
+    def deposit(self):
+        self.lock.acquire()
+        try:
+            self._refill(self.ratio)
+        finally:
+            self.lock.release()
+    
+    def withdraw(self):
+        '''
+        :return: True if the retry is allowed.
+        '''
+        
+        self.lock.acquire()
+        try:
+            self._refill(0)
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+        finally:
+            self.lock.release()
+
+class CircuitBreaker(object):
+    '''
+    Refuse the requests to an endpoint for a while after it fails in succession,
+    then let one request through to check if it recovers.
+    '''
+    
+    CLOSED, OPEN, HALF_OPEN = range(3)
+    
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+    
+    def retry_after(self):
+        return max(0, self.opened + self.reset_timeout - time.time())
+    
+    def allow(self):
+        self.lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.retry_after() <= 0:
+                # only the first request after the timeout is let through.
+                self.state = self.HALF_OPEN
+                return True
+            return False
+        finally:
+            self.lock.release()
+    
+    def record_success(self):
+        self.lock.acquire()
+        try:
+            self.state = self.CLOSED
+            self.failures = 0
+        finally:
+            self.lock.release()
+    
+    def record_failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened = time.time()
+        finally:
+            self.lock.release()
+
+class RetryPolicy(object):
+    '''
+    Retry the transient errors with capped exponential backoff and full jitter.
+    The budget of the retries and the circuit breakers are shared by all the calls.
+    
+    Usage:
+    policy = RetryPolicy()
+    result = policy.call(func, 's3.amazonaws.com')
+    '''
+    
+    def __init__(self, max_tries=DEFAULT_MAX_TRIES, base_delay=DEFAULT_BASE_DELAY,
+                 throttle_delay=DEFAULT_THROTTLE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 budget=None, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        '''
+        :param max_tries(optional): the max times a call is tried.
+        :param base_delay(optional): the delay before the first retry of a transient error.
+        :param throttle_delay(optional): the delay before the first retry if throttled.
+        :param max_delay(optional): the cap of the delay.
+        :param budget(optional): an instance of RetryBudget.
+        :param failure_threshold(optional): the failures in succession which open the circuit.
+        :param reset_timeout(optional): the seconds the circuit keeps open.
+        '''
+        
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+        
+        self.sleep = time.sleep
+    
+    def get_breaker(self, endpoint):
+        self.lock.acquire()
+        try:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(self.failure_threshold,
+                                                         self.reset_timeout)
+            return self.breakers[endpoint]
+        finally:
+            self.lock.release()
+    
+    def get_delay(self, tries, kind, base_delay=None):
+        if base_delay is None:
+            base_delay = self.throttle_delay if kind == THROTTLE else self.base_delay
+        cap = min(self.max_delay, base_delay * (2 ** (tries - 1)))
+        return random.uniform(0, cap)
+    
+    def call(self, func, endpoint=None, tries=None, base_delay=None):
+        '''
+        Call the func, and retry it if a transient error raises.
+        
+        :param func: the function without arguments.
+        :param endpoint(optional): the host which the func requests,
+                                   the circuit breaker is per endpoint.
+        :param tries(optional): the max times to try instead of the policy's.
+        :param base_delay(optional): the delay of the first retry instead of the policy's.
+        
+        :return: the result of the func, the last error raises if all the tries fail.
+        '''
+        
+        max_tries = tries or self.max_tries
+        breaker = self.get_breaker(endpoint) if endpoint is not None else None
+        
+        self.budget.deposit()
+        tried = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(endpoint, breaker.retry_after())
+            
+            tried += 1
+            try:
+                result = func()
+            except Exception, e:
+                kind = classify(e)
+                if kind == NOT_RETRY:
+                    # the server responses, so the endpoint is available.
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise
+                
+                if breaker is not None:
+                    breaker.record_failure()
+                if tried >= max_tries or not self.budget.withdraw():
+                    raise
+                self.sleep(self.get_delay(tried, kind, base_delay))
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+default_policy = RetryPolicy()
+
+def get_retry_policy():
+    return default_policy
+
+def set_retry_policy(policy):
+    global default_policy
+    default_policy = policy
@@ -20,22 +20,33 @@ Created on 2012-4-20
 @author: Chine
 '''
 
+import os
 import datetime
+import urllib
 import urllib2
 import time
+import socket
+import httplib
 import mimetypes
+from xml.sax.saxutils import escape
 
 from errors import S3Error
 from utils import XML, hmac_sha1, calc_md5, iterable
 from crypto import DES
+from retry import get_retry_policy
+from bandwidth import throttle_upload, throttle_download
+from pipeline import (DEFAULT_PIPELINE_THRESHOLD, DEFAULT_QUEUE_DEPTH, DEFAULT_CHUNK_SIZE,
+                      upload_by_pipeline, download_by_pipeline)
 
 __author__ = "Chine King"
 __description__ = "A client for Amazon S3 api, site: http://aws.amazon.com/documentation/s3/"
 __all__ = ['get_end_point', 'X_AMZ_ACL', 'REGION', 'ACL_PERMISSION', 'ALL_USERS_URI',
+           'MAX_DELETE_OBJECTS',
            'S3AclGrantByPersonID', 'S3AclGrantByEmail', 'S3AclGrantByURI',
-           'S3Bucket', 'S3Object', 'AmazonUser', 'S3Client', 'CryptoS3Client']
+           'S3Bucket', 'S3Object', 'S3ObjectRecord', 'S3BucketListing', 'AmazonUser', 
+           'S3Client', 'CryptoS3Client']
 
-ACTION_TYPES = ('PUT', 'GET', 'DELETE')
+ACTION_TYPES = ('PUT', 'GET', 'DELETE', 'POST', 'HEAD')
 GMT_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
 STRING_TO_SIGN = '''%(action)s
 %(content_md5)s
@@ -43,6 +54,15 @@ STRING_TO_SIGN = '''%(action)s
 %(date)s
 %(c_amz_headers)s%(c_resource)s'''
 ALL_USERS_URI = 'http://acs.amazonaws.com/groups/global/AllUsers'
+MAX_DELETE_OBJECTS = 1000
+DELETE_OBJECTS = '''<?xml version="1.0" encoding="UTF-8"?>
+<Delete>
+  <Quiet>%(quiet)s</Quiet>
+%(objects)s
+</Delete>'''
+DELETE_OBJECT = '''  <Object>
+    <Key>%(key)s</Key>
+  </Object>'''
 ACL = '''<AccessControlPolicy>
   <Owner>
     <ID>%(owner_id)s</ID>
@@ -72,6 +92,28 @@ GRANT_BY_URI = '''    <Grant>
       <Permission>%(user_permission)s</Permission>
     </Grant>'''
 
+def get_conditional_headers(if_none_match=None, if_modified_since=None):
+    '''
+    Get the headers of the conditional request.
+    
+    :param if_none_match(optional): the ETag, the object is returned only if its ETag differs.
+    :param if_modified_since(optional): the timestamp or the datetime, 
+                                        the object is returned only if modified after it.
+    '''
+    
+    headers = {}
+    if if_none_match is not None:
+        if not if_none_match.startswith('"'):
+            if_none_match = '"%s"' % if_none_match
+        headers['If-None-Match'] = if_none_match
+    if if_modified_since is not None:
+        if isinstance(if_modified_since, (int, long, float)):
+            if_modified_since = datetime.datetime.utcfromtimestamp(if_modified_since)
+        if isinstance(if_modified_since, datetime.datetime):
+            if_modified_since = if_modified_since.strftime(GMT_FORMAT)
+        headers['If-Modified-Since'] = if_modified_since
+    return headers
+
 end_point = "http://s3.amazonaws.com"
 def get_end_point(bucket_name=None, obj_name=None, http=False):
     prefix = 'http://' if http else ''
@@ -243,6 +285,84 @@ class S3Object(S3Base):
                 
         return obj
 
+class S3ObjectRecord(object):
+    '''
+    A compact record of an object in the bucket listing.
+    '''
+    
+    __slots__ = ('key', 'last_modified', 'etag', 'size', 'storage_class', 'owner')
+    
+    mapping = {'Key': 'key',
+               'LastModified': 'last_modified',
+               'ETag': 'etag',
+               'Size': 'size',
+               'StorageClass': 'storage_class'}
+    
+    def __init__(self, key=None, last_modified=None, etag=None, size=None,
+                 storage_class=None, owner=None):
+        self.key = key
+        self.last_modified = last_modified
+        self.etag = etag
+        self.size = size
+        self.storage_class = storage_class
+        self.owner = owner
+        
+    @classmethod
+    def from_xml(cls, tree):
+        obj = cls()
+        
+        for tag in tree:
+            attr = cls.mapping.get(tag.tag)
+            if attr is not None:
+                setattr(obj, attr, tag.text)
+            elif tag.tag == 'Owner':
+                obj.owner = AmazonUser.from_xml(tag)
+                
+        return obj
+    
+class S3BucketListing(object):
+    '''
+    A page of the bucket listing, parsed incrementally.
+    
+    Iterate it to get the objects(S3ObjectRecord instances), 
+    each one is yielded as soon as it is parsed. 
+    The properties common_prefix, has_next and next_marker
+    are complete when the iteration ends.
+    '''
+    
+    record_cls = S3ObjectRecord
+    tags = ('Contents', 'CommonPrefixes', 'IsTruncated', 'NextMarker')
+    
+    def __init__(self, source):
+        '''
+        :param source: the response(a file-like object) or the xml string.
+        '''
+        
+        self.source = source
+        self.common_prefix = []
+        self.has_next = False
+        self.next_marker = None
+        self.last_key = None
+        
+    def __iter__(self):
+        try:
+            for tag, ele in XML.iterparse(self.source, self.tags):
+                if tag == 'Contents':
+                    obj = self.record_cls.from_xml(ele)
+                    self.last_key = obj.key
+                    yield obj
+                elif tag == 'CommonPrefixes':
+                    prefix = ele.find('Prefix')
+                    if hasattr(prefix, 'text'):
+                        self.common_prefix.append(prefix.text)
+                elif tag == 'IsTruncated':
+                    self.has_next = ele.text == 'true'
+                elif tag == 'NextMarker':
+                    self.next_marker = ele.text
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+
 class AmazonUser(object):
     mapping = {'id_': 'ID',
                'display_name': 'DisplayName',
@@ -277,11 +397,14 @@ class AmazonUser(object):
         return user
 
 class S3Request(object):
+    # the name of the cloud shares the bandwidth.
+    provider = 's3'
+    
     def __init__(self, access_key, secret_access_key, 
                  action, bucket_name=None, obj_name=None,
-                 data=None, content_type=None, metadata={}, amz_headers={} ):
+                 data=None, content_type=None, metadata={}, amz_headers={}, headers={}):
         
-        assert action in ACTION_TYPES # action must be PUT, GET and DELETE.
+        assert action in ACTION_TYPES # action must be PUT, GET, DELETE, POST and HEAD.
         
         self.access_key = access_key
         self.secret_key = secret_access_key
@@ -296,6 +419,7 @@ class S3Request(object):
         
         self.metadata = metadata
         self.amz_headers = amz_headers
+        self.headers = headers
         
         self.date_str = self._get_date_str()
         
@@ -355,9 +479,15 @@ class S3Request(object):
         headers = { 
                    'Date': self.date_str
                    }
-        if self.data:
+        if hasattr(self.data, 'read'):
+            # the content is streamed, so its md5 is checked by the ETag after sent.
+            headers['Content-Length'] = len(self.data)
+        elif self.data:
             headers['Content-Length'] = len(self.data)
             headers['Content-MD5'] = calc_md5(self.data)
+        elif self.action in ('PUT', 'POST'):
+            # S3 requires the length even if there is no content, when copy object eg.
+            headers['Content-Length'] = 0
             
         if self.content_type is not None:
             headers['Content-Type'] = self.content_type
@@ -369,36 +499,69 @@ class S3Request(object):
             headers['x-amz-meta-' + k] = v
         for k, v in self.amz_headers.iteritems():
             headers['x-amz-' + k] = v
+        headers.update(self.headers)
             
         headers['Authorization'] = self._get_authorization(headers)
         return headers
     
-    def submit(self, try_times=3, try_interval=3, callback=None, include_headers=False):
+    def submit(self, try_times=None, try_interval=None, callback=None, include_headers=False,
+               stream=False):
+        '''
+        Submit the request.
+        
+        :param try_times(optional): the max times to try, the retry policy's as default.
+        :param try_interval(optional): the delay before the first retry, 
+                                       it doubles for each retry, with a random jitter.
+        :param stream(optional): if True, the response(a file-like object) is returned
+                                 or passed to the callback instead of the content,
+                                 so that it can be read incrementally.
+        '''
+        
         def _get_data():
+            # the date is signed, so it's renewed for each try.
+            self.date_str = self._get_date_str()
             headers = self.get_headers()
             try:
                 opener = urllib2.build_opener(urllib2.HTTPHandler)
-                req = urllib2.Request(self.end_point, data=self.data, headers=headers)
+                data = throttle_upload(self.data, self.provider)
+                req = urllib2.Request(self.end_point, data=data, headers=headers)
                 req.get_method = lambda: self.action
-                resp = opener.open(req)
+                resp = throttle_download(opener.open(req), self.provider)
                 
+                if stream:
+                    if include_headers:
+                        return resp, resp.headers.dict
+                    return resp
                 if include_headers:
                     return resp.read(), resp.headers.dict
                 return resp.read()
             except urllib2.HTTPError, e:
-                tree = XML.loads(e.read())
-                raise S3Error(e.code, tree)
+                content = e.read()
+                if not content:
+                    # the response of HEAD and 304 Not Modified has no content.
+                    error = S3Error(e.code, msg=e.msg)
+                else:
+                    error = S3Error(e.code, XML.loads(content))
+                # some status need the headers, the Range of 308 Resume Incomplete eg.
+                error.headers = e.headers.dict if e.headers is not None else {}
+                raise error
             
-        for i in range(try_times):
-            try:
-                if include_headers and callback:
-                    data, headers = _get_data()
-                    return callback(data, headers)
-                if callback:
-                    return callback(_get_data())
-                return _get_data()
-            except urllib2.URLError:
-                time.sleep(try_interval)
+        def _action():
+            if include_headers and callback:
+                data, headers = _get_data()
+                return callback(data, headers)
+            if callback:
+                return callback(_get_data())
+            return _get_data()
+        
+        try:
+            return get_retry_policy().call(_action, self.host, 
+                                           tries=try_times, base_delay=try_interval)
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            error = S3Error(-1, msg='Can\'t connect to server: %s' % e)
+            # kept so that the error can be classified by the retry policy.
+            error.cause = e
+            raise error
 
 class S3Client(object):
     '''
@@ -408,8 +571,17 @@ class S3Client(object):
     client = S3Client('your_access_key', 'your_secret_access_key') # init
     client.upload_file('/local_path/file_name', 'my_bucket_name', 'my_folder/file_name') 
     # call the Amazon S3 api
+    
+    The files not smaller than pipeline_threshold are read, encrypted and transfered
+    at the same time, chunk by chunk, and the utilization of each stage 
+    is kept in last_utilization after the transfer.
     '''
     
+    pipeline_threshold = DEFAULT_PIPELINE_THRESHOLD
+    pipeline_depth = DEFAULT_QUEUE_DEPTH
+    pipeline_chunk_size = DEFAULT_CHUNK_SIZE
+    last_utilization = None
+    
     def __init__(self, access_key, secret_access_key, 
                  canonical_user_id=None, user_display_name=None):
         self.access_key = access_key
@@ -513,24 +685,11 @@ class S3Client(object):
         return req.submit()
         
     
-    def _parse_get_bucket(self, data):
-        tree = XML.loads(data)
-        bucket = S3Bucket.from_xml(tree)
-        has_next = True if bucket.is_truncated == 'true' else False
-        
-        objs = []
-        for ele in tree.findall('Contents'):
-            obj = S3Object.from_xml(ele)
-            obj.bucket = bucket
-            objs.append(obj)
-            
-        common_prefix = []
-        for ele in tree.findall('CommonPrefixes'):
-            prefix = ele.find('Prefix')
-            if hasattr(prefix, 'text'):
-                common_prefix.append(prefix.text)
+    def _parse_get_bucket(self, source):
+        listing = S3BucketListing(source)
+        objs = list(listing)
             
-        return objs, common_prefix, has_next
+        return objs, listing.common_prefix, listing.has_next
     
     def get_bucket(self, bucket_name, **kwargs):
         '''
@@ -538,10 +697,26 @@ class S3Client(object):
         
         :param bucket_name
         
-        :return 0: list of objects in the bucket, each one is an instance of S3Object.
+        :return 0: list of objects in the bucket, each one is an instance of S3ObjectRecord.
         :return 1: the common prefix list, always when prefix parameter in kwargs.
         :return 2: if has next objects.
         '''
+        
+        req = self._get_bucket_request(bucket_name, **kwargs)
+        return req.submit(stream=True, callback=self._parse_get_bucket)
+    
+    def iter_bucket(self, bucket_name, **kwargs):
+        '''
+        List objects in the bucket by the bucket's name, the params are the same as get_bucket.
+        
+        :return: an instance of S3BucketListing, 
+                 the objects are parsed while iterating it, as the response arrives.
+        '''
+        
+        req = self._get_bucket_request(bucket_name, **kwargs)
+        return req.submit(stream=True, callback=S3BucketListing)
+    
+    def _get_bucket_request(self, bucket_name, **kwargs):
         args = {}
         for k in ('delimiter', 'marker', 'prefix'):
             v = kwargs.pop(k, None)
@@ -557,9 +732,8 @@ class S3Client(object):
         else:
             param = '?' + param
         
-        req = S3Request(self.access_key, self.secret_key, 'GET',
-                        bucket_name=bucket_name, obj_name=param)
-        return req.submit(callback=self._parse_get_bucket)
+        return S3Request(self.access_key, self.secret_key, 'GET',
+                         bucket_name=bucket_name, obj_name=param)
     
     def _parse_get_acl(self, data):
         tree = XML.loads(data)
@@ -653,19 +827,57 @@ class S3Client(object):
         return req.submit()
         
     
-    def get_object(self, bucket_name, obj_name):
+    def get_object(self, bucket_name, obj_name, if_none_match=None, if_modified_since=None,
+                   byte_range=None):
         '''
         Get object.
         
         :param bucket_name: the bucket contains the object.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param if_none_match(optional): the ETag, return the object only if its ETag differs.
+        :param if_modified_since(optional): the timestamp or the datetime, 
+                                            return the object only if modified after it.
+        :param byte_range(optional): tuple of (the first byte, the last byte), both included,
+                                     only the range of the content is returned.
         
         :return: instance of S3Object, the 'data' property is the content of the object.
+                 None if the object is not modified by the conditions.
         '''
         
+        headers = get_conditional_headers(if_none_match, if_modified_since)
+        if byte_range is not None:
+            headers['Range'] = 'bytes=%d-%d' % tuple(byte_range)
         req = S3Request(self.access_key, self.secret_key, 'GET',
-                        bucket_name=bucket_name, obj_name=obj_name)
-        return req.submit(include_headers=True, callback=lambda data, headers: S3Object(data=data, **headers))
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        try:
+            return req.submit(include_headers=True, callback=lambda data, headers: S3Object(data=data, **headers))
+        except S3Error, e:
+            if e.err_no == 304:
+                return
+            raise e
+    
+    def head_object(self, bucket_name, obj_name, if_none_match=None, if_modified_since=None):
+        '''
+        Get the metadata of the object without its content.
+        
+        :param bucket_name: the bucket contains the object.
+        :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param if_none_match(optional): the ETag, return the metadata only if the ETag differs.
+        :param if_modified_since(optional): the timestamp or the datetime, 
+                                            return the metadata only if modified after it.
+        
+        :return: an instance of S3Object, None if the object is not modified by the conditions.
+        '''
+        
+        headers = get_conditional_headers(if_none_match, if_modified_since)
+        req = S3Request(self.access_key, self.secret_key, 'HEAD',
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        try:
+            return req.submit(include_headers=True, callback=lambda data, headers: S3Object(**headers))
+        except S3Error, e:
+            if e.err_no == 304:
+                return
+            raise e
     
     def get_object_acl(self, bucket_name, obj_name):
         req = S3Request(self.access_key, self.secret_key, 'GET',
@@ -684,8 +896,145 @@ class S3Client(object):
                         bucket_name=bucket_name, obj_name=obj_name)
         return req.submit()
     
+    def _parse_copy_object(self, data):
+        tree = XML.loads(data)
+        
+        # the copy may fail after the response status 200 is sent,
+        # in this case, the error is in the content.
+        if tree.tag == 'Error':
+            raise S3Error(200, tree)
+        
+        return S3Object.from_xml(tree)
+    
+    def copy_object(self, src_bucket_name, src_obj_name, bucket_name, obj_name,
+                    metadata=None, amz_headers={}):
+        '''
+        Copy object in the server side, the content is not transfered by the client.
+        
+        :param src_bucket_name: the bucket contains the source object.
+        :param src_obj_name: the source object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param bucket_name: the bucket which the object copies to.
+        :param obj_name: the new object's name.
+        :param metadata(optional): if None, the metadata of the source object is copied,
+                                   else replaced by the metadata.
+        :param amz_header(optional): the extra headers which amazon defined.
+        
+        :return: instance of S3Object, with the properties etag and last_modified.
+        
+        You can refer to the document here:
+        http://docs.amazonwebservices.com/AmazonS3/latest/API/RESTObjectCOPY.html
+        '''
+        
+        if isinstance(src_obj_name, unicode):
+            src_obj_name = src_obj_name.encode('utf-8')
+        
+        amz_headers = dict(amz_headers)
+        amz_headers['copy-source'] = urllib.quote('/%s/%s' % (src_bucket_name, src_obj_name))
+        if metadata is not None:
+            amz_headers['metadata-directive'] = 'REPLACE'
+        else:
+            metadata = {}
+        
+        req = S3Request(self.access_key, self.secret_key, 'PUT',
+                        bucket_name=bucket_name, obj_name=obj_name,
+                        metadata=metadata, amz_headers=amz_headers)
+        return req.submit(callback=self._parse_copy_object)
+    
+    def move_object(self, src_bucket_name, src_obj_name, bucket_name, obj_name):
+        '''
+        Move object in the server side, by copying it and deleting the source.
+        
+        :param src_bucket_name: the bucket contains the source object.
+        :param src_obj_name: the source object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param bucket_name: the bucket which the object moves to.
+        :param obj_name: the new object's name.
+        
+        :return: instance of S3Object, with the properties etag and last_modified.
+        '''
+        
+        obj = self.copy_object(src_bucket_name, src_obj_name, bucket_name, obj_name)
+        self.delete_object(src_bucket_name, src_obj_name)
+        return obj
+    
+    def _parse_delete_objects(self, data):
+        tree = XML.loads(data)
+        
+        deleted = []
+        for ele in tree.findall('Deleted'):
+            key = ele.find('Key')
+            if hasattr(key, 'text'):
+                deleted.append(key.text)
+        
+        errors = []
+        for ele in tree.findall('Error'):
+            error = []
+            for tag_name in ('Key', 'Code', 'Message'):
+                tag = ele.find(tag_name)
+                error.append(tag.text if hasattr(tag, 'text') else None)
+            errors.append(tuple(error))
+            
+        return deleted, errors
+    
+    def delete_objects(self, bucket_name, obj_names, quiet=True):
+        '''
+        Delete multiple objects by one request.
+        
+        :param bucket_name: the bucket contains the objects.
+        :param obj_names: the objects' names, no more than 1000.
+        :param quiet(optional): if True, the response only contains the objects failed to delete.
+        
+        :return 0: the list of the objects' names deleted, always blank if quiet.
+        :return 1: the list of the objects failed to delete, 
+                   each one is a tuple of (obj_name, error_code, error_message).
+        
+        You can refer to the document here:
+        http://docs.amazonwebservices.com/AmazonS3/latest/API/multiobjectdeleteapi.html
+        '''
+        
+        if len(obj_names) > MAX_DELETE_OBJECTS:
+            raise S3Error(-1, msg='Can\'t delete more than %d objects by one request' 
+                          % MAX_DELETE_OBJECTS)
+        
+        objects = []
+        for obj_name in obj_names:
+            if isinstance(obj_name, unicode):
+                obj_name = obj_name.encode('utf-8')
+            objects.append(DELETE_OBJECT % {'key': escape(obj_name)})
+        data = DELETE_OBJECTS % {'quiet': 'true' if quiet else 'false',
+                                 'objects': '\n'.join(objects)}
+        
+        req = S3Request(self.access_key, self.secret_key, 'POST',
+                        bucket_name=bucket_name, obj_name='?delete', data=data)
+        return req.submit(callback=self._parse_delete_objects)
+    
+    def _upload_by_pipeline(self, filename, bucket_name, obj_name, amz_headers, encryptor=None):
+        size = os.path.getsize(filename)
+        if encryptor is not None:
+            size = DES.get_encrypted_size(size)
+            
+        def _send(body):
+            req = S3Request(self.access_key, self.secret_key, 'PUT',
+                            bucket_name=bucket_name, obj_name=obj_name, data=body,
+                            amz_headers=amz_headers)
+            # the body can't be read again, so the whole transfer is retried instead.
+            return req.submit(try_times=1, include_headers=True,
+                              callback=lambda data, headers: headers.get('etag', ''))
+        
+        fp = open(filename, 'rb')
+        def _action():
+            md5, etag, self.last_utilization = upload_by_pipeline(
+                fp, size, _send, encryptor() if encryptor is not None else None,
+                self.pipeline_depth, self.pipeline_chunk_size)
+            if etag.strip('"') != md5:
+                raise S3Error(-1, msg='The content of %s is broken while uploading.' % obj_name)
+        
+        try:
+            get_retry_policy().call(_action)
+        finally:
+            fp.close()
+    
     def upload_file(self, filename, bucket_name, obj_name, x_amz_acl=X_AMZ_ACL.private,
-                    encrypt=False, encrypt_func=None):
+                    encrypt=False, encrypt_func=None, encryptor=None):
         '''
         Upload a local file to the Amazon S3.
         
@@ -706,14 +1055,23 @@ class S3Client(object):
         
         The properties of X_AMZ_ACL stand for acl list above, X_AMZ_ACL.private eg.
         But notice that the '-' must be replaced with '_', X_AMZ_ACL.public_read eg.
+        
+        :param encryptor(optional): the function returns an object encrypts by chunks,
+                                    DES.encryptor eg, required to encrypt by the pipeline.
         '''
         
+        amz_headers = {}
+        if x_amz_acl != X_AMZ_ACL.private:
+            amz_headers['acl'] = x_amz_acl
+            
+        if os.path.getsize(filename) >= self.pipeline_threshold and \
+            (not encrypt or encryptor is not None):
+            self._upload_by_pipeline(filename, bucket_name, obj_name, amz_headers,
+                                     encryptor if encrypt else None)
+            return
+        
         fp = open(filename, 'rb')
         try:
-            amz_headers = {}
-            if x_amz_acl != X_AMZ_ACL.private:
-                amz_headers['acl'] = x_amz_acl
-                
             data = fp.read()
             if encrypt and encrypt_func is not None:
                 data = encrypt_func(data)
@@ -723,25 +1081,53 @@ class S3Client(object):
             fp.close()
             
     def download_file(self, filename, bucket_name, obj_name, 
-                      decrypt=False, decrypt_func=None):
+                      decrypt=False, decrypt_func=None, if_none_match=None, decryptor=None):
         '''
         Download the object in Amazon S3 to the local file.
         
         :param filename: the absolute path of the local file.
         :param bucket_name: name of the bucket which file puts into.
         :param obj_name: the object's name, as the format: 'folder/file.txt' or 'file.txt'.
+        :param if_none_match(optional): the ETag of the local file, 
+                                        if the object's ETag is the same, the file will not be written.
+        :param decryptor(optional): the function returns an object decrypts by chunks,
+                                    DES.decryptor eg, required to decrypt by the pipeline.
+        
+        :return: True if the file is written, False if the object is not modified.
         '''
         
-        fp = open(filename, 'wb')
+        headers = get_conditional_headers(if_none_match)
+        req = S3Request(self.access_key, self.secret_key, 'GET',
+                        bucket_name=bucket_name, obj_name=obj_name, headers=headers)
+        
+        def _action():
+            # the response is read after submitted, so the whole transfer is retried instead.
+            resp, resp_headers = req.submit(try_times=1, include_headers=True, stream=True)
+            fp = open(filename, 'wb')
+            try:
+                size = int(resp_headers.get('content-length', 0))
+                if size >= self.pipeline_threshold and \
+                    (not decrypt or decryptor is not None):
+                    self.last_utilization = download_by_pipeline(
+                        resp, fp, decryptor() if decrypt else None,
+                        self.pipeline_depth, self.pipeline_chunk_size)
+                    return
+                
+                data = resp.read()
+                if decrypt and decrypt_func is not None:
+                    data = decrypt_func(data)
+                fp.write(data)
+            finally:
+                fp.close()
+                resp.close()
+        
         try:
-            data = self.get_object(bucket_name, obj_name).data
-            
-            if decrypt and decrypt_func is not None:
-                data = decrypt_func(data)
-            
-            fp.write(data)
-        finally:
-            fp.close()
+            get_retry_policy().call(_action)
+        except S3Error, e:
+            if e.err_no == 304:
+                return False
+            raise e
+        return True
             
 class CryptoS3Client(S3Client):
     '''
@@ -770,11 +1156,12 @@ class CryptoS3Client(S3Client):
             raise S3Error(-1, msg='You haven\'t set the IV(8 length)')
         
         super(CryptoS3Client, self).upload_file(filename, bucket_name, obj_name, x_amz_acl,
-                                                encrypt, self.des.encrypt)
+                                                encrypt, self.des.encrypt, self.des.encryptor)
         
-    def download_file(self, filename, bucket_name, obj_name, decrypt=True):
+    def download_file(self, filename, bucket_name, obj_name, decrypt=True, if_none_match=None):
         if not hasattr(self, 'IV'):
             raise S3Error(-1, msg='You haven\'t set the IV(8 length)')
         
-        super(CryptoS3Client, self).download_file(filename, bucket_name, obj_name,
-                                                  decrypt, self.des.decrypt)
\ No newline at end of file
+        return super(CryptoS3Client, self).download_file(filename, bucket_name, obj_name,
+                                                         decrypt, self.des.decrypt, if_none_match,
+                                                         self.des.decryptor)
\ No newline at end of file
@@ -27,10 +27,20 @@ from hashlib import sha256, sha1, md5
 from base64 import b64encode
 import time
 import mimetypes
+import threading
+from Queue import Queue, Full
 try:
     from xml.etree.ElementTree import XMLTreeBuilder
 except ImportError:
     from elementtree.ElementTree import XMLTreeBuilder
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 
 from errors import CloudBackupLibError
 
@@ -86,15 +96,161 @@ def encode_multipart(kwargs, encrypt=False, encrypt_func=None):
     data.append('--%s--\r\n' % boundary)
     return '\r\n'.join(data), boundary
 
+def fix_xml_name(key):
+    if '}' in key:
+        key = key.split('}', 1)[1]
+    return key
+
 class NamespaceFixXmlTreeBuilder(XMLTreeBuilder):
     def _fixname(self, key):
-        if '}' in key:
-            key = key.split('}', 1)[1]
-        return key
+        return fix_xml_name(key)
     
 class XML(object):
     @classmethod
     def loads(cls, data):
         parser = NamespaceFixXmlTreeBuilder()
         parser.feed(data)
-        return parser.close()
\ No newline at end of file
+        return parser.close()
+    
+    @classmethod
+    def iterparse(cls, source, tags):
+        '''
+        Parse the xml incrementally, 
+        yield (tag, element) as soon as a child of the root element completes
+        if its tag is in the tags, the namespace of the tags is removed.
+        
+        The children are dropped from the root after handled,
+        so the memory doesn't grow with the size of the document.
+        
+        :param source: a file-like object or the xml string.
+        :param tags: the tags of the root's children to yield.
+        '''
+        
+        if isinstance(source, basestring):
+            source = StringIO(source)
+        
+        root = None
+        depth = 0
+        for event, ele in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = ele
+                depth += 1
+                continue
+            
+            depth -= 1
+            if depth != 1:
+                continue
+            
+            tag = fix_xml_name(ele.tag)
+            if tag in tags:
+                for child in ele.iter():
+                    child.tag = fix_xml_name(child.tag)
+                yield tag, ele
+            root.clear()
+
+class ReadAheadIterator(object):
+    '''
+    Iterate over pages fetched by a background thread.
+    
+    The fetch function is called with a marker and must return a tuple
+    (page, next_marker), next_marker is None when there is no more page.
+    While the consumer is handling the current page, 
+    at most `depth` pages are fetched ahead.
+    
+    Usage:
+    for page in ReadAheadIterator(fetch, depth=2):
+        handle(page)
+    '''
+    
+    _end = object()
+    
+    def __init__(self, fetch, marker=None, depth=2, poll_interval=0.5):
+        '''
+        :param fetch: the function to fetch a page, accept the marker as the only param.
+        :param marker(optional): the marker of the first page, None as default.
+        :param depth(optional): the max number of pages fetched ahead, 
+                                if less than 1, the pages will be fetched synchronously.
+        '''
+        
+        self.fetch = fetch
+        self.marker = marker
+        self.depth = depth
+        self.poll_interval = poll_interval
+        
+        self.queue = None
+        self.stopped = None
+        
+    def _sync_iter(self):
+        marker = self.marker
+        while True:
+            page, marker = self.fetch(marker)
+            yield page
+            if marker is None:
+                return
+            
+    def _put(self, queue, stopped, itm):
+        while not stopped.is_set():
+            try:
+                queue.put(itm, timeout=self.poll_interval)
+                return True
+            except Full:
+                continue
+        return False
+            
+    def _worker(self, queue, stopped):
+        marker = self.marker
+        try:
+            while not stopped.is_set():
+                page, marker = self.fetch(marker)
+                if not self._put(queue, stopped, (page, None)):
+                    return
+                if marker is None:
+                    break
+        except Exception, e:
+            self._put(queue, stopped, (self._end, e))
+            return
+        self._put(queue, stopped, (self._end, None))
+        
+    def start(self):
+        '''
+        Start to fetch the pages in background before iterated,
+        stop should be called if the pages are not iterated.
+        '''
+        
+        if self.depth < 1 or self.queue is not None:
+            return self
+        
+        self.queue = Queue(self.depth)
+        self.stopped = threading.Event()
+        worker = threading.Thread(target=self._worker, args=(self.queue, self.stopped))
+        worker.setDaemon(True)
+        worker.start()
+        return self
+    
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+        self.queue = self.stopped = None
+        
+    def __iter__(self):
+        if self.depth < 1:
+            for page in self._sync_iter():
+                yield page
+            return
+        
+        self.start()
+        queue, stopped = self.queue, self.stopped
+        try:
+            while True:
+                page, err = queue.get()
+                if page is self._end:
+                    if err is not None:
+                        raise err
+                    return
+                yield page
+        finally:
+            # stop the worker if the consumer breaks the iteration.
+            stopped.set()
+            if self.stopped is stopped:
+                self.queue = self.stopped = None
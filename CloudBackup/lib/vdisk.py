@@ -20,9 +20,11 @@ Created on 2012-4-18
 @author: Chine
 '''
 
-import urllib, urllib2
+import urllib, urllib2, urlparse
 import time
 import os
+import socket
+import httplib
 try:
     import json # json is simplejson in 2.6+
 except ImportError:
@@ -31,14 +33,19 @@ except ImportError:
 from errors import VdiskError
 from utils import hmac_sha256_hex as hmac_sha256, encode_multipart
 from crypto import DES
+from retry import get_retry_policy, classify, NOT_RETRY
+from bandwidth import throttle_upload, throttle_download
 
 __author__ = "Chine King"
 __description__ = "A client for vdisk api, site: http://vdisk.me/api/doc"
 __all__ = ['VdiskClient', 'CryptoVdiskClient']
 
 endpoint = "http://openapi.vdisk.me/"
+endpoint_host = urlparse.urlparse(endpoint).netloc
+# the name of the cloud shares the bandwidth.
+provider = 'vdisk'
 
-def _call(url_params, params, headers=None, method="POST", try_times=3, try_interval=3):
+def _call(url_params, params, headers=None, method="POST", try_times=None, try_interval=None):
     def _get_data():
         if method == "GET":
             if isinstance(params, str):
@@ -46,8 +53,8 @@ def _call(url_params, params, headers=None, method="POST", try_times=3, try_inte
             else:
                 full_params = "&".join((url_params, urllib.urlencode(params)))
             path = "%s?%s" % (endpoint, full_params)
-            resp = urllib2.urlopen(path)
-            return json.loads(resp.read())
+            resp = throttle_download(urllib2.urlopen(path), provider)
+            return _check(json.loads(resp.read()))
         
         # if method is POST
         path = "%s?%s" % (endpoint, url_params)
@@ -55,21 +62,27 @@ def _call(url_params, params, headers=None, method="POST", try_times=3, try_inte
             encoded_params = params
         else:
             encoded_params = urllib.urlencode(params)
+        encoded_params = throttle_upload(encoded_params, provider)
         
         if headers is not None:
             req = urllib2.Request(path, encoded_params, headers)
             resp = urllib2.urlopen(req)
         else:
             resp = urllib2.urlopen(path, encoded_params)
+        resp = throttle_download(resp, provider)
             
-        return json.loads(resp.read())
+        return _check(json.loads(resp.read()))
     
-    for i in range(try_times):
-        try:
-            return _get_data()
-        except urllib2.URLError:
-            time.sleep(try_interval)
-            
+    def _check(result):
+        # the transient errors raise to be retried, the others are left to the caller.
+        if classify(VdiskError(result['err_code'], result.get('err_msg'))) != NOT_RETRY:
+            raise VdiskError(result['err_code'], result['err_msg'])
+        return result
+    
+    try:
+        return get_retry_policy().call(_get_data, endpoint_host, 
+                                       tries=try_times, base_delay=try_interval)
+    except (urllib2.URLError, socket.error, httplib.HTTPException):
         raise VdiskError(-1, "Can't connect to server")
 
 def get_signature(data, app_secret):
@@ -257,7 +270,7 @@ class VdiskClient(object):
         fp = open(filename, 'wb')
         
         try:
-            resp = urllib2.urlopen(url)
+            resp = throttle_download(urllib2.urlopen(url), provider)
             if decrypt and decrypt_func is not None:
                 fp.write(decrypt_func(resp.read()))
             else:
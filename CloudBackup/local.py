@@ -22,32 +22,108 @@ Created on 2012-5-10
 
 import threading
 import os
+import stat
 import time
-import hashlib
+import shutil
 import logging
+import tempfile
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from cloud import Storage, S3Storage
-from utils import join_local_path, get_sys_encoding, get_info_path, ensure_folder_exsits
+from utils import join_local_path, get_sys_encoding, get_info_path, ensure_folder_exsits, \
+    calc_md5
 from CloudBackup.log import Log
+from CloudBackup.snapshot import CloudSnapshot, DEFAULT_REVALIDATE_SECS
+from CloudBackup.versions import VersionIndex
+from CloudBackup.journal import (TransferJournal, TransferOperation, UPLOAD, DOWNLOAD, 
+                                 get_part_path)
+from CloudBackup.packs import PackStore, DEFAULT_PACK_SIZE, is_pack_path
+from CloudBackup.restore import RestoreSource, MultiSourceDownloader
+from CloudBackup.ignore import get_ignore_rules
+from CloudBackup.index import LocalIndex, get_index_name
+from CloudBackup.hashing import FileHasher, DEFAULT_HASH_WORKERS
 from CloudBackup.lib.vdisk import VdiskClient
 from CloudBackup.lib.errors import VdiskError, CloudBackupLibError, GSError, S3Error
+from CloudBackup.lib.crypto import DES
+from CloudBackup.lib.retry import classify, NOT_RETRY
 
 SPACE_REPLACE = '#$&'
 DEFAULT_SLEEP_MINUTS = 5
 DEFAULT_SLEEP_SECS = DEFAULT_SLEEP_MINUTS * 60
+# the files not smaller than it are checked by a HEAD request before uploaded.
+PREFLIGHT_MIN_SIZE = 1024 * 1024
+# the folders listed at the same time, more for the network file systems.
+DEFAULT_WALK_WORKERS = 1
+
+# compare the files on both sides by the mtime and the size first, like rsync,
+# or by the md5 of each file.
+COMPARE_QUICK = 'quick'
+COMPARE_CHECKSUM = 'checksum'
+# the files are all hashed from the disk and compared by md5 once in the days.
+DEFAULT_AUDIT_DAYS = 7
+DEFAULT_AUDIT_SECS = DEFAULT_AUDIT_DAYS * 24 * 60 * 60
+# a file is uploaded after not changed in the seconds,
+# and once in the max seconds at most if it keeps changing.
+DEFAULT_QUIET_SECS = 30
+DEFAULT_MAX_DEFER_MINUTES = 60
+DEFAULT_MAX_DEFER_SECS = DEFAULT_MAX_DEFER_MINUTES * 60
+# the times to copy a changing file until the copy is consistent.
+HOT_COPY_TRIES = 3
 
 class FileEntry(object):
-    def __init__(self, path, timestamp, md5, **kwargs):
+    '''
+    A file of the local folder or the cloud, millions of them may be kept each cycle,
+    so the attributes are slots, and the ones not given are None.
+    '''
+    
+    __slots__ = ('path', 'timestamp', 'md5', 'size', 'inode', 'packed', 
+                 'encrypt_func', 'crypto_key', 'scanner')
+    
+    calc_md5 = staticmethod(calc_md5)
+    
+    def __init__(self, path, timestamp, md5, size=None, inode=None, packed=False,
+                 encrypt_func=None, crypto_key=None, scanner=None):
+        '''
+        :param path: the absolute path of the local file, or the path on the cloud.
+        :param timestamp: the mtime of the file.
+        :param md5: the md5 of the file, None if not calculated yet.
+        :param size(optional): the size of the file.
+        :param inode(optional): the inode of the local file.
+        :param packed(optional): if the file on the cloud is kept in a pack.
+        :param encrypt_func(optional): the file is encrypted before hashed if set.
+        :param crypto_key(optional): the key of the encryption, the IV eg.
+        :param scanner(optional): the LocalScanner which keeps the md5 of the cycle.
+        '''
+        
         self.path = path
         self.timestamp = timestamp
         self.md5 = md5
-        for k, v in kwargs.iteritems():
-            setattr(self, k, v)
-            
-        self.calc_md5 = lambda data: hashlib.md5(data).hexdigest()
+        self.size = size
+        self.inode = inode
+        self.packed = packed
+        self.encrypt_func = encrypt_func
+        self.crypto_key = crypto_key
+        self.scanner = scanner
+        
+    def get_md5(self, refresh=False):
+        '''
+        :param refresh(optional): if True, hash from the disk even if the md5 is indexed.
+        '''
+        
+        if self.md5 and not refresh:
+            return self.md5
         
-    def get_md5(self):
-        if self.md5:
+        if self.scanner is not None:
+            self.md5 = self.scanner.get_md5(self.path, self.timestamp, 
+                                            self.encrypt_func, self.crypto_key,
+                                            self.size, refresh)
             return self.md5
         
         if os.path.exists(self.path):
@@ -55,7 +131,7 @@ class FileEntry(object):
                 
             try:
                 content = fp.read()
-                if hasattr(self, 'encrypt_func'):
+                if self.encrypt_func is not None:
                     content = self.encrypt_func(content)
                 
                 md5 = self.calc_md5(content)
@@ -63,6 +139,304 @@ class FileEntry(object):
             finally:
                 fp.close()
         
+class _ListEntry(object):
+    '''
+    The same as the DirEntry of scandir, by os.listdir and os.stat,
+    each entry costs a stat at most.
+    '''
+    
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+        
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+    
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+        
+    def is_symlink(self):
+        return os.path.islink(self.path)
+    
+def iter_dir(dirpath):
+    if scandir is not None:
+        return scandir(dirpath)
+    return (_ListEntry(dirpath, name) for name in os.listdir(dirpath))
+
+class LocalWalker(object):
+    '''
+    Walk a local folder by scandir, the type of each entry comes with the listing,
+    so a file costs one stat, and a folder none on most systems.
+    The folders can be listed by a thread pool, 
+    which saves the most on the network file systems.
+    
+    Usage:
+    walker = LocalWalker('/local_folder', IgnoreRules(), workers=8)
+    files = walker.walk() # the relative path and the FileEntry.
+    '''
+    
+    def __init__(self, root, rules, encoding=None, workers=DEFAULT_WALK_WORKERS):
+        '''
+        :param root: the local folder.
+        :param rules: an instance of IgnoreRules, the folders ignored are never listed.
+        :param encoding(optional): the encoding of the file names, the system's as default.
+        :param workers(optional): the folders listed at the same time.
+        '''
+        
+        self.root = root
+        self.rules = rules
+        self.encoding = encoding or get_sys_encoding()
+        self.workers = max(workers, 1)
+        self.files = {}
+        
+    def _to_utf8(self, name):
+        if isinstance(name, unicode):
+            return name.encode('utf-8')
+        return name.decode(self.encoding).encode('utf-8')
+    
+    def _walk_dir(self, dirpath, rel_dir):
+        '''
+        :return: the sub folders to walk, list of (the absolute path, the relative path).
+        '''
+        
+        try:
+            entries = list(iter_dir(dirpath))
+        except OSError:
+            # removed or not permitted, the same as os.walk.
+            return []
+        
+        rules = self.rules
+        rules.load_folder(rel_dir, dirpath, [entry.name for entry in entries])
+        prefix = rel_dir + '/' if rel_dir else ''
+        
+        subdirs = []
+        for entry in entries:
+            rel_path = prefix + self._to_utf8(entry.name)
+            try:
+                if entry.is_dir():
+                    # the links to folders are not followed, the same as os.walk.
+                    if not entry.is_symlink() and not rules.is_ignored(rel_path, True):
+                        subdirs.append((entry.path, rel_path))
+                    continue
+                st = entry.stat()
+            except OSError:
+                # removed while walking.
+                continue
+            
+            timestamp = int(st.st_mtime)
+            if rules.is_ignored(rel_path, False, st.st_size, timestamp):
+                continue
+            self.files[rel_path] = FileEntry(entry.path, timestamp, None, 
+                                             size=st.st_size, inode=st.st_ino)
+        return subdirs
+    
+    def _walk_parallel(self):
+        cond = threading.Condition()
+        state = {'pending': 0, 'error': None}
+        pool = ThreadPool(self.workers)
+        
+        def _walk(dirpath, rel_dir):
+            try:
+                for subdir in self._walk_dir(dirpath, rel_dir):
+                    _submit(subdir)
+            except Exception, e:
+                state['error'] = e
+            finally:
+                cond.acquire()
+                try:
+                    state['pending'] -= 1
+                    if state['pending'] == 0:
+                        cond.notify_all()
+                finally:
+                    cond.release()
+                    
+        def _submit(subdir):
+            cond.acquire()
+            try:
+                state['pending'] += 1
+            finally:
+                cond.release()
+            pool.apply_async(_walk, subdir)
+            
+        try:
+            _submit((self.root, ''))
+            cond.acquire()
+            try:
+                while state['pending'] > 0:
+                    cond.wait(1)
+            finally:
+                cond.release()
+        finally:
+            pool.close()
+            pool.join()
+        
+        if state['error'] is not None:
+            raise state['error']
+    
+    def walk(self):
+        '''
+        :return: dict of the relative path and the FileEntry with the size and the inode.
+        '''
+        
+        self.files = {}
+        self.rules.reset()
+        
+        if self.workers > 1:
+            self._walk_parallel()
+        else:
+            stack = [(self.root, '')]
+            while stack:
+                stack.extend(self._walk_dir(*stack.pop()))
+        return self.files
+
+class LocalScanner(object):
+    '''
+    Walk the local folder once each cycle, and keep the md5 of the files,
+    so that the handlers of the same folder share the stat pass and the hash pass.
+    
+    The md5 is kept in the LocalIndex by the mtime and the size,
+    so a file is hashed again only when it changes.
+    The handlers encrypt by the same key share the same md5.
+    The files are hashed by a FileHasher, the readers are bounded for all the handlers.
+    '''
+    
+    def __init__(self, folder_name, encoding=None, rules=None, workers=DEFAULT_WALK_WORKERS,
+                 hash_workers=DEFAULT_HASH_WORKERS):
+        '''
+        :param folder_name: the local folder.
+        :param encoding(optional): the encoding of the file names, the system's as default.
+        :param rules(optional): an instance of IgnoreRules, the settings of the process as default.
+        :param workers(optional): the folders listed at the same time.
+        :param hash_workers(optional): the files hashed at the same time.
+        '''
+        
+        self.folder_name = folder_name
+        self.encoding = encoding or get_sys_encoding()
+        self.rules = rules if rules is not None else get_ignore_rules()
+        self.workers = workers
+        self.hasher = FileHasher(hash_workers)
+        
+        self.files = {}
+        self.index = None
+        self.hashing = {}
+        self.cond = threading.Condition()
+        
+        self.stats = {'scans': 0, 'hashes': 0}
+        
+    def get_index(self):
+        # loaded when first used, the scanner replaced by the orchestrator never loads.
+        self.cond.acquire()
+        try:
+            if self.index is None:
+                self.index = LocalIndex(get_index_name(self.folder_name))
+            return self.index
+        finally:
+            self.cond.release()
+    
+    def scan(self):
+        '''
+        Walk the local folder, the md5 of the files removed are dropped.
+        The folders ignored are never entered.
+        
+        :return: dict of the relative path and the FileEntry.
+        '''
+        
+        walker = LocalWalker(self.folder_name, self.rules, self.encoding, self.workers)
+        files = walker.walk()
+        
+        index = self.get_index()
+        index.prune(set(entry.path for entry in files.itervalues()))
+        # the changes between the walks tell the files still being written.
+        now = int(time.time())
+        for entry in files.itervalues():
+            index.observe(entry.path, entry.timestamp, entry.size, now)
+        
+        self.cond.acquire()
+        try:
+            self.files = files
+            self.stats['scans'] += 1
+        finally:
+            self.cond.release()
+        return files
+    
+    def flush(self):
+        if self.index is not None:
+            self.index.save()
+            
+    def get_change(self, filename):
+        '''
+        :return: (the time the latest change is seen by the walks, None if never,
+                  the walks in a row which see a change).
+        '''
+        
+        return self.get_index().get_change(filename)
+    
+    def hash_files(self, entries, refresh=False):
+        '''
+        Hash the files at the same time, the smaller ones first.
+        The md5 is set to each entry, and kept in the index.
+        
+        :param entries: the FileEntry instances of the cycle.
+        :param refresh(optional): if True, hash from the disk even if the md5 is indexed.
+        '''
+        
+        def _hash(entry):
+            entry.md5 = self.get_md5(entry.path, entry.timestamp, entry.encrypt_func,
+                                     entry.crypto_key, entry.size, refresh)
+        
+        self.hasher.map(_hash, entries, key=lambda entry: entry.size or 0)
+        self.get_index().set_meta('hash.stats', self.hasher.get_stats())
+    
+    def get_md5(self, filename, timestamp, encrypt_func=None, key=None, size=None,
+                refresh=False):
+        '''
+        :param filename: the local file's absolute path.
+        :param timestamp: the mtime of the local file.
+        :param encrypt_func(optional): the file is encrypted before hashed if set.
+        :param key(optional): the key of the encryption, the IV eg.
+        :param size(optional): the size of the local file.
+        :param refresh(optional): if True, hash from the disk even if the md5 is indexed.
+        
+        :return: the md5, calculated only once if more handlers ask at the same time.
+        '''
+        
+        if encrypt_func is None:
+            key = None
+        index = self.get_index()
+        cache_key = (filename, timestamp, key)
+        self.cond.acquire()
+        try:
+            while cache_key in self.hashing:
+                self.cond.wait()
+            if not refresh:
+                md5 = index.get(filename, timestamp, size, key)
+                if md5 is not None:
+                    return md5
+            self.hashing[cache_key] = True
+        finally:
+            self.cond.release()
+        
+        md5 = None
+        try:
+            md5 = self.hasher.calc_md5(filename, encrypt_func)
+            return md5
+        finally:
+            self.cond.acquire()
+            try:
+                del self.hashing[cache_key]
+                if md5 is not None:
+                    index.put(filename, timestamp, size, md5, key)
+                    self.stats['hashes'] += 1
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
 class VdiskRefreshToken(threading.Thread):
     stopped = False
     def __init__(self, client):
@@ -88,7 +462,12 @@ class SyncHandler(threading.Thread):
     stopped = False
     
     def __init__(self, storage, folder_name, 
-                 loop=True, sec=DEFAULT_SLEEP_SECS, log=False, log_obj=None):
+                 loop=True, sec=DEFAULT_SLEEP_SECS, log=False, log_obj=None,
+                 snapshot=True, revalidate_secs=DEFAULT_REVALIDATE_SECS, retention=None,
+                 journal=True, pack_threshold=None, pack_size=DEFAULT_PACK_SIZE,
+                 scanner=None, compare=COMPARE_QUICK, audit_secs=DEFAULT_AUDIT_SECS,
+                 quiet_secs=DEFAULT_QUIET_SECS, max_defer_secs=DEFAULT_MAX_DEFER_SECS,
+                 copy_hot=False):
         super(SyncHandler, self).__init__()
         
         assert isinstance(storage, Storage)
@@ -98,8 +477,31 @@ class SyncHandler(threading.Thread):
         self.loop = loop
         self.sec = sec
         
+        # the versions of the cloud files, and the policy to delete the old ones.
+        self.versions = VersionIndex()
+        self.retention = retention
+        
         self.encoding = get_sys_encoding()
-        self.calc_md5 = lambda data: hashlib.md5(data).hexdigest()
+        self.calc_md5 = calc_md5
+        
+        # the scanner shared by the handlers of the same folder walks once each cycle,
+        # else the handler walks by itself.
+        self.shared_scan = scanner is not None
+        self.scanner = scanner or LocalScanner(folder_name, self.encoding)
+        
+        # the files with the same mtime on both sides are taken as the same if quick,
+        # and all the files are hashed from the disk and compared once in audit_secs.
+        assert compare in (COMPARE_QUICK, COMPARE_CHECKSUM)
+        self.compare = compare
+        self.audit_secs = audit_secs
+        
+        # the files being written are uploaded when they stop changing,
+        # or once in max_defer_secs, from a consistent copy if copy_hot.
+        self.quiet_secs = quiet_secs
+        self.max_defer_secs = max_defer_secs
+        self.copy_hot = copy_hot
+        self.hot_since = {}
+        self.hot_uploaded = {}
         
         # init the error log
         self.error_log = logging.getLogger()
@@ -109,14 +511,48 @@ class SyncHandler(threading.Thread):
         self.error_log.addHandler(handler)
         self.error_log.setLevel(logging.DEBUG)
         
+        storage_type = self.storage.__class__.__name__.rsplit('Storage')[0].lower()
+        
         # init the action log
         self.log = log
         if log and log_obj:
             self.log_obj = log_obj
         elif log:
             log_file = os.path.join(self.folder_name,
-                '.%s.log.txt' % self.storage.__class__.__name__.rsplit('Storage')[0].lower())
+                '.%s.log.txt' % storage_type)
             self.log_obj = Log(log_file)
+            
+        holder = getattr(self.storage, 'holder', '') or ''
+        name = self.info_name = '%s.%s' % (storage_type, holder.replace('/', '_'))
+            
+        # init the snapshot of the cloud files
+        self.snapshot = None
+        if snapshot:
+            self.snapshot = CloudSnapshot(self.storage, name, revalidate_secs)
+            
+        # init the journal of the transfers, the outstanding ones are replayed at first.
+        self.journal = None
+        self.replayed = False
+        if journal:
+            self.journal = TransferJournal(name)
+            
+        # the handlers of the other clouds on the same folder, 
+        # the files kept by them as well are downloaded from all at the same time.
+        self.mirrors = []
+        self.restorer = None
+        self.cloud_files = {}
+        # set by the orchestrator, only the handler which claims a file first downloads it in a cycle.
+        self.claim = None
+            
+        # init the packs of the small files, None means each file is uploaded by itself.
+        self.packs = None
+        if pack_threshold is not None:
+            encrypt_func = decrypt_func = None
+            if hasattr(self.storage.client, 'des'):
+                encrypt_func = self.storage.client.des.encrypt
+                decrypt_func = self.storage.client.des.decrypt
+            self.packs = PackStore(self.storage, name, pack_threshold, pack_size,
+                                   encrypt_func=encrypt_func, decrypt_func=decrypt_func)
     
     def local_to_cloud(self, path, timestamp):
         splits = path.rsplit('.', 1)
@@ -155,123 +591,497 @@ class SyncHandler(threading.Thread):
             f.path = path
             yield f
             
+    def _list_cloud_files(self):
+        if self.snapshot is not None:
+            return self.snapshot.list_files()
+        return self.storage.list_files('', True)
+    
+    def _get_snapshot_key(self, cloud_path):
+        if isinstance(cloud_path, str):
+            return cloud_path.decode('utf-8')
+        return cloud_path
+    
+    def _record_upload(self, cloud_path, path=None, entry=None):
+        if self.snapshot is not None:
+            md5 = size = None
+            if entry is not None:
+                # the same as the listing returns, so the file can be compared before revalidated.
+                md5, size = entry.get_md5(), entry.size
+                if size is not None and hasattr(self.storage.client, 'des'):
+                    size = DES.get_encrypted_size(size)
+            self.snapshot.add(self._get_snapshot_key(cloud_path), md5, size)
+        # the file is uploaded by itself, so the packed one is out of date.
+        if self.packs is not None and path is not None:
+            self.packs.discard(path)
+            
+    def _log_packed(self, paths):
+        if self.log:
+            for path in paths:
+                self.log_obj.write('上传了文件：%s' % path)
+    
+    def _pack(self, f, entry):
+        '''
+        Add a small file to the pending pack, the pack is uploaded when it's large enough,
+        or when the sync finishes.
+        '''
+        
+        if self.packs is None or not self.packs.accepts(entry.path):
+            return False
+        
+        self._log_packed(self.packs.add(f, entry.path, entry.timestamp))
+        return True
+    
+    def _flush_packs(self):
+        if self.packs is not None:
+            self._log_packed(self.packs.flush())
+            
+    def _get_local_path(self, path):
+        return path.encode('utf-8')
+    
+    def _begin_transfer(self, kind, filename, cloud_path, timestamp):
+        if self.journal is None:
+            return
+        return self.journal.begin(TransferOperation(kind, filename, cloud_path, timestamp))
+    
+    def _end_transfer(self, op_id):
+        if op_id is not None:
+            self.journal.end(op_id)
+    
+    def _replay_journal(self):
+        '''
+        Replay the transfers which are not ended when the process exits last time.
+        The upload continues if the file isn't modified, 
+        else the unfinished upload and the partial downloaded file are cleaned,
+        the sync will decide what to do with them.
+        '''
+        
+        self.replayed = True
+        if self.journal is None:
+            return
+        
+        for op_id, op in self.journal.iter_outstanding():
+            if self.stopped: return
+            
+            try:
+                if op.kind == DOWNLOAD:
+                    part = get_part_path(op.filename)
+                    if os.path.exists(part):
+                        os.remove(part)
+                elif os.path.exists(op.filename) and \
+                    int(os.path.getmtime(op.filename)) == op.timestamp:
+                    self.storage.upload(op.cloud_path, op.filename)
+                    entry = self._get_local_entry(op.filename, op.timestamp, 
+                                                  os.path.getsize(op.filename))
+                    self._record_upload(op.cloud_path, entry=entry)
+                else:
+                    self.storage.abort_upload(op.cloud_path)
+            except CloudBackupLibError, e:
+                self.error_log.exception(str(e))
+            finally:
+                self.journal.end(op_id)
+    
+    def _is_uploaded(self, cloud_path, entry):
+        '''
+        Check by a HEAD request if the same content has been uploaded to the cloud path,
+        which happens if the last sync exits before the snapshot is flushed eg.
+        '''
+        
+        if not self.storage.conditional:
+            return False
+        try:
+            if os.path.getsize(entry.path) < PREFLIGHT_MIN_SIZE:
+                return False
+        except OSError:
+            return False
+        
+        cloud_file = self.storage.head(cloud_path)
+        return cloud_file is not None and cloud_file.md5 == entry.get_md5()
+            
     def _get_cloud_files(self):
-        files = {}
-        for f in self.storage.list_files('', True):
+        versions = VersionIndex()
+        for f in self._list_cloud_files():
+            if is_pack_path(f.path):
+                continue
             path, timestamp = self.cloud_to_local(f.path)
-            path = path.encode('utf-8')
-            files[path] = FileEntry(f.path, timestamp, f.md5)
+            path = self._get_local_path(path)
+            # the files ignored locally are never downloaded.
+            if self.scanner.rules.is_path_ignored(path):
+                continue
+            versions.add(path, timestamp, f)
+        self.versions = versions
+        
+        files = {}
+        for path, timestamp, f in versions.iter_latest():
+            files[path] = FileEntry(f.path, timestamp, f.md5, size=getattr(f, 'size', None))
+            
+        if self.packs is not None:
+            for path, record in self.packs.iter_files():
+                if path not in files or record.timestamp >= files[path].timestamp:
+                    files[path] = FileEntry(path, record.timestamp, record.md5, 
+                                            size=record.length, packed=True)
+        
+        # the files too large or too old are skipped by the walk, 
+        # so they are never downloaded either, or they are downloaded each cycle.
+        for path, entry in files.items():
+            try:
+                size = int(entry.size) if entry.size is not None else None
+            except (TypeError, ValueError):
+                size = None
+            timestamp = entry.timestamp if entry.timestamp >= 0 else None
+            if self.scanner.rules.is_path_ignored(path, size, timestamp):
+                del files[path]
             
         return files
     
-    def _is_folder_exclude(self, folder_name):
-        for name in folder_name.split(os.sep):
-            if name.startswith('.'):
-                return True
-        return False
-            
-    def _get_local_files(self):
-        files = {}
+    def collect_garbage(self, policy=None):
+        '''
+        Delete the old versions of the cloud files which expire by the retention policy.
+        
+        :param policy(optional): an instance of RetentionPolicy, self.retention as default.
+        '''
+        
+        policy = policy or self.retention
+        if policy is None:
+            return
         
-        folder_name = self.folder_name if self.folder_name.endswith(os.sep) \
-                        else self.folder_name+os.sep
+        expired = list(self.versions.iter_expired(policy))
+        deleted, failed = self.storage.delete_files(f.path for f in expired)
         
-        for dirpath, dirnames, filenames in os.walk(self.folder_name):
-            if self._is_folder_exclude(dirpath):
+        deleted = set(deleted)
+        for f in expired:
+            if f.path not in deleted:
                 continue
-            
-            for filename in filenames:
-                if filename.startswith('.'):
-                    continue
-                
-                abs_filename = os.path.join(dirpath, filename)
-                rel_path = abs_filename.split(folder_name, 1)[1]
-                if isinstance(rel_path, unicode):
-                    rel_path = rel_path.encode('utf-8')
-                else:
-                    rel_path = rel_path.decode(self.encoding).encode('utf-8')
-                timestamp = int(os.path.getmtime(abs_filename))
-                
-                if hasattr(self.storage.client, 'des'):
-                    func = self.storage.client.des.encrypt
-                    entry = FileEntry(abs_filename, timestamp, None, encrypt_func=func)
-                else:
-                    entry = FileEntry(abs_filename, timestamp, None)
-                
-                if os.sep == '/':
-                    files[rel_path] = entry
-                else:
-                    files[rel_path.replace(os.sep, '/')] = entry
+            path, _ = self.cloud_to_local(f.path)
+            self.versions.remove(self._get_local_path(path), f)
+            if self.snapshot is not None:
+                self.snapshot.remove(f.path)
+        
+        for cloud_path, e in failed:
+            self.error_log.info('delete old version %s happens an error: %s' % (cloud_path, e))
+    
+    def _get_crypto(self):
+        if hasattr(self.storage.client, 'des'):
+            return {'encrypt_func': self.storage.client.des.encrypt, 
+                    'crypto_key': self.storage.client.des.IV}
+        return {}
+    
+    def _get_local_entry(self, filename, timestamp, size, inode=None, crypto=None):
+        # each handler has its own entry, the md5 differs by the encryption.
+        if crypto is None:
+            crypto = self._get_crypto()
+        return FileEntry(filename, timestamp, None, size=size, inode=inode, 
+                         scanner=self.scanner, **crypto)
+    
+    def _get_local_files(self):
+        if not self.shared_scan:
+            self.scanner.scan()
+        
+        # the same function is kept by all the entries.
+        crypto = self._get_crypto()
+        files = {}
+        for rel_path, scanned in self.scanner.files.iteritems():
+            files[rel_path] = self._get_local_entry(scanned.path, scanned.timestamp, 
+                                                    scanned.size, scanned.inode, crypto)
                     
         return files
     
+    def _is_audit_due(self):
+        index = self.scanner.get_index()
+        key = 'audit.%s' % self.info_name
+        audited = index.get_meta(key)
+        if audited is None:
+            # the first audit is a period after the first sync.
+            index.set_meta(key, int(time.time()))
+            return False
+        return time.time() - audited >= self.audit_secs
+    
+    def _set_audited(self):
+        self.scanner.get_index().set_meta('audit.%s' % self.info_name, int(time.time()))
+    
+    def _quick_check(self, local_entry, cloud_entry):
+        '''
+        :return: True if changed, False if not, None if the md5 must be compared.
+        '''
+        
+        if self.compare != COMPARE_QUICK:
+            return
+        
+        # a different size means changed, even if the mtime is kept by the writer.
+        if local_entry.size is not None and cloud_entry.size is not None:
+            size = local_entry.size
+            # the content is padded when encrypted.
+            if hasattr(self.storage.client, 'des'):
+                size = DES.get_encrypted_size(size)
+            try:
+                if int(cloud_entry.size) != size:
+                    return True
+            except (TypeError, ValueError):
+                pass
+        
+        # the timestamp of the cloud file is the local mtime when uploaded.
+        if local_entry.timestamp == cloud_entry.timestamp:
+            return False
+    
+    def _is_changed(self, local_entry, cloud_entry, audit=False):
+        '''
+        Compare a file on both sides.
+        
+        If quick, a different size means changed, and the same mtime means unchanged,
+        only the rest are compared by md5, which is indexed unless the file changes.
+        
+        :param audit(optional): if True, compare all by md5.
+        '''
+        
+        if not audit:
+            changed = self._quick_check(local_entry, cloud_entry)
+            if changed is not None:
+                return changed
+        
+        return local_entry.get_md5() != cloud_entry.get_md5()
+    
+    def _hash_local_files(self, files, local_files_tm, cloud_files_tm, audit=False):
+        '''
+        Hash the local files to compare by md5 at the same time before the comparison.
+        The files are hashed from the disk if audit.
+        '''
+        
+        entries = []
+        for f in files:
+            local_entry = local_files_tm[f]
+            if audit or self._quick_check(local_entry, cloud_files_tm[f]) is None:
+                entries.append(local_entry)
+        self.scanner.hash_files(entries, refresh=audit)
+    
+    def _is_hot(self, entry):
+        changed_at, _ = self.scanner.get_change(entry.path)
+        last_change = max(entry.timestamp, changed_at or 0)
+        return time.time() - last_change < self.quiet_secs
+    
+    def _defer_upload(self, f, entry):
+        '''
+        Defer the file being written, it's uploaded when not changed in quiet_secs.
+        If it keeps changing, it's uploaded once in max_defer_secs.
+        
+        :return: True if not uploaded this time.
+        '''
+        
+        if self.quiet_secs <= 0 or not self._is_hot(entry):
+            self.hot_since.pop(f, None)
+            self.hot_uploaded.pop(f, None)
+            return False
+        
+        now = time.time()
+        since = self.hot_since.setdefault(f, now)
+        last = self.hot_uploaded.get(f, since)
+        if self.max_defer_secs is not None and now - last >= self.max_defer_secs:
+            self.hot_uploaded[f] = now
+            return False
+        return True
+    
+    def _copy_hot(self, entry):
+        '''
+        Copy a file being written, the copy is consistent 
+        if the mtime and the size don't change while copied.
+        
+        :return: the FileEntry of the copy, None if it keeps changing.
+        '''
+        
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        for _ in range(HOT_COPY_TRIES):
+            try:
+                before = os.stat(entry.path)
+                shutil.copyfile(entry.path, tmp)
+                after = os.stat(entry.path)
+            except (IOError, OSError):
+                break
+            if before.st_mtime == after.st_mtime and before.st_size == after.st_size:
+                return FileEntry(tmp, int(after.st_mtime), None, size=after.st_size,
+                                 encrypt_func=entry.encrypt_func, crypto_key=entry.crypto_key)
+        os.remove(tmp)
+    
+    def _upload_file(self, f, local_files_tm, cloud_files_tm):
+        entry = local_files_tm[f]
+        if not self.copy_hot or f not in self.hot_since:
+            self._upload(f, local_files_tm, cloud_files_tm)
+            return
+        
+        copied = self._copy_hot(entry)
+        if copied is None:
+            self.error_log.info('file %s keeps changing, upload next time.' % f)
+            return
+        local_files_tm[f] = copied
+        try:
+            self._upload(f, local_files_tm, cloud_files_tm)
+        finally:
+            local_files_tm[f] = entry
+            os.remove(copied.path)
+    
     def _upload(self, f, local_files_tm, cloud_files_tm):
         entry = local_files_tm[f]
         filename, timestamp = entry.path, entry.timestamp
         cloud_path = self.local_to_cloud(f, timestamp)
         
-        def _action(try_times=3, sleep_sec=3):
-            tries = 0
-            while tries <= try_times:
-                try:
-                    self.storage.upload(cloud_path, filename)
-                    break
-                except VdiskError, e:
-                    if e.err_no == 6 or e.err_no == 5:
-                        time.sleep(sleep_sec)
-                        tries += 1
-                    else:
-                        raise e
-                except GSError, e:
-                    self.error_log.info('upload file %s happens an error.' % f)
-                    raise e
-        _action()
+        if self._pack(f, entry):
+            return
+        
+        if self._is_uploaded(cloud_path, entry):
+            self._record_upload(cloud_path, f, entry)
+            return
+        
+        op_id = self._begin_transfer(UPLOAD, filename, cloud_path, timestamp)
+        try:
+            self.storage.upload(cloud_path, filename)
+            self._record_upload(cloud_path, f, entry)
+        except VdiskError, e:
+            # the transient errors have been retried by the library, 
+            # so skip the file this time if it still fails.
+            if classify(e) == NOT_RETRY:
+                raise e
+            self.error_log.info('upload file %s happens an error.' % f)
+            return
+        except GSError, e:
+            self.error_log.info('upload file %s happens an error.' % f)
+            raise e
+        finally:
+            self._end_transfer(op_id)
                     
         if self.log:
             self.log_obj.write('上传了文件：%s' % f)
         
+    def _get_source(self, cloud_entry):
+        # a new stream for each download, since the mirrors are synced by their own threads.
+        decryptor = None
+        if hasattr(self.storage.client, 'des'):
+            decryptor = self.storage.client.des.decryptor
+        return RestoreSource(self.storage, cloud_entry.path, cloud_entry.md5, 
+                             getattr(cloud_entry, 'size', None), decryptor)
+        
+    def _get_sources(self, f, cloud_entry):
+        '''
+        :return: the copies of the file on all the clouds, which keep the same content.
+        '''
+        
+        if self.restorer is None or not self.mirrors or cloud_entry.md5 is None:
+            return []
+        
+        sources = [self._get_source(cloud_entry)]
+        for mirror in self.mirrors:
+            if mirror.stopped:
+                continue
+            entry = mirror.cloud_files.get(f)
+            if entry is None or getattr(entry, 'packed', False) or \
+                entry.md5 != cloud_entry.md5:
+                continue
+            sources.append(mirror._get_source(entry))
+        return sources
+        
     def _download(self, f, local_files_tm, cloud_files_tm):
+        # the other handler of the same folder downloads it, from all the clouds.
+        if self.claim is not None and not self.claim(f):
+            return
+        
         filename = join_local_path(self.folder_name, 
                                    f.decode('utf-8'))
         dirname = os.path.dirname(filename)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
         
-        cloud_path = cloud_files_tm[f].path
-        self.storage.download(cloud_path, filename)
+        cloud_entry = cloud_files_tm[f]
+        cloud_path = cloud_entry.path
+        
+        # the content won't be transfered if the local file is the same as the cloud one.
+        md5 = local_files_tm[f].get_md5() if f in local_files_tm else None
+        
+        # download to a part file, so the local file is never left half written.
+        part = get_part_path(filename)
+        op_id = self._begin_transfer(DOWNLOAD, filename, cloud_path, cloud_entry.timestamp)
+        try:
+            if getattr(cloud_entry, 'packed', False):
+                downloaded = md5 is None or md5 != cloud_entry.md5
+                if downloaded:
+                    self.packs.restore(f, part)
+            else:
+                sources = self._get_sources(f, cloud_entry)
+                if len(sources) > 1:
+                    downloaded = md5 is None or md5 != cloud_entry.md5
+                    if downloaded:
+                        self.restorer.download(sources, part)
+                else:
+                    downloaded = self.storage.download(cloud_path, part, md5=md5)
+            if downloaded:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(part, filename)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+            self._end_transfer(op_id)
+            
+        if not downloaded:
+            if cloud_entry.timestamp >= 0:
+                os.utime(filename, (cloud_entry.timestamp, cloud_entry.timestamp))
+            return
         
         if self.log:
             self.log_obj.write('下载了文件：%s' % f)
     
     def sync(self):
         try:
+            if not self.replayed:
+                self._replay_journal()
+            
             local_files_tm = self._get_local_files()
             cloud_files_tm = self._get_cloud_files()
+            self.cloud_files = cloud_files_tm
             
             local_files = set(local_files_tm.keys())
             cloud_files = set(cloud_files_tm.keys())
             
             for f in (local_files - cloud_files):
                 if self.stopped: return
-                self._upload(f, local_files_tm, cloud_files_tm)
+                if self._defer_upload(f, local_files_tm[f]):
+                    continue
+                self._upload_file(f, local_files_tm, cloud_files_tm)
                 
             for f in (cloud_files - local_files):
                 if self.stopped: return
                 self._download(f, local_files_tm, cloud_files_tm)
                 
-            for f in (cloud_files & local_files):
+            audit = self._is_audit_due()
+            both_files = cloud_files & local_files
+            self._hash_local_files(both_files, local_files_tm, cloud_files_tm, audit)
+            for f in both_files:
                 if self.stopped: return
                 local_entry = local_files_tm[f]
                 cloud_entry = cloud_files_tm[f]
                 
-                if local_entry.get_md5() != cloud_entry.get_md5():
+                if self._is_changed(local_entry, cloud_entry, audit):
                     if local_entry.timestamp < cloud_entry.timestamp:
                         self._download(f, local_files_tm, cloud_files_tm)
                     elif local_entry.timestamp > cloud_entry.timestamp:
-                        self._upload(f, local_files_tm, cloud_files_tm)
+                        if not self._defer_upload(f, local_entry):
+                            self._upload_file(f, local_files_tm, cloud_files_tm)
+                    else:
+                        self.error_log.info('file %s differs from the cloud with the same mtime.' % f)
+            if audit:
+                self._set_audited()
+                        
+            if self.retention is not None and not self.stopped:
+                self.collect_garbage()
                         
         except CloudBackupLibError, e:
             self.error_log.exception(str(e))
+        finally:
+            # the packs are uploaded and indexed on the cloud even if the sync stops.
+            try:
+                self._flush_packs()
+            except CloudBackupLibError, e:
+                self.error_log.exception(str(e))
+            if self.snapshot is not None:
+                self.snapshot.flush()
+            if not self.shared_scan:
+                self.scanner.flush()
     
     def stop(self):
         self.stopped = True
@@ -289,8 +1099,17 @@ class SyncHandler(threading.Thread):
             
 class S3SyncHandler(SyncHandler):
     def __init__(self, storage, folder_name, loop=True, sec=DEFAULT_SLEEP_SECS, 
-                 log=False, log_obj=None):
-        super(S3SyncHandler, self).__init__(storage, folder_name, loop, sec, log, log_obj)
+                 log=False, log_obj=None, 
+                 snapshot=True, revalidate_secs=DEFAULT_REVALIDATE_SECS, retention=None,
+                 journal=True, pack_threshold=None, pack_size=DEFAULT_PACK_SIZE,
+                 scanner=None, compare=COMPARE_QUICK, audit_secs=DEFAULT_AUDIT_SECS,
+                 quiet_secs=DEFAULT_QUIET_SECS, max_defer_secs=DEFAULT_MAX_DEFER_SECS,
+                 copy_hot=False):
+        super(S3SyncHandler, self).__init__(storage, folder_name, loop, sec, log, log_obj,
+                                            snapshot, revalidate_secs, retention, journal,
+                                            pack_threshold, pack_size, scanner,
+                                            compare, audit_secs, quiet_secs, 
+                                            max_defer_secs, copy_hot)
         
         assert isinstance(storage, S3Storage)
         
@@ -307,29 +1126,160 @@ class S3SyncHandler(SyncHandler):
             
             yield f    
         
-    def _get_cloud_files(self):
-        files = {}
-        for f in self.storage.list_files('', True):
-            path, timestamp = self.cloud_to_local(f.path)
-            if isinstance(path, str):
-                path = path.decode('raw-unicode-escape').encode('utf-8')
-            elif isinstance(path, unicode):
-                path = path.encode('utf-8')
-            files[path] = FileEntry(f.path, timestamp, f.md5)
-            
-        return files
+    def _get_snapshot_key(self, cloud_path):
+        # the cloud path is escaped to ascii, the same as the listing returns.
+        return cloud_path
+        
+    def _get_local_path(self, path):
+        if isinstance(path, str):
+            return path.decode('raw-unicode-escape').encode('utf-8')
+        return path.encode('utf-8')
     
     def _upload(self, f, local_files_tm, cloud_files_tm):
         entry = local_files_tm[f]
         filename, timestamp = entry.path, entry.timestamp
         f_ = f.decode('utf-8').encode('raw-unicode-escape')
         cloud_path = self.local_to_cloud(f_, timestamp)
+        if self._pack(f, entry):
+            return
+        
+        if self._is_uploaded(cloud_path, entry):
+            self._record_upload(cloud_path, f, entry)
+            return
+        
+        op_id = self._begin_transfer(UPLOAD, filename, cloud_path, timestamp)
         try:
             self.storage.upload(cloud_path, filename)
+            self._record_upload(cloud_path, f, entry)
         except S3Error, e:
             self.error_log.info('upload file %s happens an error.' % f)
             raise e
+        finally:
+            self._end_transfer(op_id)
         
         if self.log:
             self.log_obj.write('上传了文件：%s' % f)
-            
\ No newline at end of file
+
+class SyncOrchestrator(threading.Thread):
+    '''
+    Sync the handlers of the same local folder,
+    the folder is walked and hashed once each cycle,
+    then each handler compares and transfers in its own thread.
+    So the local I/O stays the same as more clouds are added.
+    
+    Usage:
+    orchestrator = SyncOrchestrator('/local_folder')
+    orchestrator.add(SyncHandler(vdisk_storage, '/local_folder'))
+    orchestrator.add(S3SyncHandler(s3_storage, '/local_folder'))
+    orchestrator.start()
+    '''
+    
+    stopped = False
+    
+    def __init__(self, folder_name, loop=True, sec=DEFAULT_SLEEP_SECS, 
+                 walk_workers=DEFAULT_WALK_WORKERS, hash_workers=DEFAULT_HASH_WORKERS):
+        super(SyncOrchestrator, self).__init__()
+        
+        self.folder_name = folder_name
+        self.loop = loop
+        self.sec = sec
+        
+        self.scanner = LocalScanner(folder_name, workers=walk_workers, 
+                                    hash_workers=hash_workers)
+        self.restorer = MultiSourceDownloader()
+        self.handlers = []
+        self.lock = threading.Lock()
+        # the files downloaded by a handler in this cycle, each by only one.
+        self.claimed = set()
+        self.claim_lock = threading.Lock()
+        # set when a handler is added, so that it's synced without waiting a cycle.
+        self.wakeup = threading.Event()
+        
+    def add(self, handler):
+        assert handler.folder_name == self.folder_name
+        
+        handler.scanner = self.scanner
+        handler.shared_scan = True
+        self.lock.acquire()
+        try:
+            self.handlers.append(handler)
+            self._link()
+        finally:
+            self.lock.release()
+        self.wakeup.set()
+        
+    def _link(self):
+        # each handler knows the others, to download from all the clouds.
+        for handler in self.handlers:
+            handler.mirrors = [other for other in self.handlers if other is not handler]
+            handler.restorer = self.restorer
+            handler.claim = self.claim
+            
+    def claim(self, path):
+        '''
+        :return: True if no other handler downloads the file in this cycle.
+        '''
+        
+        self.claim_lock.acquire()
+        try:
+            if path in self.claimed:
+                return False
+            self.claimed.add(path)
+            return True
+        finally:
+            self.claim_lock.release()
+        
+    def remove(self, handler):
+        self.lock.acquire()
+        try:
+            if handler in self.handlers:
+                self.handlers.remove(handler)
+                handler.mirrors = []
+                handler.claim = None
+                self._link()
+            return len(self.handlers)
+        finally:
+            self.lock.release()
+            
+    def sync(self):
+        self.lock.acquire()
+        try:
+            handlers = [handler for handler in self.handlers if not handler.stopped]
+        finally:
+            self.lock.release()
+        if not handlers:
+            return
+        
+        self.scanner.scan()
+        self.claim_lock.acquire()
+        try:
+            self.claimed = set()
+        finally:
+            self.claim_lock.release()
+        
+        threads = []
+        for handler in handlers:
+            thread = threading.Thread(target=handler.sync)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.scanner.flush()
+            
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        
+    def run(self):
+        if self.folder_name is None or \
+            len(self.folder_name) == 0:
+            return
+        
+        self.sync()
+        while self.loop and not self.stopped:
+            self.wakeup.wait(self.sec)
+            self.wakeup.clear()
+            if self.stopped:
+                break
+            self.sync()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import time
+import random
+import hashlib
+import tempfile
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.errors import CloudBackupError
+from CloudBackup.lib.errors import CloudBackupLibError
+from CloudBackup.utils import join_path, get_info_path, ensure_folder_exsits
+
+# the folder on the cloud keeps the packs and the index, hidden from the sync.
+PACK_FOLDER = '.cbpacks'
+INDEX_NAME = 'index'
+
+DEFAULT_PACK_THRESHOLD = 4 * 1024
+DEFAULT_PACK_SIZE = 4 * 1024 * 1024
+# a pack is rewritten when the bytes no longer used pass the ratio of its size.
+DEFAULT_COMPACT_RATIO = 0.5
+
+get_pack_index_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.packs' % name)
+is_pack_path = lambda cloud_path: \
+    cloud_path.strip('/').startswith(PACK_FOLDER + '/')
+
+class PackedFile(object):
+    def __init__(self, pack, offset, length, md5, timestamp):
+        '''
+        :param pack: the name of the pack.
+        :param offset: where the content starts in the pack.
+        :param length: the length of the content.
+        :param md5: the md5 of the content, after encrypted if the client encrypts.
+        :param timestamp: the mtime of the local file.
+        '''
+        
+        self.pack = pack
+        self.offset = offset
+        self.length = length
+        self.md5 = md5
+        self.timestamp = timestamp
+
+class PackIndex(object):
+    '''
+    The files in the packs, and the size of each pack.
+    It's kept in the info folder, and a copy is uploaded to the cloud,
+    so that the packed files can be restored on another machine.
+    '''
+    
+    def __init__(self, name):
+        '''
+        :param name: the name of the index file in the info folder.
+        '''
+        
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_pack_index_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        self.files = {}
+        self.packs = {}
+        
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        fp = open(self.path, 'rb')
+        try:
+            self.loads(fp.read())
+        finally:
+            fp.close()
+    
+    def loads(self, data):
+        try:
+            content = pickle.loads(data)
+            self.files = content['files']
+            self.packs = content['packs']
+        except (EOFError, pickle.UnpicklingError, KeyError, ValueError):
+            self.files, self.packs = {}, {}
+    
+    def dumps(self):
+        self.lock.acquire()
+        try:
+            return pickle.dumps({'files': self.files, 'packs': self.packs},
+                                pickle.HIGHEST_PROTOCOL)
+        finally:
+            self.lock.release()
+    
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        fp = open(tmp_path, 'wb')
+        try:
+            fp.write(self.dumps())
+        finally:
+            fp.close()
+        
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+    
+    def get(self, path):
+        return self.files.get(path)
+    
+    def add_pack(self, pack, size, members):
+        '''
+        :param members: dict of the path and the PackedFile.
+        '''
+        
+        self.lock.acquire()
+        try:
+            self.packs[pack] = size
+            self.files.update(members)
+        finally:
+            self.lock.release()
+    
+    def remove(self, path):
+        self.lock.acquire()
+        try:
+            return self.files.pop(path, None)
+        finally:
+            self.lock.release()
+    
+    def remove_pack(self, pack):
+        self.lock.acquire()
+        try:
+            self.packs.pop(pack, None)
+        finally:
+            self.lock.release()
+    
+    def get_live_bytes(self):
+        '''
+        :return: dict of the pack and the bytes of the files still in use.
+        '''
+        
+        live = dict((pack, 0) for pack in self.packs)
+        for record in self.files.itervalues():
+            live[record.pack] = live.get(record.pack, 0) + record.length
+        return live
+    
+    def iter_files(self):
+        for path, record in self.files.items():
+            yield path, record
+    
+    def __len__(self):
+        return len(self.files)
+
+class PackStore(object):
+    '''
+    Pack the small files into large objects on the cloud,
+    so that hundreds of small files cost one request instead of hundreds.
+    
+    Each file is encrypted by itself before packed, if the client encrypts,
+    so that a single file can be restored by a ranged read of the pack.
+    
+    Usage:
+    store = PackStore(storage, 's3.my_bucket')
+    if store.accepts(filename):
+        store.add(path, filename, timestamp)
+    ...
+    store.flush() # upload the pending pack, compact and upload the index.
+    store.restore(path, '/local_path/file_name')
+    '''
+    
+    def __init__(self, storage, name, threshold=DEFAULT_PACK_THRESHOLD,
+                 pack_size=DEFAULT_PACK_SIZE, compact_ratio=DEFAULT_COMPACT_RATIO,
+                 encrypt_func=None, decrypt_func=None):
+        '''
+        :param storage: an instance of Storage or its subclass.
+        :param name: the name of the index file in the info folder.
+        :param threshold(optional): the files smaller than it are packed.
+        :param pack_size(optional): the size a pack is uploaded when reaches.
+        :param compact_ratio(optional): the ratio of the bytes not used,
+                                        the pack is rewritten when passes it.
+        :param encrypt_func(optional): encrypt each file before packed.
+        :param decrypt_func(optional): decrypt each file after restored.
+        '''
+        
+        self.storage = storage
+        self.threshold = threshold
+        self.pack_size = pack_size
+        self.compact_ratio = compact_ratio
+        self.encrypt_func = encrypt_func
+        self.decrypt_func = decrypt_func
+        
+        self.index = PackIndex(name)
+        if len(self.index) == 0:
+            self._fetch_index()
+        
+        self.pending = []
+        self.pending_size = 0
+        self.dirty = False
+    
+    def _get_cloud_path(self, name):
+        return join_path(PACK_FOLDER, name)
+    
+    def _fetch_index(self):
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            try:
+                self.storage.download(self._get_cloud_path(INDEX_NAME), tmp)
+            except CloudBackupLibError:
+                # no file is packed yet.
+                return
+            fp = open(tmp, 'rb')
+            try:
+                self.index.loads(fp.read())
+            finally:
+                fp.close()
+            self.index.save()
+        finally:
+            os.remove(tmp)
+    
+    def _upload_index(self):
+        self.index.save()
+        
+        fd, tmp = tempfile.mkstemp()
+        try:
+            os.write(fd, self.index.dumps())
+        finally:
+            os.close(fd)
+        try:
+            self.storage.upload(self._get_cloud_path(INDEX_NAME), tmp)
+        finally:
+            os.remove(tmp)
+        self.dirty = False
+    
+    def accepts(self, filename):
+        try:
+            return os.path.getsize(filename) < self.threshold
+        except OSError:
+            return False
+    
+    def get(self, path):
+        return self.index.get(path)
+    
+    def iter_files(self):
+        return self.index.iter_files()
+    
+    def add(self, path, filename, timestamp):
+        '''
+        Add a file to the pending pack, the pack is uploaded when it's large enough.
+        
+        :param path: the relative path of the local file.
+        :param filename: the local file's absolute path.
+        :param timestamp: the mtime of the local file.
+        
+        :return: the list of the paths uploaded by this call.
+        '''
+        
+        fp = open(filename, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        if self.encrypt_func is not None:
+            data = self.encrypt_func(data)
+        
+        self.pending.append((path, timestamp, data))
+        self.pending_size += len(data)
+        if self.pending_size >= self.pack_size:
+            return self._flush_pending()
+        return []
+    
+    def discard(self, path):
+        '''
+        Forget a packed file, when it's uploaded by itself eg.
+        The bytes in the pack are reclaimed by the compaction.
+        '''
+        
+        if self.index.remove(path) is not None:
+            self.dirty = True
+    
+    def _write_pack(self, members):
+        '''
+        :param members: list of (path, timestamp, data), the data is encrypted already.
+        '''
+        
+        pack = 'pack-%d-%08x' % (int(time.time()), random.getrandbits(32))
+        records = {}
+        
+        fd, tmp = tempfile.mkstemp()
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                offset = 0
+                for path, timestamp, data in members:
+                    fp.write(data)
+                    md5 = hashlib.md5(data).hexdigest()
+                    records[path] = PackedFile(pack, offset, len(data), md5, timestamp)
+                    offset += len(data)
+            finally:
+                fp.close()
+            
+            self.storage.upload_raw(self._get_cloud_path(pack), tmp)
+        finally:
+            os.remove(tmp)
+        
+        # the index refers to the pack only after it's uploaded,
+        # and it's saved at once, so the pack is never orphaned if the sync stops.
+        self.index.add_pack(pack, offset, records)
+        self.index.save()
+        self.dirty = True
+        return pack
+    
+    def _flush_pending(self):
+        if not self.pending:
+            return []
+        
+        members, self.pending, self.pending_size = self.pending, [], 0
+        self._write_pack(members)
+        return [path for path, _, _ in members]
+    
+    def _read(self, record):
+        data = self.storage.download_range(self._get_cloud_path(record.pack),
+                                           record.offset, record.length)
+        if hashlib.md5(data).hexdigest() != record.md5:
+            raise CloudBackupError('pack', -1,
+                                   'The content in %s is broken.' % record.pack)
+        return data
+    
+    def compact(self):
+        '''
+        Rewrite the packs whose bytes not used pass the compact ratio,
+        and delete the packs not used at all.
+        
+        :return: the list of the packs deleted.
+        '''
+        
+        obsolete = []
+        for pack, live in self.index.get_live_bytes().iteritems():
+            size = self.index.packs.get(pack, 0)
+            if live == 0 or size == 0 or \
+                1 - float(live) / size >= self.compact_ratio:
+                obsolete.append(pack)
+        if not obsolete:
+            return []
+        
+        obsolete_set = set(obsolete)
+        members, members_size = [], 0
+        for path, record in sorted(self.index.iter_files(),
+                                   key=lambda itm: (itm[1].pack, itm[1].offset)):
+            if record.pack not in obsolete_set:
+                continue
+            data = self._read(record)
+            members.append((path, record.timestamp, data))
+            members_size += len(data)
+            if members_size >= self.pack_size:
+                self._write_pack(members)
+                members, members_size = [], 0
+        if members:
+            self._write_pack(members)
+        
+        # the index is uploaded before the old packs are deleted,
+        # so it never refers to a pack which doesn't exist.
+        for pack in obsolete:
+            self.index.remove_pack(pack)
+        self._upload_index()
+        
+        deleted, _ = self.storage.delete_files(self._get_cloud_path(pack) for pack in obsolete)
+        return deleted
+    
+    def flush(self):
+        '''
+        Upload the pending pack, compact the packs, and upload the index if changed.
+        
+        :return: the list of the paths uploaded.
+        '''
+        
+        uploaded = self._flush_pending()
+        self.compact()
+        if self.dirty:
+            self._upload_index()
+        return uploaded
+    
+    def restore(self, path, filename):
+        '''
+        Restore a packed file by a ranged read of its pack.
+        
+        :param path: the relative path of the local file.
+        :param filename: the local file's absolute path.
+        '''
+        
+        record = self.index.get(path)
+        if record is None:
+            raise CloudBackupError('pack', -1, '%s is not packed.' % path)
+        
+        data = self._read(record)
+        if self.decrypt_func is not None:
+            data = self.decrypt_func(data)
+        
+        fp = open(filename, 'wb')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.errors import CloudBackupError
+from CloudBackup.lib.errors import CloudBackupLibError
+from CloudBackup.log import Log
+from CloudBackup.journal import get_part_path
+from CloudBackup.packs import PackStore, is_pack_path
+from CloudBackup.utils import join_local_path, get_info_path, ensure_folder_exsits
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_PROBE_SIZE = 64 * 1024
+# the connections to each source at the same time.
+DEFAULT_CONNECTIONS = 2
+# a chunk not received in the seconds is asked from another source as well.
+DEFAULT_STALL_SECS = 30
+# a source is given up in a file after the errors.
+DEFAULT_MAX_ERRORS = 3
+# the weight of the latest transfer in the rate of a source.
+RATE_SMOOTHING = 0.3
+
+md5_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+DEFAULT_RESTORE_WORKERS = 16
+REPORT_NAME = '.restore.report.txt'
+
+RESTORED = 'restored'
+RESUMED = 'resumed'
+UNVERIFIED = 'unverified'
+MISMATCHED = 'mismatched'
+FAILED = 'failed'
+
+get_progress_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.restore' % name)
+
+class RestoreSource(object):
+    def __init__(self, storage, cloud_path, md5, size=None, decryptor=None):
+        '''
+        :param storage: an instance of Storage or its subclass.
+        :param cloud_path: the path of the file on the storage.
+        :param md5: the md5 of the content on the cloud, after encrypted if the client encrypts.
+        :param size(optional): the size of the content on the cloud, None if unknown.
+        :param decryptor(optional): return a new stream to decrypt the content read by ranges,
+                                    DES.decryptor eg, so each download has its own state.
+        '''
+        
+        self.storage = storage
+        self.cloud_path = cloud_path
+        self.md5 = md5
+        self.size = size
+        self.decryptor = decryptor
+    
+    def read(self, offset, length):
+        return self.storage.download_range(self.cloud_path, offset, length)
+
+class MultiSourceDownloader(object):
+    '''
+    Download a file kept by several clouds from all of them at the same time.
+    
+    The file is split into chunks, each source takes the next chunk when it's free,
+    so the faster sources take more, and the bandwidth of all the clouds is used.
+    A chunk failed is taken by the other sources, and a chunk stalled is asked again,
+    the one arrives first is kept.
+    The content is checked by the md5 at last.
+    
+    The sources must keep the same content, so that their md5 on the cloud are the same.
+    
+    Usage:
+    downloader = MultiSourceDownloader()
+    downloader.download([RestoreSource(s3_storage, 'a.txt', md5, size),
+                         RestoreSource(gs_storage, 'a.txt', md5, size)], '/local_path/a.txt')
+    '''
+    
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, connections=DEFAULT_CONNECTIONS,
+                 stall_secs=DEFAULT_STALL_SECS, probe_size=DEFAULT_PROBE_SIZE,
+                 max_errors=DEFAULT_MAX_ERRORS):
+        '''
+        :param chunk_size(optional): the bytes of each ranged read,
+                                     the smaller files are downloaded as a whole.
+        :param connections(optional): the connections to each source at the same time.
+        :param stall_secs(optional): a chunk not received in the seconds is asked again.
+        :param probe_size(optional): the bytes read to probe a source never used.
+        :param max_errors(optional): a source is given up in a file after the errors.
+        '''
+        
+        self.chunk_size = chunk_size
+        self.connections = max(connections, 1)
+        self.stall_secs = stall_secs
+        self.probe_size = probe_size
+        self.max_errors = max_errors
+        
+        # the storage and (the bytes per second, the seconds of the latest request, the errors).
+        self.stats = {}
+        self.lock = threading.Lock()
+    
+    def _record(self, storage, size, elapsed):
+        elapsed = max(elapsed, 0.001)
+        self.lock.acquire()
+        try:
+            rate, _, errors = self.stats.get(storage, (None, None, 0))
+            current = size / elapsed
+            if rate is not None:
+                current = RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * rate
+            self.stats[storage] = (current, elapsed, errors)
+        finally:
+            self.lock.release()
+    
+    def _record_error(self, storage):
+        self.lock.acquire()
+        try:
+            rate, latency, errors = self.stats.get(storage, (None, None, 0))
+            self.stats[storage] = (rate, latency, errors + 1)
+        finally:
+            self.lock.release()
+    
+    def get_rate(self, storage):
+        return self.stats.get(storage, (None, None, 0))[0]
+    
+    def get_stats(self):
+        '''
+        :return: dict of the name of the storage and
+                 (the bytes per second, the seconds of the latest request, the errors).
+        '''
+        
+        self.lock.acquire()
+        try:
+            return dict(('%s.%s' % (storage.__class__.__name__, getattr(storage, 'holder', '')),
+                         stats) for storage, stats in self.stats.iteritems())
+        finally:
+            self.lock.release()
+    
+    def probe(self, sources):
+        '''
+        Read the head of the file from the sources never used, to know their speed.
+        
+        :return: the sources alive, the faster ones first.
+        '''
+        
+        failed = set()
+        
+        def _probe(source):
+            start = time.time()
+            try:
+                data = source.read(0, self.probe_size)
+            except CloudBackupLibError:
+                self._record_error(source.storage)
+                failed.add(source)
+                return
+            self._record(source.storage, len(data), time.time() - start)
+        
+        threads = []
+        for source in sources:
+            if source.storage.ranged and self.get_rate(source.storage) is None:
+                thread = threading.Thread(target=_probe, args=(source, ))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        
+        alive = [source for source in sources if source not in failed]
+        return sorted(alive, key=lambda source: -(self.get_rate(source.storage) or 0))
+    
+    def download(self, sources, filename):
+        '''
+        :param sources: list of RestoreSource.
+        :param filename: the local file's absolute path.
+        
+        :return: dict of the source and the bytes read from it.
+        '''
+        
+        if not sources:
+            raise CloudBackupError('restore', -1, 'No source to download %s.' % filename)
+        
+        size = None
+        for source in sources:
+            if source.size is not None:
+                size = source.size
+                break
+        
+        ranged = [source for source in sources if source.storage.ranged]
+        if size is None or size <= self.chunk_size or len(ranged) < 2:
+            return self._download_whole(sources, filename)
+        
+        ranged = self.probe(ranged)
+        if len(ranged) < 2:
+            return self._download_whole(ranged or sources, filename)
+        
+        received = self._download_chunks(ranged, size, filename)
+        self._verify(ranged[0], filename)
+        self._decrypt(ranged[0], filename)
+        return received
+    
+    def _download_whole(self, sources, filename):
+        # the fastest source first, the others are the fallbacks.
+        sources = sorted(sources, key=lambda source: -(self.get_rate(source.storage) or 0))
+        error = None
+        for source in sources:
+            start = time.time()
+            try:
+                source.storage.download(source.cloud_path, filename)
+            except CloudBackupLibError, e:
+                self._record_error(source.storage)
+                error = e
+                continue
+            if source.size is not None:
+                self._record(source.storage, source.size, time.time() - start)
+            return {source: source.size}
+        raise error
+    
+    def _download_chunks(self, sources, size, filename):
+        chunks = [(offset, min(self.chunk_size, size - offset))
+                  for offset in range(0, size, self.chunk_size)]
+        
+        cond = threading.Condition()
+        pending = deque(range(len(chunks)))
+        inflight, hedged, done = {}, set(), set()
+        received = dict((source, 0) for source in sources)
+        state = {'workers': 0, 'error': None}
+        
+        fp = open(filename, 'wb')
+        fp.truncate(size)
+        
+        def _take():
+            cond.acquire()
+            try:
+                while len(done) < len(chunks):
+                    while pending:
+                        i = pending.popleft()
+                        if i not in done:
+                            inflight[i] = time.time()
+                            return i
+                    cond.wait(0.5)
+            finally:
+                cond.release()
+        
+        def _work(source):
+            errors = 0
+            try:
+                while errors < self.max_errors:
+                    i = _take()
+                    if i is None:
+                        return
+                    offset, length = chunks[i]
+                    
+                    start = time.time()
+                    try:
+                        data = source.read(offset, length)
+                        if len(data) != length:
+                            raise CloudBackupError('restore', -1,
+                                                   'Read %d bytes, %d expected.' % (len(data), length))
+                    except CloudBackupLibError, e:
+                        errors += 1
+                        self._record_error(source.storage)
+                        cond.acquire()
+                        try:
+                            state['error'] = e
+                            # the other sources take it.
+                            if i not in done:
+                                pending.appendleft(i)
+                            cond.notify_all()
+                        finally:
+                            cond.release()
+                        continue
+                    self._record(source.storage, length, time.time() - start)
+                    
+                    cond.acquire()
+                    try:
+                        if i not in done:
+                            fp.seek(offset)
+                            fp.write(data)
+                            done.add(i)
+                            received[source] += length
+                        inflight.pop(i, None)
+                        cond.notify_all()
+                    finally:
+                        cond.release()
+            finally:
+                cond.acquire()
+                try:
+                    state['workers'] -= 1
+                    cond.notify_all()
+                finally:
+                    cond.release()
+        
+        cond.acquire()
+        try:
+            for source in sources:
+                for _ in range(self.connections):
+                    state['workers'] += 1
+                    thread = threading.Thread(target=_work, args=(source, ))
+                    thread.setDaemon(True)
+                    thread.start()
+            
+            while len(done) < len(chunks):
+                if state['workers'] == 0:
+                    raise state['error'] or \
+                        CloudBackupError('restore', -1, 'No source available.')
+                
+                now = time.time()
+                for i, started in inflight.items():
+                    if i in done:
+                        del inflight[i]
+                    elif now - started > self.stall_secs and i not in hedged:
+                        hedged.add(i)
+                        pending.append(i)
+                        cond.notify_all()
+                cond.wait(0.5)
+        finally:
+            # the workers left find the chunks done and exit.
+            done.update(range(len(chunks)))
+            cond.notify_all()
+            cond.release()
+            fp.close()
+        
+        return received
+    
+    def _verify(self, source, filename):
+        if source.md5 is None or not md5_pattern.match(source.md5):
+            return
+        
+        md5 = hashlib.md5()
+        fp = open(filename, 'rb')
+        try:
+            while True:
+                data = fp.read(self.chunk_size)
+                if not data:
+                    break
+                md5.update(data)
+        finally:
+            fp.close()
+        
+        if md5.hexdigest() != source.md5:
+            raise CloudBackupError('restore', -1,
+                                   'The content of %s is broken.' % source.cloud_path)
+    
+    def _decrypt(self, source, filename):
+        # the ranges are read without the decryption of the client.
+        if source.decryptor is None:
+            return
+        
+        stream = source.decryptor()
+        tmp = filename + '.decrypt'
+        src, dst = open(filename, 'rb'), open(tmp, 'wb')
+        try:
+            try:
+                while True:
+                    data = src.read(self.chunk_size)
+                    if not data:
+                        break
+                    dst.write(stream.update(data))
+                dst.write(stream.final())
+            finally:
+                src.close()
+                dst.close()
+        except:
+            os.remove(tmp)
+            raise
+        os.remove(filename)
+        os.rename(tmp, filename)
+
+class RestoreTask(object):
+    __slots__ = ('path', 'cloud_path', 'timestamp', 'md5', 'size', 'packed')
+    
+    def __init__(self, path, cloud_path, timestamp, md5, size=None, packed=False):
+        '''
+        :param path: the relative path of the local file, utf-8 encoded.
+        :param cloud_path: the path on the cloud.
+        :param timestamp: the mtime of the file when uploaded, -1 if unknown.
+        :param md5: the md5 of the content on the cloud.
+        :param size(optional): the size of the content on the cloud, None if unknown.
+        :param packed(optional): if the file is kept in a pack.
+        '''
+        
+        self.path = path
+        self.cloud_path = cloud_path
+        self.timestamp = timestamp
+        self.md5 = md5
+        self.size = size
+        self.packed = packed
+
+class RestoreProgress(object):
+    '''
+    The files restored, appended to a file in the info folder one by one,
+    so that an interrupted restore continues from where it stops.
+    '''
+    
+    def __init__(self, name):
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_progress_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        self.done = {}
+        self.load()
+        
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        fp = open(self.path, 'rb')
+        try:
+            while True:
+                try:
+                    path, md5 = pickle.load(fp)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                self.done[path] = md5
+        finally:
+            fp.close()
+            
+    def is_done(self, task):
+        return task.path in self.done and self.done[task.path] == task.md5
+    
+    def add(self, task):
+        self.lock.acquire()
+        try:
+            fp = open(self.path, 'ab')
+            try:
+                pickle.dump((task.path, task.md5), fp, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            self.done[task.path] = task.md5
+        finally:
+            self.lock.release()
+            
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.done = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        finally:
+            self.lock.release()
+
+class RestoreReport(object):
+    def __init__(self):
+        self.results = []
+        self.counts = dict((status, 0) for status in 
+                           (RESTORED, RESUMED, UNVERIFIED, MISMATCHED, FAILED))
+        self.folders = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+        
+    def add(self, status, task, detail=None):
+        self.results.append((status, task.path, detail))
+        self.counts[status] += 1
+        if status in (RESTORED, UNVERIFIED) and task.size is not None:
+            self.bytes += task.size
+            
+    @property
+    def ok(self):
+        return self.counts[FAILED] == 0 and self.counts[MISMATCHED] == 0
+    
+    def write(self, filename):
+        self.end = self.end or time.time()
+        
+        logs = ['恢复了%d个文件，%d个文件夹，用时%d秒' % (
+                    sum(self.counts.itervalues()), self.folders, int(self.end - self.start))]
+        logs.append(', '.join('%s: %d' % (status, count) 
+                              for status, count in sorted(self.counts.iteritems())))
+        for status, path, detail in sorted(self.results, key=lambda itm: itm[1]):
+            if detail:
+                logs.append('%s %s %s' % (status, path, detail))
+            else:
+                logs.append('%s %s' % (status, path))
+        Log(filename).write_logs(logs)
+
+class BulkRestore(object):
+    '''
+    Restore all the files of a cloud to a local folder, for the disaster recovery.
+    
+    The listing is streamed, and the folders are created while listing,
+    then the files are downloaded by many threads, the small ones first,
+    so that most of the files are usable soon.
+    Each file restored is recorded, so an interrupted restore skips them next time.
+    At last, a report of the files is written to the folder.
+    
+    Usage:
+    handler = SyncHandler(storage, '/new_folder', loop=False, snapshot=False)
+    report = BulkRestore(handler).run()
+    '''
+    
+    def __init__(self, handler, workers=DEFAULT_RESTORE_WORKERS, verify=True,
+                 report_name=REPORT_NAME):
+        '''
+        :param handler: an instance of SyncHandler or its subclass, not started,
+                        which knows the cloud and the local folder.
+        :param workers(optional): the files downloaded at the same time.
+        :param verify(optional): check the md5 of each file restored.
+        :param report_name(optional): the name of the report in the local folder.
+        '''
+        
+        self.handler = handler
+        self.storage = handler.storage
+        self.folder_name = handler.folder_name
+        self.workers = max(workers, 1)
+        self.verify = verify
+        self.report_name = report_name
+        
+        folder_key = self.folder_name
+        if isinstance(folder_key, unicode):
+            folder_key = folder_key.encode('utf-8')
+        self.name = '%s.%s' % (handler.info_name, hashlib.md5(folder_key).hexdigest()[:8])
+        
+        self.packs = handler.packs
+        self.progress = None
+        self.report = None
+        
+    def _get_local_filename(self, path):
+        return join_local_path(self.folder_name, path.decode('utf-8'))
+    
+    def _ensure_folder(self, path, created):
+        dirname = os.path.dirname(self._get_local_filename(path))
+        if dirname in created:
+            return
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+            self.report.folders += 1
+        created.add(dirname)
+    
+    def _list(self):
+        '''
+        :return: dict of the relative path and the RestoreTask of the latest version.
+        '''
+        
+        tasks, created = {}, set()
+        has_packs = False
+        for f in self.storage.list_files('', True):
+            if is_pack_path(f.path):
+                has_packs = True
+                continue
+            
+            path, timestamp = self.handler.cloud_to_local(f.path)
+            path = self.handler._get_local_path(path)
+            task = tasks.get(path)
+            if task is not None and task.timestamp >= timestamp:
+                continue
+            tasks[path] = RestoreTask(path, f.path, timestamp, f.md5, getattr(f, 'size', None))
+            # the skeleton is built while listing.
+            self._ensure_folder(path, created)
+            
+        if has_packs and self.packs is None:
+            self.packs = PackStore(self.storage, self.handler.info_name, 
+                                   encrypt_func=self._get_encrypt_func(),
+                                   decrypt_func=self._get_decrypt_func())
+        if self.packs is not None:
+            for path, record in self.packs.iter_files():
+                task = tasks.get(path)
+                if task is not None and task.timestamp >= record.timestamp:
+                    continue
+                tasks[path] = RestoreTask(path, None, record.timestamp, record.md5, 
+                                          record.length, packed=True)
+                self._ensure_folder(path, created)
+        return tasks
+    
+    def _get_encrypt_func(self):
+        if hasattr(self.storage.client, 'des'):
+            return self.storage.client.des.encrypt
+        
+    def _get_decrypt_func(self):
+        if hasattr(self.storage.client, 'des'):
+            return self.storage.client.des.decrypt
+    
+    def _check(self, task, filename):
+        if task.md5 is None or not md5_pattern.match(task.md5):
+            return UNVERIFIED, 'no md5 on the cloud'
+        
+        md5 = hashlib.md5()
+        stream = None
+        if hasattr(self.storage.client, 'des'):
+            stream = self.storage.client.des.encryptor()
+        fp = open(filename, 'rb')
+        try:
+            while True:
+                data = fp.read(DEFAULT_CHUNK_SIZE)
+                if not data:
+                    break
+                md5.update(stream.update(data) if stream is not None else data)
+        finally:
+            fp.close()
+        if stream is not None:
+            md5.update(stream.final())
+            
+        if md5.hexdigest() != task.md5:
+            return MISMATCHED, 'md5 differs from the cloud'
+        return RESTORED, None
+    
+    def _restore(self, task):
+        filename = self._get_local_filename(task.path)
+        if self.progress.is_done(task) and os.path.exists(filename):
+            return RESUMED, task, None
+        
+        part = get_part_path(filename)
+        try:
+            try:
+                if task.packed:
+                    self.packs.restore(task.path, part)
+                else:
+                    self.storage.download(task.cloud_path, part)
+                
+                status, detail = RESTORED, None
+                if self.verify:
+                    status, detail = self._check(task, part)
+                
+                # the file is kept even if the md5 differs, but it's tried again next time,
+                # and it never replaces the file already there.
+                if status == MISMATCHED and os.path.exists(filename):
+                    return status, task, detail
+                if os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(part, filename)
+                if task.timestamp >= 0:
+                    os.utime(filename, (task.timestamp, task.timestamp))
+            except CloudBackupLibError, e:
+                return FAILED, task, str(e)
+            except Exception, e:
+                # a file goes wrong doesn't stop restoring the others.
+                return FAILED, task, '%s: %s' % (type(e).__name__, e)
+            
+            if status != MISMATCHED:
+                self.progress.add(task)
+            return status, task, detail
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+    
+    def run(self):
+        '''
+        :return: an instance of RestoreReport.
+        '''
+        
+        self.report = RestoreReport()
+        self.progress = RestoreProgress(self.name)
+        
+        tasks = self._list()
+        # the small files first, the ones of unknown size at last.
+        ordered = sorted(tasks.itervalues(), 
+                         key=lambda task: (task.size is None, task.size, task.path))
+        
+        pool = ThreadPool(self.workers)
+        try:
+            for status, task, detail in pool.imap_unordered(self._restore, ordered):
+                self.report.add(status, task, detail)
+        finally:
+            pool.close()
+            pool.join()
+            
+        self.report.end = time.time()
+        self.report.write(os.path.join(self.folder_name, self.report_name))
+        if self.report.ok:
+            self.progress.clear()
+        return self.report
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.utils import get_info_path, ensure_folder_exsits
+
+get_sessions_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.sessions' % name)
+
+class UploadSessions(object):
+    '''
+    The sessions of the resumable uploads, persisted in the info folder,
+    so that the interrupted uploads continue after the process restarts.
+    
+    It works as a dict, and the file is rewritten on each change,
+    which is cheap because only the unfinished uploads are kept.
+    '''
+    
+    def __init__(self, name):
+        '''
+        :param name: the name of the sessions file in the info folder.
+        '''
+        
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_sessions_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.load()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        
+        fp = open(self.path, 'rb')
+        try:
+            self.sessions = pickle.load(fp)
+        except (EOFError, pickle.UnpicklingError):
+            self.sessions = {}
+        finally:
+            fp.close()
+    
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        fp = open(tmp_path, 'wb')
+        try:
+            pickle.dump(self.sessions, fp, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+    
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            return self.sessions.get(key, default)
+        finally:
+            self.lock.release()
+    
+    def __setitem__(self, key, session):
+        self.lock.acquire()
+        try:
+            self.sessions[key] = session
+            self._save()
+        finally:
+            self.lock.release()
+    
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.sessions:
+                return default
+            session = self.sessions.pop(key)
+            self._save()
+            return session
+        finally:
+            self.lock.release()
+    
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import os
+import time
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from CloudBackup.cloud import CloudFile
+from CloudBackup.utils import get_info_path, ensure_folder_exsits
+
+DEFAULT_REVALIDATE_HOURS = 1
+DEFAULT_REVALIDATE_SECS = DEFAULT_REVALIDATE_HOURS * 60 * 60
+
+get_snapshot_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.snapshot' % name)
+get_snapshot_log_path = lambda dirpath, name: \
+    os.path.join(dirpath, '.%s.snapshot.log' % name)
+
+class CloudSnapshot(object):
+    '''
+    A persisted snapshot of the files in the holder of a storage.
+    
+    The files are listed from the cloud only when the snapshot is stale,
+    which means the revalidate interval passes,
+    or the change token of the storage(dologid of vdisk eg.) differs from the recorded one.
+    Otherwise, the snapshot is kept up to date by our own uploads and deletes.
+    
+    Each change is appended to a log file at once,
+    and the whole snapshot is rewritten when flush.
+    '''
+    
+    def __init__(self, storage, name, revalidate_secs=DEFAULT_REVALIDATE_SECS):
+        '''
+        :param storage: an instance of Storage or its subclass.
+        :param name: the name of the snapshot file in the info folder.
+        :param revalidate_secs(optional): the max seconds between two full listings.
+        '''
+        
+        self.storage = storage
+        self.revalidate_secs = revalidate_secs
+        
+        info_path = get_info_path()
+        ensure_folder_exsits(info_path)
+        self.path = get_snapshot_path(info_path, name)
+        self.log_path = get_snapshot_log_path(info_path, name)
+        
+        self.lock = threading.Lock()
+        self.files = {}
+        self.validated = 0
+        self.token = None
+        
+        self.load()
+    
+    def load(self):
+        if os.path.exists(self.path):
+            fp = open(self.path, 'rb')
+            try:
+                content = pickle.load(fp)
+                self.files = content['files']
+                self.validated = content['validated']
+                self.token = content['token']
+            except (EOFError, pickle.UnpicklingError, KeyError):
+                self.files, self.validated, self.token = {}, 0, None
+            finally:
+                fp.close()
+        
+        if os.path.exists(self.log_path):
+            fp = open(self.log_path, 'rb')
+            try:
+                while True:
+                    try:
+                        key, entry, token = pickle.load(fp)
+                    except (EOFError, pickle.UnpicklingError, ValueError):
+                        # the last record may be broken if the process exits while writing.
+                        break
+                    self._apply(key, entry, token)
+            finally:
+                fp.close()
+    
+    def flush(self):
+        '''
+        Rewrite the whole snapshot, and clear the change log.
+        '''
+        
+        self.lock.acquire()
+        try:
+            tmp_path = self.path + '.tmp'
+            fp = open(tmp_path, 'wb')
+            try:
+                content = {'files': self.files,
+                           'validated': self.validated,
+                           'token': self.token}
+                pickle.dump(content, fp, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+            
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        finally:
+            self.lock.release()
+    
+    def _apply(self, key, entry, token):
+        if entry is None:
+            self.files.pop(key, None)
+        else:
+            self.files[key] = entry
+        if token is not None:
+            self.token = token
+    
+    def _record(self, key, entry):
+        token = self.storage.get_change_token(probe=False)
+        
+        self.lock.acquire()
+        try:
+            self._apply(key, entry, token)
+            
+            fp = open(self.log_path, 'ab')
+            try:
+                pickle.dump((key, entry, token), fp, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+        finally:
+            self.lock.release()
+    
+    def add(self, key, md5=None, size=None):
+        '''
+        Record a file uploaded by ourselves.
+        
+        :param key: the cloud path of the file, the same as the listing returns.
+        :param md5(optional): the md5 of the content on the cloud, None if unknown.
+        :param size(optional): the size of the content on the cloud, None if unknown.
+        '''
+        
+        self._record(key, (md5, size, int(time.time())))
+    
+    def remove(self, key):
+        '''
+        Record a file deleted by ourselves.
+        
+        :param key: the cloud path of the file, the same as the listing returns.
+        '''
+        
+        self._record(key, None)
+    
+    def is_stale(self):
+        if time.time() - self.validated >= self.revalidate_secs:
+            return True
+        
+        token = self.storage.get_change_token()
+        return token is not None and token != self.token
+    
+    def refresh(self, force=False):
+        '''
+        List all the files from the cloud if the snapshot is stale.
+        
+        :param force(optional): if True, list from the cloud even if the snapshot is fresh.
+        '''
+        
+        if not force and not self.is_stale():
+            return
+        
+        files = {}
+        now = int(time.time())
+        for f in self.storage.list_files('', True):
+            files[f.path] = (f.md5, getattr(f, 'size', None), now)
+        
+        self.lock.acquire()
+        try:
+            self.files = files
+            self.validated = now
+            self.token = self.storage.get_change_token(probe=False)
+        finally:
+            self.lock.release()
+        self.flush()
+    
+    def list_files(self):
+        '''
+        List all the files in the holder, from the cloud only if the snapshot is stale.
+        
+        :return: it returns CloudFile instances in the order of the path,
+                 the same as the recursive listing of the storage.
+        '''
+        
+        self.refresh()
+        
+        self.lock.acquire()
+        try:
+            items = sorted(self.files.iteritems())
+        finally:
+            self.lock.release()
+        
+        for key, (md5, size, timestamp) in items:
+            yield CloudFile(key, '', md5, size=size, timestamp=timestamp)
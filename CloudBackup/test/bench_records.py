@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+# Measure the memory of the file records, the RSS grown per record.
+# Each kind is measured in a process of its own, since the max RSS never shrinks.
+# 
+# Usage:
+# python -m CloudBackup.test.bench_records [the records, 300000 as default]
+
+import sys
+import gc
+import subprocess
+import resource
+
+from CloudBackup.local import FileEntry
+from CloudBackup.cloud import CloudFile
+
+DEFAULT_RECORDS = 300000
+KINDS = ('FileEntry', 'CloudFile')
+
+def _get_rss():
+    # kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(kind, n):
+    '''
+    :return: the bytes of RSS per record.
+    '''
+    
+    paths = ['dir%d/file%d.txt' % (i % 1000, i) for i in xrange(n)]
+    gc.collect()
+    before = _get_rss()
+    
+    if kind == 'FileEntry':
+        records = [FileEntry(path, 1350000000 + i, None, size=i, inode=i)
+                   for i, path in enumerate(paths)]
+    else:
+        records = [CloudFile(path, '', None, size=i)
+                   for i, path in enumerate(paths)]
+    
+    after = _get_rss()
+    assert len(records) == n
+    return float(after - before) / n
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else DEFAULT_RECORDS
+    if len(argv) > 2:
+        print '%.1f' % measure(argv[2], n)
+        return
+    
+    for kind in KINDS:
+        output = subprocess.check_output([sys.executable, '-m', 'CloudBackup.test.bench_records',
+                                          str(n), kind])
+        print '%s: %s bytes per record, %d records' % (kind, output.strip(), n)
+
+if __name__ == '__main__':
+    main(sys.argv)
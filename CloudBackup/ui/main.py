@@ -135,6 +135,8 @@ class UI(QtGui.QMainWindow):
         self.vdisk_info = self.env.load_vdisk_info()
         self.s3_info = self.env.load_s3_info()
         self.gs_info = self.env.load_gs_info()
+        self.env.load_bandwidth()
+        self.env.load_ignore()
         
         self.vdisk_cloud_browser_thread = None
         self.vdisk_cloud_browser_thread_lock = threading.Lock()
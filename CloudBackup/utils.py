@@ -24,6 +24,7 @@ __author__ = "Chine King"
 
 import os
 import sys
+import hashlib
 import platform
 import subprocess
 
@@ -35,6 +36,9 @@ def join_path(*path):
 def join_local_path(*path):
     return os.path.join(*(p.replace('/', os.sep) for p in path))
 
+def calc_md5(data):
+    return hashlib.md5(data).hexdigest()
+
 def get_sys_encoding():
     return sys.getfilesystemencoding()
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Copyright (c) 2012 chine <qin@qinxuye.me>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Created on 2026-10-19
+'''
+
+import time
+
+class RetentionPolicy(object):
+    '''
+    Decide which old versions of a file to keep.
+    
+    A version expires only if it is neither one of the newest `keep_last` versions,
+    nor modified in the latest `max_age` seconds.
+    The newest version is always kept.
+    '''
+    
+    def __init__(self, keep_last=None, max_age=None):
+        '''
+        :param keep_last(optional): the number of newest versions to keep, None means no limit.
+        :param max_age(optional): the seconds in which the versions are kept, None means no limit.
+        '''
+        
+        assert keep_last is not None or max_age is not None
+        
+        self.keep_last = max(keep_last, 1) if keep_last is not None else None
+        self.max_age = max_age
+    
+    def expired(self, versions, now=None):
+        '''
+        :param versions: list of (timestamp, obj), sorted from the newest to the oldest.
+        
+        :return: the list of (timestamp, obj) which expire.
+        '''
+        
+        if now is None:
+            now = time.time()
+        
+        expired = []
+        for i, (timestamp, obj) in enumerate(versions):
+            if i == 0:
+                continue
+            if self.keep_last is not None and i < self.keep_last:
+                continue
+            if self.max_age is not None and timestamp >= now - self.max_age:
+                continue
+            expired.append((timestamp, obj))
+        return expired
+
+class VersionIndex(object):
+    '''
+    Group the cloud files by the local path,
+    each of which may have several versions distinguished by the timestamp.
+    
+    Usage:
+    index = VersionIndex()
+    for f in storage.list_files('', True):
+        path, timestamp = handler.cloud_to_local(f.path)
+        index.add(path, timestamp, f)
+    
+    for path, timestamp, f in index.iter_latest():
+        ...
+    '''
+    
+    def __init__(self):
+        self.latest = {}
+        self.older = {}
+    
+    def __len__(self):
+        return len(self.latest)
+    
+    def __contains__(self, path):
+        return path in self.latest
+    
+    def add(self, path, timestamp, obj):
+        '''
+        :param path: the local path.
+        :param timestamp: the timestamp embedded in the cloud path, -1 if not exists.
+        :param obj: the cloud file.
+        '''
+        
+        current = self.latest.get(path)
+        if current is None:
+            self.latest[path] = (timestamp, obj)
+            return
+        
+        # the newest timestamp wins, compare the cloud path if the same,
+        # so the result doesn't depend on the order of listing.
+        if (timestamp, obj.path) > (current[0], current[1].path):
+            self.latest[path] = (timestamp, obj)
+            self.older.setdefault(path, []).append(current)
+        else:
+            self.older.setdefault(path, []).append((timestamp, obj))
+    
+    def get_latest(self, path):
+        '''
+        :return: (timestamp, obj) of the newest version, None if not exists.
+        '''
+        
+        return self.latest.get(path)
+    
+    def get_versions(self, path):
+        '''
+        :return: list of (timestamp, obj), sorted from the newest to the oldest.
+        '''
+        
+        if path not in self.latest:
+            return []
+        
+        older = sorted(self.older.get(path, []), key=lambda itm: (itm[0], itm[1].path),
+                       reverse=True)
+        return [self.latest[path]] + older
+    
+    def iter_latest(self):
+        for path, (timestamp, obj) in self.latest.iteritems():
+            yield path, timestamp, obj
+    
+    def iter_expired(self, policy, now=None):
+        '''
+        Iterate the cloud files which expire by the retention policy.
+        The files without timestamp are not created by us, so they never expire.
+        
+        :param policy: an instance of RetentionPolicy.
+        '''
+        
+        for path in self.older:
+            versions = [itm for itm in self.get_versions(path) if itm[0] >= 0]
+            for _, obj in policy.expired(versions, now):
+                yield obj
+    
+    def remove(self, path, obj):
+        versions = self.older.get(path, [])
+        self.older[path] = [itm for itm in versions if itm[1] is not obj]
+        if not self.older[path]:
+            del self.older[path]